@@ -1,6 +1,7 @@
-from Encounter import Encounter, disposition_names, default_encounter_diagnoses_list
+from Encounter import Encounter, disposition_names, disposition_name_to_bit, default_encounter_diagnoses_list
 from icd_code_to_category import compute_suicide_attempt_likely
-import uuid
+from memoization import memoized, mark_modified
+from id_interning import encounter_ids
 from statistics import median
 
 def compute_whether_had_complaint(encounters, complaints):
@@ -10,6 +11,24 @@ def compute_whether_had_complaint(encounters, complaints):
         return -9999
     return 0
 
+# Whether each primary ICD code is psychiatric, filled in as codes are seen, since the same codes repeat across episodes.
+icd_code_to_is_psychiatric = {}
+
+def is_psychiatric_icd_code(icd_code):
+    is_psychiatric = icd_code_to_is_psychiatric.get(icd_code)
+    if is_psychiatric is None:
+        try:
+
+            # ICD 9: 290.* - 319.* are psychiatric.
+            icd_9_code = float(icd_code)
+            is_psychiatric = (icd_9_code >= 290) and (icd_9_code < 320)
+        except ValueError:
+
+            # ICD 10: Anything starting with F is psychiatric.
+            is_psychiatric = icd_code[0] == 'F'
+        icd_code_to_is_psychiatric[icd_code] = is_psychiatric
+    return is_psychiatric
+
 diagnosis_to_episode_diagnosis = {}
 for diagnosis in default_encounter_diagnoses_list:
     diagnosis_to_episode_diagnosis[diagnosis] = 'episode_%s' % diagnosis
@@ -24,10 +43,18 @@ class CareEpisode:
         self.previous_calendar_year_emergency_visits = -9999
         self.previous_calendar_year_hospital_visits = -9999
 
-        # Used to cache a commonly accessed set of data during CSV generation. This data has non-trivial computation costs, so caching saves non-trivial time.
-        self.encounter_diagnoses = None
+        # Used to cache commonly accessed data during CSV generation. This data has non-trivial computation costs, so caching saves non-trivial time.
+        self.memoized_values = {}
+
+    # Memoized values are not pickled, e.g. when a patient is written to a PatientStore. They are recomputed on demand.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memoized_values'] = {}
+        return state
 
     def add_visit_type(self, encounter_year, visit_type, number_of_visits):
+        mark_modified()
+
         self.previous_calendar_year_ambulatory_visits = max(self.previous_calendar_year_ambulatory_visits, 0)
         self.previous_calendar_year_emergency_visits = max(self.previous_calendar_year_emergency_visits, 0)
         self.previous_calendar_year_hospital_visits = max(self.previous_calendar_year_hospital_visits, 0)
@@ -40,7 +67,9 @@ class CareEpisode:
             self.previous_calendar_year_hospital_visits = self.previous_calendar_year_hospital_visits + number_of_visits
 
     def add_encounter_from_charges(self, row):
-        encounter_id = row['STUDY_CSN']
+        mark_modified()
+
+        encounter_id = encounter_ids.intern(row['STUDY_CSN'])
 
         # Ignore encounters that don't have an id.
         if encounter_id:
@@ -50,7 +79,9 @@ class CareEpisode:
             self.encounters[encounter_id].add_charge(row['AMOUNT'])
 
     def add_encounter_by_encounter_id(self, encounter_id = None):
-        encounter_id = encounter_id if encounter_id else 'phantom%s' % str(uuid.uuid4())
+        mark_modified()
+
+        encounter_id = encounter_id if encounter_id else encounter_ids.make_phantom_id()
 
         if encounter_id not in self.encounters:
             self.encounters[encounter_id] = Encounter(encounter_id)
@@ -58,6 +89,7 @@ class CareEpisode:
     def add_pain_score_to_encounter(self, encounter_id, pain_score):
         self.encounters[encounter_id].add_pain_score(int(pain_score))
 
+    @memoized
     def get_pain_score(self):
 
         # Combine all pain scores for each encounter.
@@ -71,72 +103,73 @@ class CareEpisode:
             pain_score = median(pain_scores)
         return pain_score
 
+    @memoized
     def get_charges(self):
         episode_charges = [ encounter.charge for encounter in self.encounters.values() if encounter.charge is not None ]
 
         return sum(episode_charges) if len(episode_charges) > 0 else -9999
 
+    @memoized
     def get_chief_complaint_medical(self):
         return compute_whether_had_complaint(
             self.encounters,
             [ encounter.chief_complaint_medical for encounter in self.encounters.values() ]
         )
 
+    @memoized
     def get_chief_complaint_psychiatric(self):
         return compute_whether_had_complaint(
             self.encounters,
             [ encounter.chief_complaint_psychiatric for encounter in self.encounters.values() ]
         )
 
+    @memoized
     def get_chief_complaint_suicidal(self):
         return compute_whether_had_complaint(
             self.encounters,
             [ encounter.chief_complaint_suicidal for encounter in self.encounters.values() ]
         )
 
+    @memoized
     def get_chief_complaint_substance_use(self):
         return compute_whether_had_complaint(
             self.encounters,
             [ encounter.chief_complaint_substance_use for encounter in self.encounters.values() ]
         )
 
+    @memoized
     def get_primary_diagnosis(self):
         is_primary_diagnosis_psychiatric = -9999
         is_primary_diagnosis_medical = -9999
-        primary_diagnosis_icd_codes = ''
-        primary_diagnosis_descriptions = ''
+        primary_icd_codes = []
+        primary_icd_descriptions = []
         is_psychiatric = False
 
         for encounter in self.encounters.values():
-            if len(encounter.primary_icd_codes):
-
-                for index, icd_code in enumerate(encounter.primary_icd_codes):
-                    primary_diagnosis_icd_codes = primary_diagnosis_icd_codes + ',' + icd_code
-                    primary_diagnosis_descriptions = primary_diagnosis_descriptions + ',' + encounter.primary_icd_descriptions[index]
-                    try:
-
-                        # ICD 9: 290.* - 319.* are psychiatric.
-                        icd_9_code = float(icd_code)
-                        if (icd_9_code >= 290) and (icd_9_code < 320):
-                            is_psychiatric = True
-                    except:
-
-                        # ICD 10: Anything starting with F is psychiatric.
-                        if icd_code[0] == 'F':
-                            is_psychiatric = True
-
-                    if is_psychiatric:
-                        is_primary_diagnosis_psychiatric = 1
-                        if is_primary_diagnosis_medical == -9999:
-                            is_primary_diagnosis_medical = 0
-                    else:
-                        is_primary_diagnosis_medical = 1
-                        if is_primary_diagnosis_psychiatric == -9999:
-                            is_primary_diagnosis_psychiatric = 0
+            for icd_code, icd_description in zip(encounter.primary_icd_codes, encounter.primary_icd_descriptions):
+                primary_icd_codes.append(icd_code)
+                primary_icd_descriptions.append(icd_description)
+
+                # Once a code is psychiatric, the following codes in the episode count as psychiatric too.
+                is_psychiatric = is_psychiatric_icd_code(icd_code) or is_psychiatric
+
+                if is_psychiatric:
+                    is_primary_diagnosis_psychiatric = 1
+                    if is_primary_diagnosis_medical == -9999:
+                        is_primary_diagnosis_medical = 0
+                else:
+                    is_primary_diagnosis_medical = 1
+                    if is_primary_diagnosis_psychiatric == -9999:
+                        is_primary_diagnosis_psychiatric = 0
+
+        # Each code and description is preceded by a comma, e.g. ',F329,F411'.
+        primary_diagnosis_icd_codes = ''.join([ ',' + icd_code for icd_code in primary_icd_codes ])
+        primary_diagnosis_descriptions = ''.join([ ',' + icd_description for icd_description in primary_icd_descriptions ])
 
         return (is_primary_diagnosis_psychiatric, is_primary_diagnosis_medical,
                 primary_diagnosis_icd_codes, primary_diagnosis_descriptions)
 
+    @memoized
     def is_psychiatric_hospitalization(self):
         (is_primary_diagnosis_psychiatric, is_primary_diagnosis_medical,
         primary_diagnosis_icd_codes, primary_diagnosis_descriptions) = self.get_primary_diagnosis()
@@ -149,6 +182,7 @@ class CareEpisode:
                 return -9999
         return 0
 
+    @memoized
     def is_transfer_psychiatric(self):
         is_transfer_psychiatric = any([encounter.is_transfer_psychiatric for encounter in self.encounters.values()])
 
@@ -158,6 +192,7 @@ class CareEpisode:
             return -9999
         return 0
 
+    @memoized
     def get_start_day(self):
         start_days = [ encounter.start_day for encounter in self.encounters.values() if encounter.start_day != None ]
 
@@ -165,6 +200,7 @@ class CareEpisode:
             return min(start_days)
         return -9999
 
+    @memoized
     def get_discharge_day(self):
         discharge_days = [ encounter.discharge_day for encounter in self.encounters.values() if encounter.discharge_day != None ]
 
@@ -172,6 +208,7 @@ class CareEpisode:
             return max(discharge_days)
         return -9999
 
+    @memoized
     def get_length_of_stay(self):
         start_day = self.get_start_day()
         discharge_day = self.get_discharge_day()
@@ -180,33 +217,39 @@ class CareEpisode:
             return -9999
         return discharge_day - start_day
 
+    @memoized
     def get_dispositions(self):
+
+        # 1 if any encounter had the disposition, 0 if none did, or -9999 if no encounter had a discharge disposition.
+        encounter_disposition_bits = [ encounter.disposition_bits for encounter in self.encounters.values() if encounter.disposition_bits is not None ]
+        if not encounter_disposition_bits:
+            return dict.fromkeys(disposition_names, -9999)
+
+        disposition_bits = 0
+        for bits in encounter_disposition_bits:
+            disposition_bits |= bits
+
         dispositions = {}
         for name in disposition_names:
-            disposition_values = [ encounter.dispositions[name] for encounter in self.encounters.values() if encounter.dispositions[name] != None ]
-            value = -9999
-            if len(disposition_values):
-                value = 1 if any(disposition_values) else 0
-            dispositions[name] = value
+            dispositions[name] = 1 if disposition_bits & disposition_name_to_bit[name] else 0
         return dispositions
 
+    @memoized
     def get_episode_diagnoses(self):
-        if not self.encounter_diagnoses:
-
-            # Initialize to each diagnosis to -9999.
-            diagnoses = {}
-            for diagnosis in default_encounter_diagnoses_list:
-                diagnoses[diagnosis] = -9999
 
-            # Combine diagnoses across encounters. If any diagnosis is 1, then 1. Else if any 0, then 0. Else, -9999.
-            for encounter in self.encounters.values():
-                for diagnosis in diagnoses:
-                    diagnoses[diagnosis] = max(diagnoses[diagnosis], encounter.diagnoses[diagnosis])
+        # Initialize to each diagnosis to -9999.
+        diagnoses = {}
+        for diagnosis in default_encounter_diagnoses_list:
+            diagnoses[diagnosis] = -9999
 
-            compute_suicide_attempt_likely(diagnoses)
+        # Combine diagnoses across encounters. If any diagnosis is 1, then 1. Else if any 0, then 0. Else, -9999.
+        for encounter in self.encounters.values():
+            for diagnosis in diagnoses:
+                diagnoses[diagnosis] = max(diagnoses[diagnosis], encounter.diagnoses[diagnosis])
 
-            self.encounter_diagnoses = {}
-            for diagnosis, value in diagnoses.items():
-                self.encounter_diagnoses[diagnosis_to_episode_diagnosis[diagnosis]] = value
+        compute_suicide_attempt_likely(diagnoses)
 
-        return self.encounter_diagnoses
+        episode_diagnoses = {}
+        for diagnosis, value in diagnoses.items():
+            episode_diagnoses[diagnosis_to_episode_diagnosis[diagnosis]] = value
+        return episode_diagnoses
@@ -1,5 +1,7 @@
 from math import log
+from collections import Counter
 from icd_code_to_category import make_diagnosis_categories, add_icd_code_to_dictionary
+from memoization import mark_modified
 
 planned_psychiatric_transfer_strings = [
     'Psychiatric Hospital UCLA RNPH with planned Acute IP readmission',
@@ -29,6 +31,49 @@ died_strings = [ 'Expired' ]
 rehab_strings = [ 'Inpatient Rehab Facility or Unit (not UCLA)', 'Inpatient Rehab Unit UCLA 1West' ]
 long_term_care_strings = [ 'Residential Care Facility', 'Long Term Care Hospital (LTCH)', 'Long Term Acute Facility' ]
 
+disposition_name_to_strings = {
+    'home': home_strings,
+    'home_health': home_health_strings,
+    'psychiatry': psychiatry_strings,
+    'acute_care': acute_care_strings,
+    'operating_room': operating_room_strings,
+    'hospice': hospice_strings,
+    'skilled_nursing_facility': skilled_nursing_facility_strings,
+    'planned_readmit': planned_readmit_strings,
+    'awol': awol_strings,
+    'died': died_strings,
+    'rehab': rehab_strings,
+    'long_term_care': long_term_care_strings,
+}
+
+# Each disposition is one bit, in the order of disposition_names.
+disposition_name_to_bit = {}
+for index, disposition_name in enumerate(disposition_names):
+    disposition_name_to_bit[disposition_name] = 1 << index
+
+# Every known discharge disposition string, compiled to (disposition bits, is_transfer_psychiatric, is_transfer_planned, is_transfer_out).
+disposition_string_to_code = {}
+for discharge_disposition in set([ string for strings in disposition_name_to_strings.values() for string in strings ] + psychiatric_transfer_strings):
+    disposition_bits = 0
+    for disposition_name, strings in disposition_name_to_strings.items():
+        if discharge_disposition in strings:
+            disposition_bits |= disposition_name_to_bit[disposition_name]
+    disposition_string_to_code[discharge_disposition] = (
+        disposition_bits,
+        discharge_disposition in psychiatric_transfer_strings,
+        discharge_disposition in planned_psychiatric_transfer_strings,
+        discharge_disposition == psychiatric_transfer_out_string,
+    )
+unknown_disposition_code = (0, False, False, False)
+
+# Discharge dispositions that aren't in any of the lists above, and how often each was seen. These count as no
+# disposition and no transfer. Empty dispositions aren't counted.
+unknown_disposition_counts = Counter()
+
+def print_unknown_dispositions():
+    for discharge_disposition, count in unknown_disposition_counts.most_common():
+        print('Unknown discharge disposition %s: %d encounters' % (discharge_disposition, count))
+
 default_encounter_diagnoses_list = make_diagnosis_categories()
 default_diagnoses = {}
 for item in default_encounter_diagnoses_list:
@@ -54,11 +99,11 @@ class Encounter:
         self.discharge_day = None
         self.diagnoses = default_diagnoses.copy()
 
-        self.dispositions = {}
-        for disposition_name in disposition_names:
-            self.dispositions[disposition_name] = None
+        # Bits from disposition_name_to_bit, or None if there was no discharge disposition.
+        self.disposition_bits = None
 
     def add_charge(self, charge):
+        mark_modified()
         if self.charge is None:
             self.charge = 0
 
@@ -67,10 +112,12 @@ class Encounter:
             self.charge = self.charge + log(charge_float)
 
     def add_pain_score(self, pain_score):
+        mark_modified()
         if 0 <= pain_score <= 11:
             self.pain_scores.append(pain_score)
 
     def add_chief_complaints(self, medical, psychiatric, suicidal, substance_use):
+        mark_modified()
         self.chief_complaint_medical = True if self.chief_complaint_medical else medical
         self.chief_complaint_psychiatric = True if self.chief_complaint_psychiatric else psychiatric
         self.chief_complaint_suicidal = True if self.chief_complaint_suicidal else suicidal
@@ -80,34 +127,26 @@ class Encounter:
             self.diagnoses['suicidal_ideation'] = 1
 
     def add_diagnosis(self, icd_code, icd_description, is_primary_diagnosis):
+        mark_modified()
         if is_primary_diagnosis:
             self.primary_icd_codes.append(icd_code)
             self.primary_icd_descriptions.append(icd_description)
         add_icd_code_to_dictionary(icd_code, self.diagnoses)
 
     def add_discharge_disposition(self, discharge_disposition):
-        self.is_transfer_psychiatric = discharge_disposition in psychiatric_transfer_strings
-        self.is_transfer_planned = discharge_disposition in planned_psychiatric_transfer_strings
-        self.is_transfer_out = discharge_disposition == psychiatric_transfer_out_string
-
-        self.dispositions = {
-            'home': discharge_disposition in home_strings,
-            'home_health': discharge_disposition in home_health_strings,
-            'psychiatry': discharge_disposition in psychiatry_strings,
-            'acute_care': discharge_disposition in acute_care_strings,
-            'operating_room': discharge_disposition in operating_room_strings,
-            'hospice': discharge_disposition in hospice_strings,
-            'skilled_nursing_facility': discharge_disposition in skilled_nursing_facility_strings,
-            'planned_readmit': discharge_disposition in planned_readmit_strings,
-            'awol': discharge_disposition in awol_strings,
-            'died': discharge_disposition in died_strings,
-            'rehab': discharge_disposition in rehab_strings,
-            'long_term_care': discharge_disposition in long_term_care_strings,
-        }
+        mark_modified()
+        code = disposition_string_to_code.get(discharge_disposition)
+        if code is None:
+            code = unknown_disposition_code
+            if discharge_disposition:
+                unknown_disposition_counts[discharge_disposition] += 1
+        self.disposition_bits, self.is_transfer_psychiatric, self.is_transfer_planned, self.is_transfer_out = code
 
     def add_length_of_stay(self, length_of_stay):
+        mark_modified()
         self.length_of_stay = None if length_of_stay == '' else int(length_of_stay)
 
     def add_date_ranges(self, start_day, discharge_day):
+        mark_modified()
         self.start_day = None if start_day == '' else int(start_day)
         self.discharge_day = None if discharge_day == '' else int(discharge_day)
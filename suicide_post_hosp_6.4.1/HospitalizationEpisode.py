@@ -2,31 +2,66 @@ from numpy import nan
 from Patient import epic_medicine_categories, custom_medicine_categories
 from CareEpisode import encounter_diagnoses_list
 from icd_code_to_category import make_diagnosis_categories, elixhauser_to_icd9
+from output_sinks import read_rows
+from instrumentation import stage
+from feature_matrix import build_feature_matrix
 import csv
 from numpy import array
 from math import isnan
 
-def load_episodes(aggregated_days):
+def load_episodes(aggregated_days, input_format='csv', sampler=None):
     print('Loading episodes')
-    care_episodes = []
-    with open('analyzable_care_episodes_%ddays.csv' % aggregated_days, 'r', encoding='iso-8859-1') as encounters_file:
-        reader = csv.DictReader(encounters_file)
-        for row in reader:
-            care_episodes.append(HospitalizationEpisode(row))
+    with stage('Load episodes for %d days' % aggregated_days) as report:
+        if input_format != 'csv':
+
+            # Parquet and Arrow files are typed, so only read the columns HospitalizationEpisode uses.
+            rows, column_names = read_rows('analyzable_care_episodes_%ddays' % aggregated_days, input_format, hospitalization_episode_columns)
+            care_episodes = [ HospitalizationEpisode(row) for row in rows ]
+        else:
+            care_episodes = []
+            with open('analyzable_care_episodes_%ddays.csv' % aggregated_days, 'r', encoding='iso-8859-1') as encounters_file:
+                reader = csv.DictReader(encounters_file)
+                for row in reader:
+                    care_episodes.append(HospitalizationEpisode(row))
+        if sampler:
+
+            # Samples the same patients as a sampled run of make_analyzable_care_episodes.py, from full files.
+            care_episodes = [ care_episode for care_episode in care_episodes if sampler.is_sampled(care_episode.id) ]
+        report['rows'] = len(care_episodes)
     return care_episodes
 
 
-def get_medical_hospitalization_episodes(aggregated_days, use_serious_mental_illness_only=False, use_suicidal_ideation=False, use_suicide_attempt=True, use_suicide_attempt_broad=False, use_cdc_suicide_self_injury=False):
-    initial_care_episodes = load_episodes(aggregated_days)
+# The ICD maps have no bipolar or schizoaffective categories. Elixhauser's psychoses category covers schizophrenia,
+# schizoaffective disorder and bipolar disorder with psychotic features.
+serious_mental_illness_categories = [ 'psychoses', 'depression' ]
+
+def is_serious_mental_illness(episode):
+    return any([ episode.diagnoses[category] == 1 for category in serious_mental_illness_categories ])
+
+
+def get_predictors_for_layout(predictors_labeled, number_of_rows, predictor_layout):
+
+    '''
+        Returns predictors_labeled and the dense float64 predictors array, or, for any other predictor_layout, None
+        and a FeatureMatrix read straight from the predictors_labeled iterator, without holding every dict or a
+        dense copy.
+    '''
+    if predictor_layout == 'dense':
+        predictors_labeled = list(predictors_labeled)
+        return predictors_labeled, array([ list(episode.values()) for episode in predictors_labeled ])
+    return None, build_feature_matrix(predictors_labeled, predictor_layout, number_of_rows)
+
+
+def get_medical_hospitalization_episodes(aggregated_days, use_serious_mental_illness_only=False, use_suicidal_ideation=False, use_suicide_attempt=True, use_suicide_attempt_broad=False, use_cdc_suicide_self_injury=False, input_format='csv', sampler=None, predictor_layout='dense'):
+    initial_care_episodes = load_episodes(aggregated_days, input_format, sampler)
 
     # Remove hospitalizations that we don't know whether the next hospitalization included a suicide attempt.
     care_episodes = [ episode for episode in initial_care_episodes if not isnan(episode.get_suicidal_outcome(use_suicidal_ideation, use_suicide_attempt, use_suicide_attempt_broad, use_cdc_suicide_self_injury)) ]
 
     if use_serious_mental_illness_only:
-        care_episodes = [ episode for episode in care_episodes if (episode.diagnoses['bipolar'] == 1) or (episode.diagnoses['psychosis'] == 1) or (episode.diagnoses['schizoaffective'] == 1) or (episode.diagnoses['depression'] == 1) ]
+        care_episodes = [ episode for episode in care_episodes if is_serious_mental_illness(episode) ]
 
-    predictors_labeled = [ episode.get_predictors() for episode in care_episodes ]
-    predictors = array([ list(episode.values()) for episode in predictors_labeled ])
+    predictors_labeled, predictors = get_predictors_for_layout((episode.get_predictors() for episode in care_episodes), len(care_episodes), predictor_layout)
     outcomes = array([ episode.get_suicidal_outcome(use_suicidal_ideation, use_suicide_attempt, use_suicide_attempt_broad, use_cdc_suicide_self_injury) for episode in care_episodes ])
 
     care_episode_indices = [ initial_care_episodes.index(care_episode) for care_episode in care_episodes ]
@@ -34,8 +69,8 @@ def get_medical_hospitalization_episodes(aggregated_days, use_serious_mental_ill
     return predictors_labeled, predictors, outcomes, care_episode_indices
 
 
-def get_bipolar_episodes(aggregated_days, outcome_days_until_rehospitalization, predictors_to_use=None, use_psychiatric_rehospitalization_outcome=False, use_bipolar_only=False):
-    care_episodes = load_episodes(aggregated_days)
+def get_bipolar_episodes(aggregated_days, outcome_days_until_rehospitalization, predictors_to_use=None, use_psychiatric_rehospitalization_outcome=False, use_bipolar_only=False, input_format='csv', sampler=None, predictor_layout='dense'):
+    care_episodes = load_episodes(aggregated_days, input_format, sampler)
 
     if use_bipolar_only:
         care_episodes = [ care_episode for care_episode in care_episodes if care_episode.diagnoses['bipolar'] == 1 ]
@@ -44,26 +79,23 @@ def get_bipolar_episodes(aggregated_days, outcome_days_until_rehospitalization,
         care_episodes = [ care_episode for care_episode in care_episodes if care_episode.is_psychiatric_hospitalization ]
 
     # Juliet note: Our research group decided these are unlikely to be useful for prediction as is, so removing medicines and diagnoses.
-    all_predictors_labeled = [ episode.get_predictors(exclude_medicines_and_diagnoses=True) for episode in care_episodes ]
+    all_predictors_labeled = (episode.get_predictors(exclude_medicines_and_diagnoses=True) for episode in care_episodes)
 
     if predictors_to_use is None:
         predictors_labeled = all_predictors_labeled
     else:
-        predictors_labeled = []
-        for episode in all_predictors_labeled:
-            new_episode = {}
-            for label, value in episode.items():
-                if label in predictors_to_use:
-                    new_episode[label] = value
-            predictors_labeled.append(new_episode)
-
-    predictors = array([ list(episode.values()) for episode in predictors_labeled ])
+        predictors_labeled = (dict([ (label, value) for label, value in episode.items() if label in predictors_to_use ]) for episode in all_predictors_labeled)
+
+    predictors_labeled, predictors = get_predictors_for_layout(predictors_labeled, len(care_episodes), predictor_layout)
     outcomes = array([ episode.get_days_until_rehospitalization(outcome_days_until_rehospitalization, use_psychiatric_rehospitalization_outcome) for episode in care_episodes ])
 
     return predictors_labeled, predictors, outcomes
 
 
+# Parquet and Arrow files store missing data as null, which is read as None.
 def handle_missing_data_int(value):
+    if value is None:
+        return nan
     int_value = int(value)
     if int_value == -9999:
         return nan
@@ -71,6 +103,8 @@ def handle_missing_data_int(value):
 
 
 def handle_missing_data_float(value):
+    if value is None:
+        return nan
     try:
         if int(value) == -9999:
             return nan
@@ -98,12 +132,32 @@ for ethnicity in ethnicities:
 
 gender_options = {
     '-9999': nan,
+    None: nan,
     'Male': '0',
     'Female': '1',
 }
 
 diagnoses = make_diagnosis_categories()
 
+# The analyzable care episode columns read by HospitalizationEpisode.
+hospitalization_episode_columns = [
+    'PatientID', 'CareEpisodeDate', 'does_include_hospitalization',
+    'is_30_day_rehospitalization', 'days_until_rehospitalization', 'is_30_day_psychiatric_rehospitalization', 'days_until_psychiatric_rehospitalization',
+    'gender', 'AGE_AS_OF_1ST_ADMIT', 'race', 'ethnicity',
+    'home', 'home_health', 'psychiatry', 'acute_care', 'operating_room', 'hospice', 'skilled_nursing_facility', 'planned_readmit', 'awol', 'died', 'rehab', 'long_term_care',
+    'elixhauser_walraven_score', 'pain_score', 'Charges',
+    'previous_calendar_year_ambulatory_visits', 'previous_calendar_year_emergency_visits', 'previous_calendar_year_hospital_visits',
+    'previous_year_hospital_cares', 'previous_year_non_hospital_cares', 'previous_year_total_cares',
+    'chief_complaint_medical', 'chief_complaint_psychiatric', 'chief_complaint_suicidal', 'chief_complaint_substance_use',
+    'is_primary_diagnosis_psychiatric', 'is_primary_diagnosis_medical', 'is_transfer_psychiatric', 'length_of_stay', 'is_psychiatric_hospitalization',
+    'is_rehospitalized_for_suicide_attempt', 'is_rehospitalized_for_suicidal_ideation',
+    'is_rehospitalized_for_suicidal_attempt_broad', 'is_rehospitalized_for_cdc_suicide_self_injury',
+]
+hospitalization_episode_columns.extend(epic_medicine_categories)
+hospitalization_episode_columns.extend(custom_medicine_categories)
+hospitalization_episode_columns.extend(diagnoses)
+hospitalization_episode_columns.extend(encounter_diagnoses_list)
+
 class HospitalizationEpisode:
     def __init__(self, row):
         self.id = row['PatientID']
@@ -1,7 +1,12 @@
 from datetime import datetime, timedelta
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
 from CareEpisode import CareEpisode, diagnosis_to_episode_diagnosis
 import re
-from icd_code_to_category import add_icd_code_to_dictionary, make_diagnosis_categories, elixhauser_to_icd9
+from icd_code_to_category import add_icd_code_to_dictionary, make_diagnosis_categories
+from comorbidity import get_comorbidity_score
+from memoization import memoized, mark_modified
+from id_interning import encounter_ids
 
 psychiatric_regular_expression = re.compile('(anxi|depress|psych|suicid|homicid|aggress|panic|agitat|hallucin|addict|manic|mania|bipola|paranoi|behavior|schizo|stress|adhd)', re.IGNORECASE)
 suicidal_regular_expression = re.compile('suicid', re.IGNORECASE)
@@ -45,6 +50,63 @@ def date_to_datetime(date):
     return datetime.strptime(date, date_format)
 
 
+class EpisodeCalendar:
+
+    '''
+        A patient's care episodes with encounters, by day number, so whether an episode with a diagnosis came before
+        a day, or which hospitalizations came within some days after it, is a binary search. The days of each
+        diagnosis are collected the first time it is asked about, so a patient holds one short list per diagnosis
+        rather than a cached answer per care episode and diagnosis.
+    '''
+    def __init__(self, episodes_and_datetimes):
+        self.episodes_and_days = [ (episode_and_datetime['episode'], episode_and_datetime['days'].toordinal()) for episode_and_datetime in episodes_and_datetimes ]
+        self.days = sorted([ day for _, day in self.episodes_and_days ])
+        hospitalizations_and_days = sorted([ (episode, day) for episode, day in self.episodes_and_days if episode.does_include_hospitalization == 1 ], key=itemgetter(1))
+        self.hospitalizations = [ episode for episode, _ in hospitalizations_and_days ]
+        self.hospitalization_days = [ day for _, day in hospitalizations_and_days ]
+        self.diagnosis_days = {}
+        self.hospitalization_diagnoses = {}
+        self.day0s = {}
+
+    def get_day0(self, care_episode):
+
+        # Day 0 is the day that the patient was discharged, as a day number (date ordinal). Kept per care episode, since
+        # parsing the date is slower than the searches.
+        if care_episode.date not in self.day0s:
+            length_of_stay = max(care_episode.get_length_of_stay(), 0)
+            self.day0s[care_episode.date] = date_to_datetime(care_episode.date).toordinal() + length_of_stay
+        return self.day0s[care_episode.date]
+
+    def had_diagnosis_before(self, day, episode_diagnosis):
+
+        '''
+            1 if an episode before day had the diagnosis, 0 if none did, or -9999 if there is no episode before day.
+        '''
+        if not bisect_left(self.days, day):
+            return -9999
+        if episode_diagnosis not in self.diagnosis_days:
+            self.diagnosis_days[episode_diagnosis] = sorted([ day for episode, day in self.episodes_and_days if episode.get_episode_diagnoses()[episode_diagnosis] == 1 ])
+        return 1 if bisect_left(self.diagnosis_days[episode_diagnosis], day) else 0
+
+    def get_days_until_hospitalization(self, day):
+        position = bisect_right(self.hospitalization_days, day)
+        return self.hospitalization_days[position] - day if position < len(self.hospitalization_days) else -9999
+
+    def get_whether_hospitalized_for_diagnosis(self, day, episode_diagnosis, days_after):
+
+        '''
+            The highest value of the diagnosis over the hospitalizations after day, up to days_after days after, or
+            -9999 if there are none.
+        '''
+        start = bisect_right(self.hospitalization_days, day)
+        end = bisect_right(self.hospitalization_days, day + days_after)
+        if start == end:
+            return -9999
+        if episode_diagnosis not in self.hospitalization_diagnoses:
+            self.hospitalization_diagnoses[episode_diagnosis] = [ hospitalization.get_episode_diagnoses()[episode_diagnosis] for hospitalization in self.hospitalizations ]
+        return max(self.hospitalization_diagnoses[episode_diagnosis][start:end])
+
+
 class Patient:
     def __init__(self, id):
         self.id = id
@@ -58,58 +120,32 @@ class Patient:
         self.diagnoses = default_diagnoses.copy()
         self.zip_code = -9999
 
-        # Used to cache a common accessed list of information during CSV generation.
-        self.episodes_and_days = None
+        # Used to cache commonly accessed information during CSV generation.
+        self.memoized_values = {}
 
+    # Memoized values are not pickled, e.g. when a patient is written to a PatientStore. They are recomputed on demand.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memoized_values'] = {}
+        return state
+
+    @memoized
     def get_elixhauser_walraven_score(self):
 
-        '''
-            Scoring from paper:
-            A Modification of the Elixhauser Comorbidity Measures Into a Point System for Hospital Death Using Administrative Data
-            Carl van Walraven, Peter C. Austin, Alison Jennings, Hude Quan, and Alan J. Forster
-        '''
-        category_to_points = {
-            'congestive_heart_failure': 7,
-            'cardiac_arrhythmia': 5,
-            'valvular_disease': -1,
-            'pulmonary_circulation_disorder': 4,
-            'peripheral_vascular_disorder': 2,
-            'hypertension_uncomplicated': 0,
-            'hypertension_complicated': 0,
-            'paralysis': 7,
-            'other_neurological_disorder': 6,
-            'chronic_pulmonary_disease': 3,
-            'diabetes_uncomplicated': 0,
-            'diabetes_complicated': 0,
-            'hypothyroidism': 0,
-            'renal_failure': 5,
-            'liver_disease': 11,
-            'peptic_ulcer_disease_excluding_bleeding': 0,
-            'aids_hiv': 0,
-            'lymphoma': 9,
-            'metastatic_cancer': 12,
-            'solid_tumor_wo_metastasis': 4,
-            'rheumatoid_arhritis': 0,
-            'coagulopathy': 3,
-            'obesity': -4,
-            'weight_loss': 6,
-            'fluid_and_electrolyte_disorders': 5,
-            'blood_loss_anemia': -2,
-            'deficiency_anemia': -2,
-            'alcohol_abuse': 0,
-            'drug_abuse': -7,
-            'psychoses': 0,
-            'depression': -3,
-        }
-
-        elixhauser_walraven_score = sum(
-            [ self.diagnoses[category] * category_to_points[category] for category in elixhauser_to_icd9.keys() ]
-        )
-
-        return elixhauser_walraven_score if elixhauser_walraven_score >= 0 else -9999
+        # The points are in comorbidity.py, which scores the whole cohort at once after merging.
+        return get_comorbidity_score(self, 'elixhauser_walraven')
+
+    def set_care_episodes(self, care_episodes):
+        mark_modified()
+
+        self.care_episodes = {}
+        for care_episode in care_episodes:
+            self.care_episodes[care_episode.date] = care_episode
 
     def add_episode_from_charges(self, row):
-        encounter_id = row['STUDY_CSN']
+        mark_modified()
+
+        encounter_id = encounter_ids.intern(row['STUDY_CSN'])
         encounter = self.find_encounter_by_id(encounter_id)
 
         # Ensure this encounter doesn't exist already.
@@ -123,6 +159,8 @@ class Patient:
 
 
     def add_episode_from_readmissions(self, row):
+        mark_modified()
+
         global date_format
         date = timestamp_to_date(row['EFFECTIVE_DATE_DT'])
 
@@ -130,7 +168,7 @@ class Patient:
         if date not in self.care_episodes:
             self.care_episodes[date] = CareEpisode(date)
         self.care_episodes[date].does_include_hospitalization = True
-        self.care_episodes[date].add_encounter_by_encounter_id(row['STUDY_CSN'])
+        self.care_episodes[date].add_encounter_by_encounter_id(encounter_ids.intern(row['STUDY_CSN']))
 
         # Flag the previous date as a hospitalization.
         previous_date_object = datetime.strptime(date, date_format) - timedelta(days=int(row['DIFF_IN_DAYS']))
@@ -141,15 +179,21 @@ class Patient:
         self.care_episodes[date].add_encounter_by_encounter_id()
 
     def add_demographics(self, row):
+        mark_modified()
+
         self.age_of_first_admit = int(row['AGE_AS_OF_1ST_ADMIT'])
         self.gender = row['gender']
         self.race = row['race']
         self.ethnicity = row['ethnicity']
 
     def add_zip_demographics(self, row):
+        mark_modified()
+
         self.zip_code = row['ZIP_1ST_3']
 
     def add_epic_medication_categories(self, row):
+        mark_modified()
+
         medicines = dict(row)
         del medicines['']
         del medicines['DEID_PATIENT_NUM']
@@ -165,6 +209,8 @@ class Patient:
                 self.epic_medicines[category] = 0
 
     def add_medications(self, row):
+        mark_modified()
+
         for category in custom_medicine_categories:
             regular_expression = custom_medicine_category_to_regular_expression[category]
             medicine_value = 1 if regular_expression.match(row['MEDICATION_NAME']) else 0
@@ -175,7 +221,9 @@ class Patient:
                 self.custom_medicines[category] = 0
 
     def add_pain_score(self, row):
-        encounter_id = row['STUDY_CSN']
+        mark_modified()
+
+        encounter_id = encounter_ids.intern(row['STUDY_CSN'])
         encounter = self.find_encounter_by_id(encounter_id)
 
         # Ensure this encounter doesn't exist already.
@@ -196,7 +244,9 @@ class Patient:
         return None
 
     def add_encounter_diagnosis(self, row):
-        encounter_id = row['STUDY_CSN']
+        mark_modified()
+
+        encounter_id = encounter_ids.intern(row['STUDY_CSN'])
         encounter = self.find_encounter_by_id(encounter_id)
         is_primary_diagnosis = (row['PRIMARY_DIAGNOSIS_FLAG'] == 'P') or (row['ADMISSION_DIAGNOSIS_FLAG'] == 'Y')
         if encounter:
@@ -204,6 +254,8 @@ class Patient:
             encounter.add_diagnosis(icd_code, row['ICD_DESCRIPTION'], is_primary_diagnosis)
 
     def add_visit(self, row):
+        mark_modified()
+
         encounter_year = int(row['ENCOUNTER_YEAR'])
 
         # Outside this range is probably a typo.
@@ -214,7 +266,9 @@ class Patient:
                     care_episode.add_visit_type(encounter_year, row['VISIT_TYPE'], int(row['TOTAL (Visits per Year)']))
 
     def add_chief_complaints(self, row):
-        encounter_id = row['STUDY_CSN']
+        mark_modified()
+
+        encounter_id = encounter_ids.intern(row['STUDY_CSN'])
         encounter = self.find_encounter_by_id(encounter_id)
 
         if encounter:
@@ -237,74 +291,45 @@ class Patient:
 
             encounter.add_chief_complaints(medical, psychiatric, suicidal, substance_use)
 
-    def build_episodes_and_days(self, current_care_episode):
-        if not self.episodes_and_days:
-            care_episodes = [ care_episode for care_episode in self.care_episodes.values() if len(care_episode.encounters) ]
-            self.episodes_and_days = [ { 'episode': care_episode, 'days': date_to_datetime(care_episode.date) } for care_episode in care_episodes ]
+    @memoized
+    def get_episodes_and_datetimes(self):
+        care_episodes = [ care_episode for care_episode in self.care_episodes.values() if len(care_episode.encounters) ]
+        return [ { 'episode': care_episode, 'days': date_to_datetime(care_episode.date) } for care_episode in care_episodes ]
 
-        # Day 0 is the day that the patient was discharged.
-        admit_day = date_to_datetime(current_care_episode.date)
-        length_of_stay = max(current_care_episode.get_length_of_stay(), 0)
-        day0 = admit_day + timedelta(days=length_of_stay)
-
-        return [
-            { 'episode': episode_and_day['episode'], 'days': (episode_and_day['days'] - day0).days }
-            for episode_and_day in self.episodes_and_days
-        ]
+    @memoized
+    def get_episode_calendar(self):
+        return EpisodeCalendar(self.get_episodes_and_datetimes())
 
     def get_days_until_psychiatric_rehospitalization(self, current_care_episode):
         if current_care_episode.is_psychiatric_hospitalization() == 1:
-            episodes_and_days = self.build_episodes_and_days(current_care_episode)
-            hospitalizations_and_days = [ episode_and_day for episode_and_day in episodes_and_days if episode_and_day['episode'].does_include_hospitalization == 1 ]
-            days = [ hospitalization_and_day['days'] for hospitalization_and_day in hospitalizations_and_days ]
-            days_since_hospitalization = [ day for day in days if day > 0 ]
-
-            if days_since_hospitalization:
-                return min(days_since_hospitalization)
+            return self.get_days_until_rehospitalization(current_care_episode)
         return -9999
 
     def had_prior_diagnosis(self, current_care_episode, diagnosis):
-        episodes_and_days = self.build_episodes_and_days(current_care_episode)
-        if episodes_and_days:
-
-            # Filter out later hospitalizations.
-            prior_episodes = [ episode_and_day['episode'] for episode_and_day in episodes_and_days if episode_and_day['days'] < 0 ]
-
-            if prior_episodes:
-                encounter_diagnosis = diagnosis_to_episode_diagnosis[diagnosis]
-                had_prior_diagnosis = any([
-                    prior_episode.get_episode_diagnoses()[encounter_diagnosis] == 1
-                    for prior_episode in prior_episodes
-                ])
-                return 1 if had_prior_diagnosis else 0
-        return -9999
+        calendar = self.get_episode_calendar()
+        return calendar.had_diagnosis_before(calendar.get_day0(current_care_episode), diagnosis_to_episode_diagnosis[diagnosis])
 
-    def get_next_hospitalizations_and_days_since(self, current_care_episode):
-        episodes_and_days = self.build_episodes_and_days(current_care_episode)
-        if episodes_and_days:
-            hospitalizations_and_days = [ episode_and_day for episode_and_day in episodes_and_days if episode_and_day['episode'].does_include_hospitalization == 1 ]
+    def get_days_until_rehospitalization(self, current_care_episode):
+        calendar = self.get_episode_calendar()
+        return calendar.get_days_until_hospitalization(calendar.get_day0(current_care_episode))
 
-            # Filter out prior hospitalizations.
-            prior_hospitalizations_and_days = [ hospitalization_and_day for hospitalization_and_day in hospitalizations_and_days if hospitalization_and_day['days'] > 0 ]
+    def get_whether_rehospitalized_for_diagnosis(self, current_care_episode, diagnosis):
+        calendar = self.get_episode_calendar()
+        return calendar.get_whether_hospitalized_for_diagnosis(calendar.get_day0(current_care_episode), diagnosis, 365)
 
-            if prior_hospitalizations_and_days:
-                return sorted(prior_hospitalizations_and_days, key=lambda k: k['days'])
-        return None
+    def clear_memoized_values(self):
 
-    def get_days_until_rehospitalization(self, current_care_episode):
-        next_hospitalizations_and_days = self.get_next_hospitalizations_and_days_since(current_care_episode)
-        return next_hospitalizations_and_days[0]['days'] if next_hospitalizations_and_days else -9999
+        # Frees the cached values of the patient and its care episodes, e.g. once every row of the patient is written.
+        self.memoized_values.clear()
+        for care_episode in self.care_episodes.values():
+            care_episode.memoized_values.clear()
 
-    def get_whether_rehospitalized_for_diagnosis(self, current_care_episode, diagnosis):
-        next_hospitalizations_and_days = self.get_next_hospitalizations_and_days_since(current_care_episode)
-        if next_hospitalizations_and_days:
-            next_year_episodes = [ next_hospitalization_and_day['episode'] for next_hospitalization_and_day in next_hospitalizations_and_days if next_hospitalization_and_day['days'] <= 365 ]
-            subsequent_diagnoses = [ next_year_episode.get_episode_diagnoses()[diagnosis] for next_year_episode in next_year_episodes ]
-            if subsequent_diagnoses:
-                return max(subsequent_diagnoses)
-        return -9999
+    def add_diagnoses(self, row):
+        self.add_diagnoses_by_code(row['ICD_CODE'].replace('.', ''))
 
     def add_diagnoses_by_code(self, code):
+        mark_modified()
+
         add_icd_code_to_dictionary(code, self.diagnoses)
 
     def count_previous_year_cares(self, care_episode_to_count_from):
@@ -331,7 +356,9 @@ class Patient:
         return previous_year_hospital_cares, previous_year_non_hospital_cares, previous_year_total_cares
 
     def add_encounters(self, row):
-        encounter_id = row['STUDY_CSN']
+        mark_modified()
+
+        encounter_id = encounter_ids.intern(row['STUDY_CSN'])
         encounter = self.find_encounter_by_id(encounter_id)
 
         if encounter:
@@ -0,0 +1,124 @@
+'''
+    Times the pipeline end to end on synthetic cohorts of increasing size: ingest of each source file, the care episode
+    merge, the CSV export and cross validation of the classifier. Results are written to a JSON file, and compared to a
+    previous results file (--baseline) to catch performance regressions.
+'''
+import argparse
+import json
+import os
+import sys
+from os import path
+import instrumentation
+import source_files
+from instrumentation import stage
+from synthetic_cohort import generate_cohort
+from make_analyzable_care_episodes import load_patients, merge_care_episodes, make_care_episode_file
+
+def run_cross_validation_benchmark(number_of_days_back):
+    import decision_tree_utilities
+    from HospitalizationEpisode import get_medical_hospitalization_episodes
+    from sklearn.preprocessing import Imputer
+
+    predictors_labeled, predictors, outcomes, care_episode_indices = get_medical_hospitalization_episodes(
+        number_of_days_back, use_suicide_attempt=False, use_cdc_suicide_self_injury=True
+    )
+    with stage('Impute missing predictors', rows=len(predictors)):
+        predictors = Imputer(strategy='median').fit_transform(predictors)
+
+    # run_cross_validation works on the module's data and accumulates its metrics there.
+    decision_tree_utilities.predictors_labeled = predictors_labeled
+    decision_tree_utilities.predictors = predictors
+    decision_tree_utilities.outcomes = outcomes
+    decision_tree_utilities.care_episode_index_results = None
+    for results in [ decision_tree_utilities.outcome_values, decision_tree_utilities.prediction_values, decision_tree_utilities.probabilities ]:
+        del results[:]
+
+    command_args = { 'cv_fold': 10, 'balancing': 'balanced', 'random_seed': 314, 'max_leaf_nodes': 16 }
+    decision_tree_utilities.run_cross_validation(command_args, 'benchmark_tree')
+
+
+def run_benchmark(number_of_patients, benchmark_directory, episodes_per_patient, include_cross_validation):
+    cohort_directory = path.abspath(path.join(benchmark_directory, 'cohort_%d_patients' % number_of_patients))
+    work_directory = path.join(benchmark_directory, 'output_%d_patients' % number_of_patients)
+    os.makedirs(work_directory, exist_ok=True)
+
+    # Cohorts are reused between runs, since generating the largest takes a while.
+    if not path.exists(path.join(cohort_directory, 'Encounters_5.2018.csv')):
+        print('Generating %d patients' % number_of_patients)
+        generate_cohort(cohort_directory, number_of_patients, episodes_per_patient)
+
+    del instrumentation.stage_reports[:]
+    source_files.source_directory = cohort_directory
+    current_directory = os.getcwd()
+    os.chdir(work_directory)
+    try:
+        patients = {}
+        with stage('Total'):
+            load_patients(patients)
+            merge_care_episodes(patients)
+            make_care_episode_file(patients, 365)
+            if include_cross_validation:
+                del patients
+                run_cross_validation_benchmark(365)
+    finally:
+        os.chdir(current_directory)
+
+    return [ dict(report) for report in instrumentation.stage_reports ]
+
+
+def find_regressions(results, baseline, tolerance, minimum_seconds):
+    regressions = []
+    for number_of_patients, reports in results.items():
+        baseline_times = { report['name']: report['wall_time_seconds'] for report in baseline.get(number_of_patients, []) }
+        for report in reports:
+            baseline_time = baseline_times.get(report['name'])
+            if baseline_time is None:
+                continue
+
+            # Ignore small absolute differences, which are mostly noise.
+            slowdown = report['wall_time_seconds'] - baseline_time
+            if (slowdown > minimum_seconds) and (report['wall_time_seconds'] > baseline_time * (1 + tolerance)):
+                regressions.append((number_of_patients, report['name'], baseline_time, report['wall_time_seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic cohorts')
+    parser.add_argument('--patients', nargs='+', default=[10000, 100000, 1000000], type=int, help='cohort sizes to benchmark')
+    parser.add_argument('--episodes_per_patient', default=4, type=float, help='mean number of care episodes per patient')
+    parser.add_argument('--benchmark_directory', default='benchmarks', help='directory for the synthetic cohorts and outputs')
+    parser.add_argument('--skip_cross_validation', action='store_true', help='only benchmark building the analyzable files')
+    parser.add_argument('--results', default='benchmark_results.json', help='JSON file to write the results to')
+    parser.add_argument('--baseline', default=None, help='results JSON file from a previous run to compare against')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='fraction a stage can slow down by before it is a regression')
+    parser.add_argument('--minimum_seconds', default=1.0, type=float, help='slowdowns smaller than this many seconds are ignored')
+    command_args = vars(parser.parse_args())
+
+    results = {}
+    for number_of_patients in command_args['patients']:
+        reports = run_benchmark(
+            number_of_patients, command_args['benchmark_directory'], command_args['episodes_per_patient'],
+            not command_args['skip_cross_validation']
+        )
+
+        # JSON keys are strings, so use strings here too so results compare against a loaded baseline.
+        results[str(number_of_patients)] = reports
+        print('%d patients' % number_of_patients)
+        for report in reports:
+            print('    %-45s %10.2f s %10.1f MB peak RSS' % (report['name'], report['wall_time_seconds'], report['peak_rss_mb']))
+
+    with open(command_args['results'], 'w') as results_file:
+        json.dump(results, results_file, indent=4)
+
+    if command_args['baseline']:
+        with open(command_args['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(results, baseline, command_args['tolerance'], command_args['minimum_seconds'])
+        for number_of_patients, name, baseline_time, wall_time in regressions:
+            print('Regression at %s patients in %s: %.2f s -> %.2f s' % (number_of_patients, name, baseline_time, wall_time))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
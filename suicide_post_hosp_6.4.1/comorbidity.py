@@ -0,0 +1,140 @@
+'''
+    Comorbidity indices scored from each patient's diagnosis categories. An index is a constant vector of points, one
+    per category it counts, so scoring a cohort is one product of the patients x categories matrix of diagnosis flags
+    and that vector. make_cohort_scores builds the matrix once for every registered index and keeps each patient's
+    scores, keyed by patient id, until a patient is modified, so they outlive patients evicted from a PatientStore.
+
+    Further indices, e.g. Charlson, plug in with register_comorbidity_index once their categories are mapped in
+    icd_code_to_category.
+'''
+from collections import OrderedDict
+import numpy
+import memoization
+from icd_code_to_category import make_diagnosis_categories
+
+class ComorbidityIndex:
+
+    '''
+        Scores a patient as the sum of the points of their diagnosis categories, or as missing_score if that is below
+        minimum_score, e.g. when a category is -9999.
+    '''
+    def __init__(self, name, category_to_points, minimum_score=0, missing_score=-9999):
+        self.name = name
+        self.categories = list(category_to_points.keys())
+        self.points = numpy.array(list(category_to_points.values()), dtype=numpy.int64)
+        self.minimum_score = minimum_score
+        self.missing_score = missing_score
+
+    def score_matrix(self, diagnosis_matrix):
+
+        '''
+            The score of each row of diagnosis_matrix, whose columns are self.categories.
+        '''
+        scores = diagnosis_matrix.dot(self.points)
+        return numpy.where(scores >= self.minimum_score, scores, self.missing_score)
+
+    def score(self, diagnoses):
+        score = sum([ diagnoses[category] * int(points) for category, points in zip(self.categories, self.points) ])
+        return score if score >= self.minimum_score else self.missing_score
+
+
+comorbidity_indices = OrderedDict()
+
+def register_comorbidity_index(index):
+    unknown_categories = set(index.categories) - set(make_diagnosis_categories())
+    if unknown_categories:
+        raise ValueError('%s counts unknown diagnosis categories: %s' % (index.name, ', '.join(sorted(unknown_categories))))
+    comorbidity_indices[index.name] = index
+    return index
+
+
+'''
+    Scoring from paper:
+    A Modification of the Elixhauser Comorbidity Measures Into a Point System for Hospital Death Using Administrative Data
+    Carl van Walraven, Peter C. Austin, Alison Jennings, Hude Quan, and Alan J. Forster
+'''
+elixhauser_walraven = register_comorbidity_index(ComorbidityIndex('elixhauser_walraven', OrderedDict([
+    ('congestive_heart_failure', 7),
+    ('cardiac_arrhythmia', 5),
+    ('valvular_disease', -1),
+    ('pulmonary_circulation_disorder', 4),
+    ('peripheral_vascular_disorder', 2),
+    ('hypertension_uncomplicated', 0),
+    ('hypertension_complicated', 0),
+    ('paralysis', 7),
+    ('other_neurological_disorder', 6),
+    ('chronic_pulmonary_disease', 3),
+    ('diabetes_uncomplicated', 0),
+    ('diabetes_complicated', 0),
+    ('hypothyroidism', 0),
+    ('renal_failure', 5),
+    ('liver_disease', 11),
+    ('peptic_ulcer_disease_excluding_bleeding', 0),
+    ('aids_hiv', 0),
+    ('lymphoma', 9),
+    ('metastatic_cancer', 12),
+    ('solid_tumor_wo_metastasis', 4),
+    ('rheumatoid_arhritis', 0),
+    ('coagulopathy', 3),
+    ('obesity', -4),
+    ('weight_loss', 6),
+    ('fluid_and_electrolyte_disorders', 5),
+    ('blood_loss_anemia', -2),
+    ('deficiency_anemia', -2),
+    ('alcohol_abuse', 0),
+    ('drug_abuse', -7),
+    ('psychoses', 0),
+    ('depression', -3),
+])))
+
+
+class CohortScores:
+
+    '''
+        The score of each patient for each index, as computed at generation.
+    '''
+    def __init__(self):
+        self.generation = None
+        self.patient_rows = {}
+        self.index_to_scores = {}
+
+    def compute(self, patients, indices):
+        categories = list(OrderedDict.fromkeys([ category for index in indices for category in index.categories ]))
+        patient_ids = []
+        diagnosis_matrix = numpy.empty((len(patients), len(categories)), dtype=numpy.int64)
+        for row, (patient_id, patient) in enumerate(patients.items()):
+            patient_ids.append(patient_id)
+            diagnosis_matrix[row] = [ patient.diagnoses[category] for category in categories ]
+
+        category_columns = dict([ (category, column) for column, category in enumerate(categories) ])
+        self.index_to_scores = {}
+        for index in indices:
+            self.index_to_scores[index.name] = index.score_matrix(diagnosis_matrix[:, [ category_columns[category] for category in index.categories ]])
+        self.patient_rows = dict([ (patient_id, row) for row, patient_id in enumerate(patient_ids) ])
+        self.generation = memoization.generation
+
+    def get_score(self, patient_id, index_name):
+
+        '''
+            The cached score, or None if the patient or index was not scored or anything changed since.
+        '''
+        if self.generation != memoization.generation or index_name not in self.index_to_scores:
+            return None
+        row = self.patient_rows.get(patient_id)
+        return None if row is None else int(self.index_to_scores[index_name][row])
+
+
+cohort_scores = CohortScores()
+
+def make_cohort_scores(patients, indices=None):
+
+    '''
+        Scores every patient of patients, a dict or PatientStore of patient id to Patient, on indices, by default every
+        registered index. Patients look up their scores with get_comorbidity_score.
+    '''
+    cohort_scores.compute(patients, list(indices or comorbidity_indices.values()))
+
+
+def get_comorbidity_score(patient, index_name):
+    score = cohort_scores.get_score(patient.id, index_name)
+    return score if score is not None else comorbidity_indices[index_name].score(patient.diagnoses)
@@ -1,24 +1,38 @@
-import os, pydotplus
+import os, threading
 from sklearn.model_selection import LeaveOneOut
 from sklearn.model_selection import KFold
 from sklearn.tree import DecisionTreeClassifier
-from sklearn.metrics import accuracy_score, roc_curve, auc
+from sklearn.metrics import accuracy_score
 from sklearn.externals.six import StringIO
 from sklearn.tree import export_graphviz
 from progress.bar import Bar
 from multiprocessing.dummy import Pool as ThreadPool
 from HospitalizationEpisode import get_bipolar_episodes
+from instrumentation import stage, print_stage_summary, write_run_report
 from sklearn.preprocessing import Imputer
+from numpy import arange
+import numpy
+from explanations import explain_predictions
+from evaluation import evaluate, compute_roc, bootstrap_intervals, make_operating_point_table, write_operating_point_table
+from feature_matrix import FeatureMatrix, build_feature_matrix, layouts
+from model_cache import ModelCache, make_data_key
 import matplotlib.pyplot as plt
 import argparse
 
 predictors_labeled = predictors = outcomes = care_episode_index_results = None
 
+# Set to a ModelCache, with the data_key of predictors and outcomes, to cache fitted trees.
+model_cache = data_key = None
+
 class IndexResult:
     def __init__(self, index):
         self.index = index
         self.result = None
 
+        # Set by --explain: the out-of-fold probability and the rules of the tree path that scored the episode.
+        self.probability = None
+        self.explanation = None
+
 def make_decision_tree_classifier(balancing, seed, max_leaf_nodes):
     return DecisionTreeClassifier(
 
@@ -34,117 +48,203 @@ def make_decision_tree_classifier(balancing, seed, max_leaf_nodes):
         max_leaf_nodes=max_leaf_nodes
     )
 
-true_positives = []
-false_positives = []
-true_negatives = []
-false_negatives = []
+def fit_and_evaluate_fold(predictors, outcomes, train_index, test_index, balancing, seed, max_leaf_nodes, model_cache=None, data_key=None):
+
+    '''
+        Fits a tree on the train rows and evaluates it on the test rows. Returns the fitted tree, and the test
+        outcomes, predictions and predicted probabilities of the positive class. If model_cache is given, the result
+        is loaded from it when the same fit was cached before, where data_key is make_data_key(predictors, outcomes).
+    '''
+    def fit_and_evaluate():
+        decision_tree = make_decision_tree_classifier(balancing, seed, max_leaf_nodes)
+        decision_tree.fit(predictors[train_index], outcomes[train_index])
+        if len(test_index) == 0:
+            return { 'decision_tree': decision_tree, 'outcomes': [], 'predictions': [], 'probabilities': [] }
+
+        predictors_test = predictors[test_index]
+        return {
+            'decision_tree': decision_tree,
+            'outcomes': outcomes[test_index],
+            'predictions': decision_tree.predict(predictors_test),
+            'probabilities': decision_tree.predict_proba(predictors_test)[:,1].tolist(),
+        }
+
+    if model_cache is None:
+        return fit_and_evaluate()
+    parameters = { 'balancing': balancing, 'seed': seed, 'max_leaf_nodes': max_leaf_nodes }
+    return model_cache.get_or_compute(model_cache.make_key(data_key, train_index, test_index, parameters), fit_and_evaluate)
+
+
+def classify_predictions(outcomes, predictions):
+    outcomes = numpy.asarray(outcomes) == 1
+    predictions = numpy.asarray(predictions) == 1
+    return numpy.where(outcomes,
+        numpy.where(predictions, 'true positive', 'false negative'),
+        numpy.where(predictions, 'false positive', 'true negative'))
+
+
+def concatenate_folds(fold_results):
+
+    '''
+        The out-of-fold outcomes, probabilities and predictions of every fold, as arrays for the evaluation module.
+    '''
+    if not fold_results:
+        return numpy.array([]), numpy.array([]), numpy.array([])
+    return tuple([ numpy.concatenate([ numpy.asarray(fold_result[name], dtype=float) for fold_result in fold_results ]) for name in [ 'outcomes', 'probabilities', 'predictions' ] ])
+
+
+def summarize_folds(fold_results):
+
+    '''
+        Combines the results of fit_and_evaluate_fold over every fold into counts, rates and the ROC AUC.
+    '''
+    return evaluate(*concatenate_folds(fold_results))
+
 outcome_values = []
+prediction_values = []
 probabilities = []
 def compute_metrics(run):
-    predictors_train, predictors_test = predictors[run['train_index']], predictors[run['test_index']]
-    outcomes_train, outcomes_test = outcomes[run['train_index']], outcomes[run['test_index']]
+    fold_result = fit_and_evaluate_fold(predictors, outcomes, run['train_index'], run['test_index'], run['balancing'], run['seed'], run['max_leaf_nodes'], model_cache, data_key)
+
     if care_episode_index_results:
-        index_results = [ care_episode_index_results[index] for index in run['test_index'] ]
-
-    decision_tree = make_decision_tree_classifier(run['balancing'], run['seed'], run['max_leaf_nodes'])
-    decision_tree.fit(predictors_train, outcomes_train)
-    predictions = decision_tree.predict(predictors_test)
-
-    # Compute accuracy.
-    for index, outcome in enumerate(outcomes_test):
-        if outcome == 1:
-            if predictions[index] == 1:
-                true_positives.append(True)
-                result = 'true positive'
-            else:
-                false_negatives.append(True)
-                result = 'false negative'
-        else:
-            if predictions[index] == 1:
-                false_positives.append(True)
-                result = 'false positive'
-            else:
-                true_negatives.append(True)
-                result = 'true negative'
-
-        if index_results:
-            index_results[index].result = result
-
-    outcome_values.extend(outcomes_test)
-    probabilities.extend(decision_tree.predict_proba(predictors_test)[:,1].tolist())
+        for index, result in zip(run['test_index'], classify_predictions(fold_result['outcomes'], fold_result['predictions'])):
+            care_episode_index_results[index].result = str(result)
+
+        if run.get('explain'):
+            explained = explain_predictions(fold_result['decision_tree'], predictors[run['test_index']], get_predictor_names())
+            for index, probability, explanation in zip(run['test_index'], explained['probabilities'], explained['explanations']):
+                care_episode_index_results[index].probability = probability
+                care_episode_index_results[index].explanation = explanation
+    return fold_result
+
+def get_predictor_names():
+
+    # A FeatureMatrix drops predictors with no known values, so its column names are the ones the trees see.
+    if isinstance(predictors, FeatureMatrix):
+        return predictors.column_names
+    return list(predictors_labeled[0].keys())
 
 # generalizing to x fold CV
 def run_cross_validation(command_args, tree_filename):
     print('Initializing ', command_args['cv_fold'], ' fold cross validation')
-    loo = KFold(n_splits=command_args['cv_fold'], shuffle=True, random_state=command_args['random_seed']) # n_splits equal to data dimension is equivalent to LOO, command_args['random_seed']
-    runs = []
-    for train_index, test_index in loo.split(predictors):
-        runs.append({
-            'train_index': train_index,
-            'test_index': test_index,
-            'max_leaf_nodes': command_args['max_leaf_nodes'],
-            'balancing': command_args['balancing'],
-            'seed': command_args['random_seed']
-        })
-
-    # Multi-thread computation of classifier metrics.
-    pool = ThreadPool(10)
-    bar = Bar('Computing metrics', max=command_args['cv_fold'])
-    for i in pool.imap(compute_metrics, runs):
-        bar.next()
-    bar.finish()
+    with stage('Cross validation split', rows=len(predictors)):
+        loo = KFold(n_splits=command_args['cv_fold'], shuffle=True, random_state=command_args['random_seed']) # n_splits equal to data dimension is equivalent to LOO, command_args['random_seed']
+        runs = []
+        for train_index, test_index in loo.split(predictors):
+            runs.append({
+                'train_index': train_index,
+                'test_index': test_index,
+                'max_leaf_nodes': command_args['max_leaf_nodes'],
+                'balancing': command_args['balancing'],
+                'seed': command_args['random_seed'],
+                'explain': command_args.get('explain'),
+            })
+
+    # Multi-thread computation of classifier metrics. Results are gathered here, in fold order, so the outcomes,
+    # predictions and probabilities stay aligned.
+    with stage('Cross validation fits', rows=len(predictors) * command_args['cv_fold']):
+        pool = ThreadPool(10)
+        bar = Bar('Computing metrics', max=command_args['cv_fold'])
+        for fold_result in pool.imap(compute_metrics, runs):
+            outcome_values.extend(fold_result['outcomes'])
+            prediction_values.extend(fold_result['predictions'])
+            probabilities.extend(fold_result['probabilities'])
+            bar.next()
+        bar.finish()
 
     # Compute metrics.
-    sensitivity = 100.0 * len(true_positives) / (len(true_positives) + len(false_negatives))
-    specificity = 100.0 * len(true_negatives) / (len(true_negatives) + len(false_positives))
-    positive_predictive_value = 100.0 * len(true_positives) / (len(true_positives) + len(false_positives))
-    negative_predictive_value = 100.0 * len(true_negatives) / (len(true_negatives) + len(false_negatives))
-    accuracy = float(len(true_positives) + len(true_negatives)) / (len(true_positives) + len(true_negatives) + len(false_positives) + len(false_negatives))
-    print('true_positives:', len(true_positives))
-    print('false_negatives:', len(false_negatives))
-    print('true_negatives:', len(true_negatives))
-    print('false_positives:', len(false_positives))
-    print('sensitivity:', sensitivity)
-    print('specificity:', specificity)
-    print('ppv:', positive_predictive_value)
-    print('npv:', negative_predictive_value)
-    print('accuracy:', accuracy)
+    metrics = evaluate(outcome_values, probabilities, prediction_values)
+    for name in [ 'true_positives', 'false_negatives', 'true_negatives', 'false_positives', 'sensitivity', 'specificity', 'ppv', 'npv', 'accuracy' ]:
+        print('%s:' % name, metrics[name])
+
+    if command_args.get('bootstrap_resamples'):
+        with stage('Bootstrap confidence intervals', rows=len(outcome_values) * command_args['bootstrap_resamples']):
+            metrics['intervals'] = bootstrap_intervals(outcome_values, probabilities, prediction_values, command_args['bootstrap_resamples'], command_args['random_seed'])
+        for name, (lower, upper) in metrics['intervals'].items():
+            print('%s 95%% CI: %f - %f' % (name, lower, upper))
+
+    if command_args.get('operating_points'):
+        write_operating_point_table(tree_filename + '_operating_points.csv', make_operating_point_table(outcome_values, probabilities))
 
     # Make AUC.
-    false_positive_rate, true_positive_rate, _ = roc_curve(outcome_values, probabilities)
-    roc_auc = auc(false_positive_rate, true_positive_rate)
-    f = plt.figure()
-    lw = 2
-    plt.plot(false_positive_rate, true_positive_rate, color='darkorange',
-             lw=lw, label='ROC curve (area = %0.2f)' % roc_auc)
-    plt.plot([0, 1], [0, 1], color='navy', lw=lw, linestyle='--')
-    plt.xlim([0.0, 1.0])
-    plt.ylim([0.0, 1.05])
-    plt.xlabel('False Positive Rate')
-    plt.ylabel('True Positive Rate')
-    plt.title('Receiver operating characteristic example')
-    plt.legend(loc="lower right")
-    f.savefig(tree_filename + '.pdf', bbox_inches='tight')
+    with stage('ROC curve', rows=len(outcome_values)):
+        false_positive_rate, true_positive_rate, _ = compute_roc(outcome_values, probabilities)
+        roc_auc = metrics['auc']
+        f = plt.figure()
+        lw = 2
+        plt.plot(false_positive_rate, true_positive_rate, color='darkorange',
+                 lw=lw, label='ROC curve (area = %0.2f)' % roc_auc)
+        plt.plot([0, 1], [0, 1], color='navy', lw=lw, linestyle='--')
+        plt.xlim([0.0, 1.0])
+        plt.ylim([0.0, 1.05])
+        plt.xlabel('False Positive Rate')
+        plt.ylabel('True Positive Rate')
+        plt.title('Receiver operating characteristic example')
+        plt.legend(loc="lower right")
+        f.savefig(tree_filename + '.pdf', bbox_inches='tight')
+
+    return metrics
+
+def render_picture(dot_data, picture_filepath):
+
+    # pydotplus and the Graphviz binaries it runs are only needed for the PNG. A failure leaves the .dot file for later.
+    try:
+        import pydotplus
+        graph = pydotplus.graph_from_dot_data(dot_data)
+        graph.write_png(picture_filepath)
+    except Exception as error:
+        print('Could not render %s: %s' % (picture_filepath, error))
 
 def make_decision_tree_picture(command_args, tree_filename):
-    decision_tree = make_decision_tree_classifier(command_args['balancing'], command_args['random_seed'], command_args['max_leaf_nodes'])
-    decision_tree.fit(predictors, outcomes)
+
+    '''
+        Fits a tree on all of the data and writes it as a Graphviz .dot file. If command_args['picture'] is 'png', it
+        is also rendered as a PNG by a background thread, which is returned so the caller can wait for it.
+    '''
+    fit = fit_and_evaluate_fold(predictors, outcomes, arange(len(predictors)), arange(0), command_args['balancing'], command_args['random_seed'], command_args['max_leaf_nodes'], model_cache, data_key)
     dot_data = StringIO()
-    export_graphviz(decision_tree, out_file=dot_data,
+    export_graphviz(fit['decision_tree'], out_file=dot_data,
                     filled=True, rounded=True,
                     special_characters=True,
-                    feature_names=list(predictors_labeled[0].keys()),
+                    feature_names=get_predictor_names(),
                     class_names=['no', 'yes'],
                     impurity=False,
                     proportion=True)
-    graph = pydotplus.graph_from_dot_data(dot_data.getvalue())
-    graph.write_png(tree_filename + '.png')
+    with open(tree_filename + '.dot', 'w') as dot_file:
+        dot_file.write(dot_data.getvalue())
+
+    if command_args['picture'] != 'png':
+        return None
+    renderer = threading.Thread(target=render_picture, args=(dot_data.getvalue(), tree_filename + '.png'))
+    renderer.start()
+    return renderer
+
+def parse_command_args():
+    parser = argparse.ArgumentParser(description='Compute rehospitalization classification')
+    parser.add_argument('--cv_fold', default = 10, type=int, help='specifies fold number for cross-validation')
+    parser.add_argument('--balancing', default = "balanced", help='specifies the tree class_weight')
+    parser.add_argument('--random_seed', default = 314, type=int, help='randomization seed')
+    parser.add_argument('--max_leaf_nodes', default = 16, type=int, help='max # of leaf nodes')
+    parser.add_argument('--predictor_layout', default='compact', choices=['dense'] + layouts, help='dense float64 predictors, or a compact FeatureMatrix (see feature_matrix)')
+    parser.add_argument('--picture', default='png', choices=['png', 'dot', 'none'], help='draw the tree as a PNG (rendered in the background) or only a Graphviz .dot file, or not at all')
+    parser.add_argument('--bootstrap_resamples', default=0, type=int, help='bootstrap resamples for 95%% confidence intervals of the metrics, or 0 for none')
+    parser.add_argument('--operating_points', action='store_true', help='write the counts and rates at every threshold to <tree>_operating_points.csv')
+    parser.add_argument('--explain', action='store_true', help='record the out-of-fold probability and tree rules of each care episode with its result')
+    parser.add_argument('--model_cache', help='directory caching fitted trees and fold predictions, so reruns with the same data and parameters skip the fits')
+    return vars(parser.parse_args())
 
 def make_decision_tree_fit_statistics_and_picture(file_prefix, _predictors_labeled, _predictors, _outcomes, care_episode_indices=None):
+
+    '''
+        _predictors is the dense array of the episode getters, or the FeatureMatrix they build when given the
+        --predictor_layout of parse_command_args(), which is then used as is.
+    '''
     global predictors_labeled
     global predictors
     global outcomes
     global care_episode_index_results
+    global model_cache
+    global data_key
 
     predictors_labeled = _predictors_labeled
     predictors = _predictors
@@ -153,20 +253,37 @@ def make_decision_tree_fit_statistics_and_picture(file_prefix, _predictors_label
     if care_episode_indices:
         care_episode_index_results = [ IndexResult(index) for index in care_episode_indices ]
 
-    parser = argparse.ArgumentParser(description='Compute rehospitalization classification')
-    parser.add_argument('--cv_fold', default = 10, type=int, help='specifies fold number for cross-validation')
-    parser.add_argument('--balancing', default = "balanced", help='specifies the tree class_weight')
-    parser.add_argument('--random_seed', default = 314, type=int, help='randomization seed')
-    parser.add_argument('--max_leaf_nodes', default = 16, type=int, help='max # of leaf nodes')
+    command_args = parse_command_args()
+    if isinstance(predictors, FeatureMatrix) and predictors.layout != command_args['predictor_layout']:
+        raise ValueError('The predictors were built with the %s layout, not --predictor_layout %s' % (predictors.layout, command_args['predictor_layout']))
 
     # Fill missing data with median of that type of data.
-    imputer = Imputer(strategy='median')
-    predictors = imputer.fit_transform(predictors)
+    with stage('Impute missing predictors', rows=len(predictors)):
+        if command_args['predictor_layout'] == 'dense':
+            imputer = Imputer(strategy='median')
+            predictors = imputer.fit_transform(predictors)
+        elif not isinstance(predictors, FeatureMatrix):
+            predictors = build_feature_matrix(predictors_labeled, command_args['predictor_layout'])
 
-    command_args = vars(parser.parse_args())
+    if command_args['model_cache']:
+        model_cache = ModelCache(command_args['model_cache'])
+        with stage('Hash predictors', rows=len(predictors)):
+            data_key = make_data_key(predictors, outcomes)
 
     tree_filename = 'tree_%s_seed_%d_max_leaf_nodes_%d_balancing_%s' % (file_prefix, command_args['random_seed'], command_args['max_leaf_nodes'], command_args['balancing'])
-    make_decision_tree_picture(command_args, tree_filename)
+    renderer = None
+    if command_args['picture'] != 'none':
+        with stage('Decision tree picture', rows=len(predictors)):
+            renderer = make_decision_tree_picture(command_args, tree_filename)
     run_cross_validation(command_args, tree_filename)
+    if renderer:
+        with stage('Wait for picture rendering'):
+            renderer.join()
+
+    print_stage_summary()
+    run_information = { 'command_args': command_args }
+    if model_cache:
+        run_information['model_cache'] = model_cache.get_statistics()
+    write_run_report(tree_filename + '_run_report.json', **run_information)
 
     return care_episode_index_results
\ No newline at end of file
@@ -0,0 +1,155 @@
+'''
+    Reads gzip (.gz) or zstd (.zst) compressed files, or a directory of parts, as one stream. Each file is decompressed
+    by its own background thread, with up to parallel_parts files decompressing ahead of the reader at once, so
+    decompression runs alongside CSV parsing and, for parts, in parallel. zlib and zstd release the GIL while they work.
+'''
+import gzip
+import io
+import os
+import queue
+import threading
+from collections import deque
+from os import path
+from pipelined_io import put_unless_stopped, end_of_iterable, BackgroundError
+
+chunk_bytes = 1024 * 1024
+
+def open_zstd(filepath):
+
+    # zstandard is optional, so it is only needed when reading .zst files.
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True)
+
+
+compressed_extension_to_opener = {
+    '.gz': gzip.open,
+    '.zst': open_zstd,
+}
+compressed_extensions = list(compressed_extension_to_opener.keys())
+
+def open_binary(filepath):
+    for extension, opener in compressed_extension_to_opener.items():
+        if filepath.endswith(extension):
+            return opener(filepath)
+    return open(filepath, 'rb')
+
+
+def find_part_filepaths(directory):
+
+    # Parts are read in name order, e.g. part-00000.csv.gz, part-00001.csv.gz. Other files, such as _SUCCESS, are skipped.
+    part_extensions = tuple([ '.csv' ] + [ '.csv' + extension for extension in compressed_extensions ])
+    return [ path.join(directory, filename) for filename in sorted(os.listdir(directory)) if filename.endswith(part_extensions) ]
+
+
+class PartReader:
+    def __init__(self, filepath, chunks_ahead):
+        self.filepath = filepath
+        self.chunks = queue.Queue(maxsize=chunks_ahead)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        try:
+            with open_binary(self.filepath) as input_file:
+                while True:
+                    chunk = input_file.read(chunk_bytes)
+                    if not chunk:
+                        break
+                    if not put_unless_stopped(self.chunks, chunk, self.stop):
+                        return
+            put_unless_stopped(self.chunks, end_of_iterable, self.stop)
+        except BaseException as error:
+            put_unless_stopped(self.chunks, BackgroundError(error), self.stop)
+
+    def get(self):
+        chunk = self.chunks.get()
+        if isinstance(chunk, BackgroundError):
+            raise chunk.error
+        return chunk
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+class DecompressedStream(io.RawIOBase):
+
+    '''
+        The concatenated contents of filepaths. Every part after the first drops its first line if it repeats the first
+        part's header line, so parts that each have a CSV header read as one CSV file.
+    '''
+    def __init__(self, filepaths, parallel_parts=4, chunks_ahead=16):
+        self.filepaths = deque(filepaths)
+        self.parallel_parts = max(1, parallel_parts)
+        self.chunks_ahead = chunks_ahead
+        self.readers = deque()
+        self.header = None
+        self.is_part_start = True
+        self.last_byte = b''
+        self.buffer = memoryview(b'')
+        self.start_readers()
+
+    def start_readers(self):
+        while self.filepaths and len(self.readers) < self.parallel_parts:
+            self.readers.append(PartReader(self.filepaths.popleft(), self.chunks_ahead))
+
+    def readable(self):
+        return True
+
+    def read_part_start(self, reader):
+
+        # Read up to the end of the first line, or the end of the part.
+        start = b''
+        while b'\n' not in start:
+            chunk = reader.get()
+            if chunk is end_of_iterable:
+                return start, True
+            start += chunk
+        return start, False
+
+    def fill_buffer(self):
+        while not self.buffer and self.readers:
+            reader = self.readers[0]
+            is_part_end = False
+            if self.is_part_start:
+                chunk, is_part_end = self.read_part_start(reader)
+                first_line = chunk[:chunk.find(b'\n') + 1] if b'\n' in chunk else chunk
+                if self.header is None:
+                    self.header = first_line or None
+                elif first_line == self.header:
+                    chunk = chunk[len(first_line):]
+                self.is_part_start = False
+                self.last_byte = b''
+            else:
+                chunk = reader.get()
+                if chunk is end_of_iterable:
+                    chunk, is_part_end = b'', True
+
+            if chunk:
+                self.last_byte = chunk[-1:]
+            if is_part_end:
+                self.readers.popleft().close()
+                self.start_readers()
+                self.is_part_start = True
+
+                # Keep the last line of a part without a trailing newline from running into the next part.
+                if self.readers and self.last_byte not in (b'', b'\n'):
+                    chunk += b'\n'
+            self.buffer = memoryview(chunk)
+
+    def readinto(self, output):
+        self.fill_buffer()
+        length = min(len(output), len(self.buffer))
+        output[:length] = self.buffer[:length]
+        self.buffer = self.buffer[length:]
+        return length
+
+    def close(self):
+        while self.readers:
+            self.readers.popleft().close()
+        super().close()
+
+
+def open_text(filepaths, encoding, parallel_parts=4):
+    return io.TextIOWrapper(io.BufferedReader(DecompressedStream(filepaths, parallel_parts), buffer_size=chunk_bytes), encoding=encoding)
@@ -0,0 +1,186 @@
+'''
+    A SQLite file holding the analyzable files as tables, named like the files, e.g. analyzable_care_episodes_365days,
+    and indexed on the columns cohorts are usually pulled by: the patient, the episode date, whether the episode is a
+    psychiatric hospitalization and the outcomes. make_analyzable_care_episodes.py fills it with --episode_store, and
+    query pulls a filtered subset of columns as NumPy arrays, so a cohort is read from the indexes instead of by
+    loading a whole file, e.g.
+
+        with EpisodeStore('episodes.sqlite') as store:
+            episodes = store.query('analyzable_care_episodes_365days', [ 'PatientID', 'CareEpisodeDate', 'Charges' ], [
+                ('CareEpisodeDate', 'between', ('2012-01-01', '2012-12-31')),
+                ('is_psychiatric_hospitalization', '=', 1),
+                ('is_transfer_psychiatric', '=', 1),
+            ])
+
+    Values are stored as the CSV files write them, so missing values are -9999 and dates are YYYY-MM-DD strings.
+'''
+import json
+import sqlite3
+from collections import OrderedDict
+import numpy
+from output_sinks import Sink
+
+indexed_column_names = [
+    'PatientID', 'CareEpisodeDate', 'is_psychiatric_hospitalization',
+    'is_30_day_psychiatric_rehospitalization', 'is_30_day_rehospitalization',
+    'is_rehospitalized_for_suicide_attempt', 'is_rehospitalized_for_suicidal_ideation',
+    'is_rehospitalized_for_suicidal_attempt_broad', 'is_rehospitalized_for_cdc_suicide_self_injury',
+]
+
+# Column types as in output_sinks.ColumnarSink. Anything not in column_types is an 'int'.
+sqlite_types = {
+    'string': 'TEXT',
+    'float': 'REAL',
+    'int': 'INTEGER',
+    'indicator': 'INTEGER',
+}
+
+# Indicators are 0, 1 or -9999, which needs 16 bits.
+numpy_types = {
+    'string': object,
+    'float': numpy.float64,
+    'int': numpy.int64,
+    'indicator': numpy.int16,
+}
+
+filter_operators = ['=', '!=', '<', '<=', '>', '>=', 'in', 'between']
+
+def quote_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class EpisodeTableSink(Sink):
+
+    '''
+        Writes rows to a table of the store, replacing any table of that name, in batches of rows_per_batch rows.
+        The indexes are built once every row is written, which is faster than updating them row by row.
+    '''
+    def __init__(self, store, table_name, column_names, column_types=None, rows_per_batch=10000):
+        self.store = store
+        self.table_name = table_name
+        self.column_names = list(column_names)
+        self.rows_per_batch = rows_per_batch
+        column_types = column_types or {}
+        self.column_types = [ column_types.get(name, 'int') for name in self.column_names ]
+
+        connection = store.connection
+        connection.execute('DROP TABLE IF EXISTS %s' % quote_name(table_name))
+        connection.execute('CREATE TABLE %s (%s)' % (quote_name(table_name),
+            ', '.join([ '%s %s' % (quote_name(name), sqlite_types[column_type]) for name, column_type in zip(self.column_names, self.column_types) ])))
+        connection.execute('DELETE FROM episode_store_columns WHERE table_name = ?', (table_name,))
+        connection.executemany('INSERT INTO episode_store_columns VALUES (?, ?, ?, ?)',
+            [ (table_name, position, name, column_type) for position, (name, column_type) in enumerate(zip(self.column_names, self.column_types)) ])
+        self.insert = 'INSERT INTO %s VALUES (%s)' % (quote_name(table_name), ', '.join([ '?' ] * len(self.column_names)))
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(tuple([ row[name] for name in self.column_names ]))
+        if len(self.rows) >= self.rows_per_batch:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.store.connection.executemany(self.insert, self.rows)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        connection = self.store.connection
+        for name in indexed_column_names:
+            if name in self.column_names:
+                connection.execute('CREATE INDEX %s ON %s (%s)' % (quote_name('%s_%s' % (self.table_name, name)), quote_name(self.table_name), quote_name(name)))
+
+        # Gives the query planner the selectivity of each index, e.g. that an outcome of 1 is rare.
+        connection.execute('ANALYZE %s' % quote_name(self.table_name))
+        connection.commit()
+
+
+class EpisodeStore:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS episode_store_columns (table_name TEXT, position INTEGER, column_name TEXT, column_type TEXT)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def make_sink(self, table_name, column_names, column_types=None):
+        return EpisodeTableSink(self, table_name, column_names, column_types)
+
+    def get_table_names(self):
+        return [ table_name for table_name, in self.connection.execute('SELECT DISTINCT table_name FROM episode_store_columns ORDER BY table_name') ]
+
+    def get_column_types(self, table_name):
+
+        '''
+            An OrderedDict of the table's column names to their types.
+        '''
+        column_types = OrderedDict(self.connection.execute('SELECT column_name, column_type FROM episode_store_columns WHERE table_name = ? ORDER BY position', (table_name,)))
+        if not column_types:
+            raise KeyError('No table %s in %s' % (table_name, self.filepath))
+        return column_types
+
+    def make_query(self, table_name, column_names=None, filters=None, order_by=None):
+        column_types = self.get_column_types(table_name)
+        column_names = list(column_types) if column_names is None else list(column_names)
+        for name in column_names + [ name for name, _, _ in filters or [] ] + list(order_by or []):
+            if name not in column_types:
+                raise KeyError('No column %s in %s' % (name, table_name))
+
+        conditions = []
+        parameters = []
+        for name, operator, value in filters or []:
+            if operator not in filter_operators:
+                raise ValueError('Unknown filter operator %s, expected one of %s' % (operator, ', '.join(filter_operators)))
+            if operator == 'in':
+
+                # The values are passed as one JSON array, so a cohort of any number of patients is a single parameter.
+                conditions.append('%s IN (SELECT value FROM json_each(?))' % quote_name(name))
+                parameters.append(json.dumps(numpy.asarray(value).tolist()))
+            elif operator == 'between':
+                conditions.append('%s BETWEEN ? AND ?' % quote_name(name))
+                parameters.extend(value)
+            else:
+                conditions.append('%s %s ?' % (quote_name(name), operator))
+                parameters.append(value)
+
+        sql = 'SELECT %s FROM %s' % (', '.join([ quote_name(name) for name in column_names ]), quote_name(table_name))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        if order_by:
+            sql += ' ORDER BY ' + ', '.join([ quote_name(name) for name in order_by ])
+        return sql, parameters, [ (name, numpy_types[column_types[name]]) for name in column_names ]
+
+    def query_batches(self, table_name, column_names=None, filters=None, order_by=None, rows_per_batch=65536):
+
+        '''
+            Yields the rows of query in batches of at most rows_per_batch rows, each an OrderedDict of column name to
+            array, so a large pull is converted a batch at a time.
+        '''
+        sql, parameters, column_dtypes = self.make_query(table_name, column_names, filters, order_by)
+        cursor = self.connection.execute(sql, parameters)
+        while True:
+            rows = cursor.fetchmany(rows_per_batch)
+            if not rows:
+                break
+            yield OrderedDict([ (name, numpy.array(values, dtype=dtype)) for (name, dtype), values in zip(column_dtypes, zip(*rows)) ])
+
+    def query(self, table_name, column_names=None, filters=None, order_by=None):
+
+        '''
+            Returns an OrderedDict of each of column_names, by default every column, to an array of its values in the
+            rows matching every filter. A filter is (column name, operator, value), where the operator is one of
+            filter_operators, the value of 'in' is a sequence and the value of 'between' is (low, high), inclusive.
+        '''
+        batches = list(self.query_batches(table_name, column_names, filters, order_by))
+        if not batches:
+            _, _, column_dtypes = self.make_query(table_name, column_names, filters, order_by)
+            return OrderedDict([ (name, numpy.array([], dtype=dtype)) for name, dtype in column_dtypes ])
+        return OrderedDict([ (name, numpy.concatenate([ batch[name] for batch in batches ])) for name in batches[0] ])
@@ -0,0 +1,214 @@
+'''
+    Evaluates out-of-fold predictions held in NumPy arrays: confusion counts, sensitivity, specificity, PPV, NPV and
+    accuracy, the ROC curve and AUC, a table of operating points, and bootstrap confidence intervals for them.
+
+    Rates are percentages and accuracy is a fraction, as run_cross_validation has always printed them. The AUC is the
+    probability that a positive outranks a negative, counting ties as half, which is the area under the ROC curve.
+    A bootstrap resample is counted into the number of rows drawn in each confusion cell at each distinct score, so the
+    metrics of a batch of resamples are a few array operations on those counts. Batches are spread across a process
+    pool, and each batch draws from its own seeded random state, so the intervals depend on the seed but not on the
+    number of processes.
+'''
+import csv
+import os
+from multiprocessing import Pool
+import numpy
+
+rate_names = ['sensitivity', 'specificity', 'ppv', 'npv', 'accuracy']
+interval_metric_names = rate_names + ['auc']
+
+def as_arrays(labels, scores):
+    return numpy.asarray(labels, dtype=float) == 1, numpy.asarray(scores, dtype=float)
+
+
+def count_confusion(labels, predictions):
+    is_positive, is_predicted_positive = as_arrays(labels, predictions)
+    is_predicted_positive = is_predicted_positive == 1
+    return {
+        'true_positives': int(numpy.count_nonzero(is_positive & is_predicted_positive)),
+        'false_negatives': int(numpy.count_nonzero(is_positive & ~is_predicted_positive)),
+        'true_negatives': int(numpy.count_nonzero(~is_positive & ~is_predicted_positive)),
+        'false_positives': int(numpy.count_nonzero(~is_positive & is_predicted_positive)),
+    }
+
+
+def divide(numerator, denominator, scale=1.0):
+
+    # Rates of an empty group, e.g. the PPV when nothing is predicted positive, are NaN.
+    numerator = numpy.asarray(numerator, dtype=float)
+    denominator = numpy.asarray(denominator, dtype=float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(denominator > 0, scale * numerator / numpy.where(denominator > 0, denominator, 1), numpy.nan)
+
+
+def compute_rates(true_positives, false_negatives, true_negatives, false_positives):
+
+    '''
+        Works on counts, or on arrays of counts, e.g. one per bootstrap resample.
+    '''
+    return {
+        'sensitivity': divide(true_positives, true_positives + false_negatives, 100.0),
+        'specificity': divide(true_negatives, true_negatives + false_positives, 100.0),
+        'ppv': divide(true_positives, true_positives + false_positives, 100.0),
+        'npv': divide(true_negatives, true_negatives + false_negatives, 100.0),
+        'accuracy': divide(true_positives + true_negatives, true_positives + false_negatives + true_negatives + false_positives),
+    }
+
+
+def count_by_threshold(labels, scores):
+
+    '''
+        Returns, for each distinct score from the highest down, the score and the numbers of true and false positives
+        when predicting positive for scores at least that high.
+    '''
+    is_positive, scores = as_arrays(labels, scores)
+    order = numpy.argsort(-scores, kind='mergesort')
+    scores = scores[order]
+    is_positive = is_positive[order]
+
+    # The last row of each run of equal scores.
+    threshold_ends = numpy.append(numpy.flatnonzero(numpy.diff(scores)), len(scores) - 1) if len(scores) else numpy.array([], dtype=int)
+    true_positives = numpy.cumsum(is_positive)[threshold_ends]
+    false_positives = threshold_ends + 1 - true_positives
+    return scores[threshold_ends], true_positives, false_positives
+
+
+def compute_roc(labels, scores):
+
+    '''
+        Returns the false positive rates, true positive rates and thresholds of the ROC curve, one point per distinct
+        score from the highest down, after a first point at (0, 0) with an infinite threshold.
+    '''
+    thresholds, true_positives, false_positives = count_by_threshold(labels, scores)
+    false_positive_rates = divide(numpy.append(0, false_positives), false_positives[-1] if len(thresholds) else 0)
+    true_positive_rates = divide(numpy.append(0, true_positives), true_positives[-1] if len(thresholds) else 0)
+    return false_positive_rates, true_positive_rates, numpy.append(numpy.inf, thresholds)
+
+
+def group_by_score(scores):
+
+    # The index of each score among the distinct scores, from the lowest up.
+    distinct_scores, group_ids = numpy.unique(scores, return_inverse=True)
+    return group_ids, len(distinct_scores)
+
+
+def compute_aucs(positive_weights, negative_weights):
+
+    '''
+        The AUC of each row, where positive_weights[i, g] and negative_weights[i, g] are the number of positives and
+        negatives with the g-th lowest distinct score in the i-th resample.
+    '''
+    negative_weights_below = numpy.cumsum(negative_weights, axis=1) - negative_weights
+    concordant_weights = (positive_weights * (negative_weights_below + 0.5 * negative_weights)).sum(axis=1)
+    return divide(concordant_weights, positive_weights.sum(axis=1) * negative_weights.sum(axis=1))
+
+
+def compute_auc(labels, scores):
+    is_positive, scores = as_arrays(labels, scores)
+    group_ids, number_of_groups = group_by_score(scores)
+    positive_weights = numpy.bincount(group_ids, weights=is_positive, minlength=number_of_groups)
+    negative_weights = numpy.bincount(group_ids, weights=~is_positive, minlength=number_of_groups)
+    return float(compute_aucs(positive_weights[numpy.newaxis], negative_weights[numpy.newaxis])[0])
+
+
+def make_operating_point_table(labels, scores):
+
+    '''
+        A row for each distinct score, from the highest down, with the counts and rates of predicting positive when
+        the score is at least that threshold.
+    '''
+    is_positive, scores = as_arrays(labels, scores)
+    thresholds, true_positives, false_positives = count_by_threshold(is_positive, scores)
+    number_of_positives = int(numpy.count_nonzero(is_positive))
+    number_of_negatives = len(is_positive) - number_of_positives
+    false_negatives = number_of_positives - true_positives
+    true_negatives = number_of_negatives - false_positives
+    rates = compute_rates(true_positives, false_negatives, true_negatives, false_positives)
+
+    rows = []
+    for index, threshold in enumerate(thresholds):
+        row = {
+            'threshold': float(threshold),
+            'true_positives': int(true_positives[index]),
+            'false_negatives': int(false_negatives[index]),
+            'true_negatives': int(true_negatives[index]),
+            'false_positives': int(false_positives[index]),
+        }
+        for name in rate_names:
+            row[name] = float(rates[name][index])
+        rows.append(row)
+    return rows
+
+
+def write_operating_point_table(filepath, rows):
+    with open(filepath, 'w', newline='') as table_file:
+        writer = csv.DictWriter(table_file, fieldnames=[ 'threshold', 'true_positives', 'false_negatives', 'true_negatives', 'false_positives' ] + rate_names)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def evaluate(labels, scores, predictions):
+    counts = count_confusion(labels, predictions)
+    evaluation = dict(counts)
+    evaluation.update([ (name, float(rate)) for name, rate in compute_rates(**counts).items() ])
+    evaluation['auc'] = compute_auc(labels, scores)
+    return evaluation
+
+
+# The data being resampled, set in each worker process by set_bootstrap_data.
+bootstrap_data = None
+
+def set_bootstrap_data(labels, scores, predictions):
+    global bootstrap_data
+
+    # Code each row by its score group and its confusion cell: true positive, false negative, true negative or false
+    # positive. Counting the codes drawn by a resample gives everything its metrics need.
+    is_positive, scores = as_arrays(labels, scores)
+    is_predicted_positive = numpy.asarray(predictions, dtype=float) == 1
+    confusion_cells = numpy.where(is_positive, numpy.where(is_predicted_positive, 0, 1), numpy.where(is_predicted_positive, 3, 2))
+    group_ids, number_of_groups = group_by_score(scores)
+    bootstrap_data = { 'codes': group_ids * 4 + confusion_cells, 'number_of_groups': number_of_groups }
+
+
+def compute_bootstrap_batch(batch):
+    seed, batch_index, number_of_resamples = batch
+    codes = bootstrap_data['codes']
+    number_of_groups = bootstrap_data['number_of_groups']
+    random_state = numpy.random.RandomState([ seed, batch_index ])
+    counts = numpy.array([ numpy.bincount(codes[random_state.randint(0, len(codes), len(codes))], minlength=4 * number_of_groups) for _ in range(number_of_resamples) ])
+    counts = counts.reshape(number_of_resamples, number_of_groups, 4)
+
+    confusion_counts = counts.sum(axis=1)
+    metrics = compute_rates(confusion_counts[:, 0], confusion_counts[:, 1], confusion_counts[:, 2], confusion_counts[:, 3])
+    metrics['auc'] = compute_aucs(counts[:, :, 0] + counts[:, :, 1], counts[:, :, 2] + counts[:, :, 3])
+    return metrics
+
+
+def bootstrap_intervals(labels, scores, predictions, number_of_resamples=2000, seed=314, confidence=0.95, processes=None, resamples_per_batch=25):
+
+    '''
+        Returns a dict of each metric in interval_metric_names to its (lower, upper) percentile bootstrap interval.
+        Batches of resamples_per_batch resamples run across processes worker processes, os.cpu_count() by default.
+    '''
+    batches = []
+    for batch_index, start in enumerate(range(0, number_of_resamples, resamples_per_batch)):
+        batches.append((seed, batch_index, min(resamples_per_batch, number_of_resamples - start)))
+
+    processes = min(processes or os.cpu_count() or 1, len(batches))
+    if processes <= 1:
+        set_bootstrap_data(labels, scores, predictions)
+        batch_metrics = [ compute_bootstrap_batch(batch) for batch in batches ]
+    else:
+        with Pool(processes, initializer=set_bootstrap_data, initargs=(labels, scores, predictions)) as pool:
+            batch_metrics = pool.map(compute_bootstrap_batch, batches)
+
+    tail = 100.0 * (1.0 - confidence) / 2
+    intervals = {}
+    for name in interval_metric_names:
+        values = numpy.concatenate([ metrics[name] for metrics in batch_metrics ])
+        if numpy.isnan(values).all():
+            intervals[name] = (numpy.nan, numpy.nan)
+        else:
+            lower, upper = numpy.nanpercentile(values, [ tail, 100.0 - tail ])
+            intervals[name] = (float(lower), float(upper))
+    return intervals
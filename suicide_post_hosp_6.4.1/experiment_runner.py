@@ -0,0 +1,222 @@
+'''
+    Runs a list of classifier experiments, each an outcome, a cohort and a tree configuration, against one load of the
+    care episodes, and writes one results table. Episodes are read and their predictors built once. Each distinct
+    (outcome, cohort) subset is imputed once and shared by the experiments on it, and the cross validation folds of
+    those experiments are fit in parallel by a thread pool, since sklearn releases the GIL while building a tree.
+    Imputed subsets are compact FeatureMatrix objects unless --predictor_layout is dense.
+
+    Experiments are the product of --outcomes, --cohorts and the tree options, or are read from a JSON file
+    (--experiments) holding a list of objects with the keys of default_experiment, e.g.
+
+        [ { "outcome": "suicide_attempt", "cohort": "serious_mental_illness", "max_leaf_nodes": 8 } ]
+'''
+import argparse
+import csv
+import itertools
+import json
+import time
+from collections import OrderedDict
+from math import isnan
+from multiprocessing.dummy import Pool as ThreadPool
+import numpy
+from numpy import array, float32
+from sklearn.model_selection import KFold
+from sklearn.preprocessing import Imputer
+from feature_matrix import FeatureMatrix, read_predictor_columns, layouts
+from HospitalizationEpisode import load_episodes, is_serious_mental_illness
+from sampling import read_sample_manifest
+from model_cache import ModelCache, make_data_key
+from evaluation import bootstrap_intervals, interval_metric_names
+from decision_tree_utilities import fit_and_evaluate_fold, summarize_folds, concatenate_folds
+from instrumentation import stage, print_stage_summary, write_run_report
+
+# The get_suicidal_outcome flags (use_suicidal_ideation, use_suicide_attempt, use_suicide_attempt_broad,
+# use_cdc_suicide_self_injury) of each outcome.
+outcome_to_flags = OrderedDict([
+    ('suicidal_ideation', (True, False, False, False)),
+    ('suicide_attempt', (False, True, False, False)),
+    ('suicidal_ideation_or_attempt', (True, True, False, False)),
+    ('suicide_attempt_broad', (False, False, True, False)),
+    ('cdc_suicide_self_injury', (False, False, False, True)),
+])
+
+cohort_to_filter = OrderedDict([
+    ('all', lambda episode: True),
+    ('serious_mental_illness', is_serious_mental_illness),
+])
+
+default_experiment = {
+    'outcome': 'cdc_suicide_self_injury',
+    'cohort': 'all',
+    'cv_fold': 10,
+    'balancing': 'balanced',
+    'random_seed': 314,
+    'max_leaf_nodes': 16,
+}
+
+result_column_names = [
+    'outcome', 'cohort', 'cv_fold', 'balancing', 'random_seed', 'max_leaf_nodes', 'episodes', 'positive_outcomes',
+    'true_positives', 'false_negatives', 'true_negatives', 'false_positives', 'sensitivity', 'specificity', 'ppv', 'npv',
+    'accuracy', 'auc', 'seconds',
+] + [ '%s_%s' % (name, bound) for name in interval_metric_names for bound in [ 'lower', 'upper' ] ]
+
+def make_experiment(**settings):
+    experiment = dict(default_experiment)
+    experiment.update(settings)
+    if experiment['outcome'] not in outcome_to_flags:
+        raise ValueError('Unknown outcome %s, expected one of %s' % (experiment['outcome'], ', '.join(outcome_to_flags)))
+    if experiment['cohort'] not in cohort_to_filter:
+        raise ValueError('Unknown cohort %s, expected one of %s' % (experiment['cohort'], ', '.join(cohort_to_filter)))
+    if experiment['balancing'] == 'none':
+        experiment['balancing'] = None
+    return experiment
+
+
+def select_cohort(care_episodes, outcome, cohort):
+
+    '''
+        Returns the indices of the episodes in the cohort whose outcome is known, and their outcomes, the same
+        episodes get_medical_hospitalization_episodes selects.
+    '''
+    flags = outcome_to_flags[outcome]
+    is_in_cohort = cohort_to_filter[cohort]
+    indices = []
+    outcomes = []
+    for index, episode in enumerate(care_episodes):
+        episode_outcome = episode.get_suicidal_outcome(*flags)
+        if not isnan(episode_outcome) and is_in_cohort(episode):
+            indices.append(index)
+            outcomes.append(episode_outcome)
+    return indices, array(outcomes)
+
+
+def run_experiment_fold(task):
+
+    '''
+        Returns the fold's fit_and_evaluate_fold result and the seconds it took.
+    '''
+    experiment, predictors, outcomes, train_index, test_index, model_cache, data_key = task
+    start_time = time.perf_counter()
+    fold_result = fit_and_evaluate_fold(predictors, outcomes, train_index, test_index, experiment['balancing'], experiment['random_seed'], experiment['max_leaf_nodes'], model_cache, data_key)
+    return fold_result, time.perf_counter() - start_time
+
+
+def impute_predictors(column_names, columns, indices, predictor_layout):
+    if predictor_layout == 'dense':
+        return Imputer(strategy='median').fit_transform(numpy.column_stack([ column[indices] for column in columns ]))
+    return FeatureMatrix(column_names, [ column[indices] for column in columns ], predictor_layout)
+
+
+def run_experiments(care_episodes, experiments, threads=10, predictor_layout='compact', model_cache=None, bootstrap_resamples=0):
+
+    '''
+        Runs each experiment with cross validation, and returns a result row for each, in the order of experiments.
+        With bootstrap_resamples, each row also has the 95% confidence interval bounds of each metric.
+    '''
+    with stage('Build predictors', rows=len(care_episodes)):
+        column_names, columns = read_predictor_columns((episode.get_predictors() for episode in care_episodes), len(care_episodes), float if predictor_layout == 'dense' else float32)
+
+    # Group experiments by the subset of episodes they use, so each subset is selected and imputed once.
+    subset_to_experiments = OrderedDict()
+    for experiment in experiments:
+        subset_to_experiments.setdefault((experiment['outcome'], experiment['cohort']), []).append(experiment)
+
+    results = {}
+    pool = ThreadPool(threads)
+    try:
+        for (outcome, cohort), subset_experiments in subset_to_experiments.items():
+            with stage('Impute %s %s' % (outcome, cohort)) as report:
+                indices, outcomes = select_cohort(care_episodes, outcome, cohort)
+                predictors = impute_predictors(column_names, columns, indices, predictor_layout)
+                report['rows'] = len(indices)
+            data_key = make_data_key(predictors, outcomes) if model_cache else None
+
+            tasks = []
+            for experiment in subset_experiments:
+                folds = KFold(n_splits=experiment['cv_fold'], shuffle=True, random_state=experiment['random_seed'])
+                for train_index, test_index in folds.split(predictors):
+                    tasks.append((experiment, predictors, outcomes, train_index, test_index, model_cache, data_key))
+
+            with stage('Fit %s %s' % (outcome, cohort), rows=len(indices) * len(subset_experiments)):
+                fold_results_and_seconds = pool.map(run_experiment_fold, tasks)
+
+            for experiment in subset_experiments:
+                experiment_fold_results = [ fold_result for task, (fold_result, _) in zip(tasks, fold_results_and_seconds) if task[0] is experiment ]
+                result = dict(experiment)
+                result['balancing'] = experiment['balancing'] or 'none'
+                result['episodes'] = len(indices)
+                result['positive_outcomes'] = int(sum(outcomes == 1))
+                result.update(summarize_folds(experiment_fold_results))
+
+                # The folds of an experiment run in parallel, so this is the sum of their times rather than wall time.
+                result['seconds'] = sum([ seconds for task, (_, seconds) in zip(tasks, fold_results_and_seconds) if task[0] is experiment ])
+                if bootstrap_resamples:
+                    intervals = bootstrap_intervals(*concatenate_folds(experiment_fold_results), number_of_resamples=bootstrap_resamples, seed=experiment['random_seed'])
+                    for name, (lower, upper) in intervals.items():
+                        result[name + '_lower'] = lower
+                        result[name + '_upper'] = upper
+                results[id(experiment)] = result
+    finally:
+        pool.close()
+        pool.join()
+
+    return [ results[id(experiment)] for experiment in experiments ]
+
+
+def write_results(filepath, results):
+    with open(filepath, 'w', newline='') as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=result_column_names, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def read_experiments(filepath):
+    with open(filepath, 'r') as experiments_file:
+        return [ make_experiment(**settings) for settings in json.load(experiments_file) ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several classifier experiments against one load of the care episodes')
+    parser.add_argument('--aggregated_days', default=365, type=int, help='which analyzable_care_episodes_<days>days file to read')
+    parser.add_argument('--input_format', default='csv', choices=['csv', 'parquet', 'arrow'], help='format of the analyzable care episodes file')
+    parser.add_argument('--experiments', help='JSON file listing the experiments, instead of the product of the options below')
+    parser.add_argument('--outcomes', nargs='+', default=[ default_experiment['outcome'] ], choices=list(outcome_to_flags), help='outcomes to classify')
+    parser.add_argument('--cohorts', nargs='+', default=[ default_experiment['cohort'] ], choices=list(cohort_to_filter), help='cohorts to classify')
+    parser.add_argument('--cv_fold', nargs='+', default=[ default_experiment['cv_fold'] ], type=int, help='fold numbers for cross-validation')
+    parser.add_argument('--balancing', nargs='+', default=[ default_experiment['balancing'] ], help='tree class_weight values, or none')
+    parser.add_argument('--random_seeds', nargs='+', default=[ default_experiment['random_seed'] ], type=int, help='randomization seeds')
+    parser.add_argument('--max_leaf_nodes', nargs='+', default=[ default_experiment['max_leaf_nodes'] ], type=int, help='max # of leaf nodes')
+    parser.add_argument('--predictor_layout', default='compact', choices=['dense'] + layouts, help='dense float64 predictors, or a compact FeatureMatrix (see feature_matrix)')
+    parser.add_argument('--model_cache', help='directory caching fitted trees and fold predictions, so reruns with the same data and parameters skip the fits')
+    parser.add_argument('--bootstrap_resamples', default=0, type=int, help='bootstrap resamples for 95%% confidence intervals of the metrics, or 0 for none')
+    parser.add_argument('--sample_manifest', help='sample manifest written by make_analyzable_care_episodes.py, to only classify the care episodes of its patients')
+    parser.add_argument('--threads', default=10, type=int, help='number of folds fit at once')
+    parser.add_argument('--results', default='experiment_results.csv', help='results table to write')
+    command_args = vars(parser.parse_args())
+
+    if command_args['experiments']:
+        experiments = read_experiments(command_args['experiments'])
+    else:
+        experiments = [
+            make_experiment(outcome=outcome, cohort=cohort, cv_fold=cv_fold, balancing=balancing, random_seed=random_seed, max_leaf_nodes=max_leaf_nodes)
+            for outcome, cohort, cv_fold, balancing, random_seed, max_leaf_nodes in itertools.product(
+                command_args['outcomes'], command_args['cohorts'], command_args['cv_fold'], command_args['balancing'],
+                command_args['random_seeds'], command_args['max_leaf_nodes'])
+        ]
+    print('Running %d experiments' % len(experiments))
+
+    model_cache = ModelCache(command_args['model_cache']) if command_args['model_cache'] else None
+    sampler = read_sample_manifest(command_args['sample_manifest']) if command_args['sample_manifest'] else None
+    care_episodes = load_episodes(command_args['aggregated_days'], command_args['input_format'], sampler)
+    results = run_experiments(care_episodes, experiments, command_args['threads'], command_args['predictor_layout'], model_cache, command_args['bootstrap_resamples'])
+    write_results(command_args['results'], results)
+
+    print_stage_summary()
+    run_information = { 'command_args': command_args }
+    if model_cache:
+        run_information['model_cache'] = model_cache.get_statistics()
+    write_run_report(command_args['results'].rsplit('.', 1)[0] + '_run_report.json', **run_information)
+
+
+if __name__ == '__main__':
+    main()
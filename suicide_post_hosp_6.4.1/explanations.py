@@ -0,0 +1,75 @@
+'''
+    Explains tree predictions by the rules on each row's path from the root to its leaf, e.g.
+    'age > 64.5 AND chief_complaint_psychiatric <= 0.5'. Paths are found for all rows at once with the tree's sparse
+    decision_path matrix. Every row reaching a leaf has the same path, so each leaf's rules are formatted once and
+    shared by its rows, and explaining a batch costs little more than scoring it.
+'''
+import numpy
+
+def format_threshold(threshold):
+    return '%.6g' % threshold
+
+
+def make_node_predicates(decision_tree, column_names):
+
+    '''
+        Returns the rule of going left and of going right at each node, e.g. 'age <= 64.5' and 'age > 64.5'. Leaves
+        have no rules.
+    '''
+    tree = decision_tree.tree_
+    left_predicates = numpy.empty(tree.node_count, dtype=object)
+    right_predicates = numpy.empty(tree.node_count, dtype=object)
+    for node in range(tree.node_count):
+        if tree.children_left[node] != -1:
+            name = column_names[tree.feature[node]]
+            threshold = format_threshold(tree.threshold[node])
+            left_predicates[node] = '%s <= %s' % (name, threshold)
+            right_predicates[node] = '%s > %s' % (name, threshold)
+    return left_predicates, right_predicates
+
+
+def get_node_positive_probabilities(decision_tree):
+
+    '''
+        The probability of class 1 at each node of the tree, as predict_proba gives it for rows ending there, or 0 at
+        every node if the tree was fit without class 1.
+    '''
+    tree = decision_tree.tree_
+    positive_classes = numpy.flatnonzero(decision_tree.classes_ == 1)
+    if not len(positive_classes):
+        return numpy.zeros(tree.node_count)
+    class_values = tree.value[:, 0, :]
+    return class_values[:, positive_classes[0]] / class_values.sum(axis=1)
+
+
+def explain_predictions(decision_tree, rows, column_names, separator=' AND '):
+
+    '''
+        Scores rows with decision_tree, and returns a dict of arrays with a value per row: the 'probabilities' of the
+        positive class, 'predictions', 'leaves' (leaf node ids) and 'explanations', the rules of the row's path joined
+        by separator. column_names are the names of the columns of rows.
+    '''
+    tree = decision_tree.tree_
+    paths = decision_tree.decision_path(rows).tocsr()
+
+    # Node ids increase from the root down, so a row's sorted node ids are its path and the last is its leaf.
+    paths.sort_indices()
+    path_ends = paths.indptr[1:]
+    leaves = paths.indices[path_ends - 1]
+
+    left_predicates, right_predicates = make_node_predicates(decision_tree, column_names)
+    node_explanations = numpy.empty(tree.node_count, dtype=object)
+    distinct_leaves, first_rows = numpy.unique(leaves, return_index=True)
+    for leaf, row in zip(distinct_leaves, first_rows):
+        path = paths.indices[paths.indptr[row]:paths.indptr[row + 1]]
+        went_left = path[1:] == tree.children_left[path[:-1]]
+        predicates = numpy.where(went_left, left_predicates[path[:-1]], right_predicates[path[:-1]])
+        node_explanations[leaf] = separator.join(predicates)
+
+    class_values = tree.value[:, 0, :]
+    return {
+        'probabilities': get_node_positive_probabilities(decision_tree)[leaves],
+        'predictions': decision_tree.classes_[numpy.argmax(class_values[leaves], axis=1)],
+        'leaves': leaves,
+        'explanations': node_explanations[leaves],
+    }
@@ -0,0 +1,83 @@
+'''
+    Sorts source files by patient id without holding them in memory, so every source can be streamed together one
+    patient at a time. Each file is read in chunks, each chunk is sorted and spilled to disk, and the spilled chunks are
+    merged back together lazily.
+'''
+import csv
+import heapq
+import itertools
+from operator import itemgetter
+from os import path
+from source_files import open_source_file
+
+def write_chunk(rows, filepath):
+    with open(filepath, 'w', encoding='utf-8', newline='') as chunk_file:
+        writer = csv.writer(chunk_file)
+        for patient_id, values in rows:
+            writer.writerow([ patient_id ] + values)
+
+
+def read_chunk(filepath, fieldnames):
+    with open(filepath, 'r', encoding='utf-8', newline='') as chunk_file:
+        for values in csv.reader(chunk_file):
+            yield values[0], dict(zip(fieldnames, values[1:]))
+
+
+def sort_source_file(source_file, spill_directory, rows_per_chunk=1000000, is_patient_kept=None):
+
+    '''
+        Returns the number of rows in the source file, and an iterator of (patient id, row) sorted by
+        source_file.get_patient_id. Rows for the same patient keep their order in the file, since the sort and the merge
+        are both stable. Rows are dicts of column to value, as csv.DictReader would return. If is_patient_kept is
+        given, only the rows of patients it returns True for are sorted and counted.
+    '''
+    chunk_filepaths = []
+    number_of_rows = 0
+    with open_source_file(source_file) as input_file:
+        reader = csv.reader(input_file)
+        fieldnames = next(reader, [])
+        patient_id_index = fieldnames.index(source_file.patient_id_column)
+
+        while True:
+            chunk_values = list(itertools.islice(reader, rows_per_chunk))
+            if not chunk_values:
+                break
+
+            # csv.DictReader skips blank lines, so they are skipped here too.
+            chunk = [ (source_file.normalize_patient_id(values[patient_id_index]), values) for values in chunk_values if values ]
+            if is_patient_kept:
+                chunk = [ (patient_id, values) for patient_id, values in chunk if is_patient_kept(patient_id) ]
+
+            number_of_rows += len(chunk)
+            chunk.sort(key=itemgetter(0))
+            chunk_filepath = path.join(spill_directory, '%s.%d.csv' % (source_file.filename, len(chunk_filepaths)))
+            write_chunk(chunk, chunk_filepath)
+            chunk_filepaths.append(chunk_filepath)
+
+    # heapq.merge breaks ties by the order of its inputs, so earlier chunks (earlier rows) come first.
+    return number_of_rows, heapq.merge(*[ read_chunk(filepath, fieldnames) for filepath in chunk_filepaths ], key=itemgetter(0))
+
+
+def merge_sources_by_patient(sorted_sources):
+
+    '''
+        Joins iterators of (patient id, row) sorted by patient id. Yields each patient id with a list of its rows from
+        each source, in the order of sorted_sources, e.g. ('Z1', [ [ row1, row2 ], [], [ row3 ] ]).
+    '''
+    grouped_sources = [ itertools.groupby(sorted_source, key=itemgetter(0)) for sorted_source in sorted_sources ]
+    current_groups = [ next(grouped_source, None) for grouped_source in grouped_sources ]
+
+    while True:
+        patient_ids = [ current_group[0] for current_group in current_groups if current_group is not None ]
+        if not patient_ids:
+            return
+        patient_id = min(patient_ids)
+
+        rows_by_source = []
+        for index, current_group in enumerate(current_groups):
+            if current_group is not None and current_group[0] == patient_id:
+                rows_by_source.append([ row for _, row in current_group[1] ])
+                current_groups[index] = next(grouped_sources[index], None)
+            else:
+                rows_by_source.append([])
+        yield patient_id, rows_by_source
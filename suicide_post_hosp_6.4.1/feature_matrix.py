@@ -0,0 +1,131 @@
+'''
+    A compact, imputed predictor matrix for the decision tree. Most predictors are 0/1 indicators (medicine categories,
+    diagnoses, dispositions, races), which are stored as int8, and the rest as float32, instead of one float64 array.
+    scikit-learn trees work in float32 internally, so this changes no fit or prediction. The 'csr' layout instead stores
+    a float32 scipy.sparse CSR matrix, which scikit-learn trees accept directly. Its trees are fit by scikit-learn's
+    sparse splitter, which can break ties between equally good splits differently, so its results can differ slightly.
+
+    Indexing a FeatureMatrix with an array of row indices, e.g. predictors[train_index], makes that fold's float32 (or
+    CSR) rows in one step. scikit-learn uses them without another conversion, where the float64 array was copied once by
+    the indexing and again by the fit. Folds are kept as index arrays until they are fit. The predictors are read
+    straight into int8 and float32 columns, a chunk of episodes at a time, without a float64 copy.
+'''
+import itertools
+import numpy
+from numpy import float32, int8
+
+layouts = ['compact', 'csr']
+
+# Predictor dicts read_predictor_columns converts at once.
+chunk_rows = 4096
+
+def read_predictor_columns(predictors_labeled, number_of_rows=None, dtype=float32):
+
+    '''
+        Returns the predictor names and a column for each predictor, with missing values as NaN. predictors_labeled
+        is a list of predictor dicts, or an iterator of number_of_rows of them, e.g. of each episode.get_predictors(),
+        so the dicts of every episode are never held at once. Columns are dtype, by default the float32 the trees work
+        in, except that columns of only 0 and 1 are int8.
+    '''
+    if number_of_rows is None:
+        number_of_rows = len(predictors_labeled)
+    predictors_labeled = iter(predictors_labeled)
+    column_names = columns = None
+    start = 0
+    while start < number_of_rows:
+        chunk = list(itertools.islice(predictors_labeled, chunk_rows))
+        if not chunk:
+            break
+        if columns is None:
+            column_names = list(chunk[0].keys())
+            columns = [ numpy.empty(number_of_rows, dtype=dtype) for _ in column_names ]
+        for name, column in zip(column_names, columns):
+            column[start:start + len(chunk)] = numpy.fromiter((predictors[name] for predictors in chunk), dtype=dtype, count=len(chunk))
+        start += len(chunk)
+    if columns is None:
+        return [], []
+    return column_names, [ column.astype(int8) if numpy.isin(column, (0, 1)).all() else column for column in columns ]
+
+
+class FeatureMatrix:
+
+    '''
+        Imputes each column with the median of its known values, as Imputer(strategy='median') does, and drops
+        columns with no known values. column_names are the names of the kept columns.
+    '''
+    def __init__(self, column_names, columns, layout='compact'):
+        if layout not in layouts:
+            raise ValueError('Unknown layout %s, expected one of %s' % (layout, ', '.join(layouts)))
+        self.layout = layout
+        self.number_of_rows = len(columns[0]) if columns else 0
+        self.column_names = []
+        self.indicator_positions = []
+        self.continuous_positions = []
+        indicators = []
+        continuous = []
+        for name, column in zip(column_names, columns):
+            is_missing = numpy.isnan(column)
+            if is_missing.all():
+                continue
+            if is_missing.any():
+                column = numpy.where(is_missing, numpy.median(column[~is_missing].astype(float)), column)
+
+            position = len(self.column_names)
+            self.column_names.append(name)
+            if numpy.isin(column, (0, 1)).all():
+                self.indicator_positions.append(position)
+                indicators.append(column.astype(int8, copy=False))
+            else:
+                self.continuous_positions.append(position)
+                continuous.append(column.astype(float32, copy=False))
+
+        self.indicators = numpy.column_stack(indicators) if indicators else numpy.empty((self.number_of_rows, 0), dtype=int8)
+        self.continuous = numpy.column_stack(continuous) if continuous else numpy.empty((self.number_of_rows, 0), dtype=float32)
+        self.sparse = None
+        if layout == 'csr':
+            from scipy.sparse import csr_matrix
+            self.sparse = csr_matrix(self.take(numpy.arange(self.number_of_rows)))
+            self.indicators = self.continuous = None
+
+    @property
+    def shape(self):
+        return (self.number_of_rows, len(self.column_names))
+
+    def __len__(self):
+        return self.number_of_rows
+
+    def take(self, indices):
+        if self.sparse is not None:
+            return self.sparse[indices]
+        rows = numpy.empty((len(indices), len(self.column_names)), dtype=float32)
+        rows[:, self.indicator_positions] = self.indicators[indices]
+        rows[:, self.continuous_positions] = self.continuous[indices]
+        return rows
+
+    def __getitem__(self, indices):
+        return self.take(indices)
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.take(numpy.arange(self.number_of_rows))
+        if self.sparse is not None:
+            rows = rows.toarray()
+        return rows if dtype is None else rows.astype(dtype)
+
+    def update_hash(self, hasher):
+        hasher.update(repr((self.layout, self.shape, self.column_names)).encode('utf-8'))
+        if self.sparse is not None:
+            for values in [ self.sparse.data, self.sparse.indices, self.sparse.indptr ]:
+                hasher.update(numpy.ascontiguousarray(values).tobytes())
+        else:
+            hasher.update(numpy.ascontiguousarray(self.indicators).tobytes())
+            hasher.update(numpy.ascontiguousarray(self.continuous).tobytes())
+
+    def get_memory_bytes(self):
+        if self.sparse is not None:
+            return self.sparse.data.nbytes + self.sparse.indices.nbytes + self.sparse.indptr.nbytes
+        return self.indicators.nbytes + self.continuous.nbytes
+
+
+def build_feature_matrix(predictors_labeled, layout='compact', number_of_rows=None):
+    column_names, columns = read_predictor_columns(predictors_labeled, number_of_rows)
+    return FeatureMatrix(column_names, columns, layout)
@@ -2,7 +2,7 @@ import json
 from os import path
 
 def build_map(filename):
-    filepath = path.join('icd_code_maps', filename)
+    filepath = path.join(path.dirname(path.abspath(__file__)), 'icd_code_maps', filename)
     category_to_codes = json.load(open(filepath))
     code_to_category = {}
     for category, codes in category_to_codes.items():
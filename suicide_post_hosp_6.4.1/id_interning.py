@@ -0,0 +1,49 @@
+class IdInterner:
+
+    '''
+        Maps string ids to dense integers (1, 2, 3, ...) at ingest, and back to strings on output. Integer keys are
+        cheaper to hash and compare than the id strings in the per-row dict lookups.
+
+        Phantom ids, for encounters without an id, are drawn from a counter as -1, -2, ..., so they never collide
+        with interned ids. If is_empty_missing, the empty string is a missing id and maps to None, so missing ids
+        stay falsy as the empty string was.
+    '''
+    def __init__(self, is_empty_missing=True):
+        self.is_empty_missing = is_empty_missing
+        self.clear()
+
+    def clear(self):
+        self.id_to_number = {}
+        self.numbers_to_ids = [ None ]
+        self.number_of_phantom_ids = 0
+
+    def intern(self, id):
+        if self.is_empty_missing and id == '':
+            return None
+
+        number = self.id_to_number.get(id)
+        if number is None:
+            number = len(self.numbers_to_ids)
+            self.id_to_number[id] = number
+            self.numbers_to_ids.append(id)
+        return number
+
+    def make_phantom_id(self):
+        self.number_of_phantom_ids += 1
+        return -self.number_of_phantom_ids
+
+    def lookup(self, number):
+        if number is None:
+            return ''
+        if number < 0:
+            return 'phantom%d' % -number
+        return self.numbers_to_ids[number]
+
+    def __len__(self):
+        return len(self.numbers_to_ids) - 1
+
+
+# Patient ids (STUDY_ID / DEID_PATIENT_NUM) and encounter ids (STUDY_CSN), shared by the loaders.
+# An empty patient id is still a patient, as it was when patients were keyed by string.
+patient_ids = IdInterner(is_empty_missing=False)
+encounter_ids = IdInterner()
@@ -0,0 +1,137 @@
+import cProfile
+import json
+import os
+import re
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from os import path
+
+# One report per finished stage, in the order the stages finished.
+stage_reports = []
+
+# Stages currently running, innermost last. Used to carry a nested stage's peak memory up to its parents.
+running_stages = []
+
+# Stages to profile, by name ('*' profiles every stage), and how: 'cprofile' or 'tracemalloc'.
+profiled_stages = set()
+profile_mode = 'cprofile'
+profile_directory = 'profiles'
+
+# Only one stage is profiled at a time, so a profiled stage nested in another profiled stage is not profiled separately.
+is_profiling = False
+
+def enable_profiling(stage_names, mode='cprofile', directory='profiles'):
+    global profile_mode
+    global profile_directory
+
+    if mode not in ('cprofile', 'tracemalloc'):
+        raise ValueError('Unknown profile mode %s, expected cprofile or tracemalloc' % mode)
+    profiled_stages.update(stage_names)
+    profile_mode = mode
+    profile_directory = directory
+
+
+def read_peak_rss_mb():
+
+    # On Linux, VmHWM is the peak resident set size since it was last reset (see reset_peak_rss).
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+
+    # Elsewhere, fall back to the peak for the whole process. macOS reports bytes, Linux reports kilobytes.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except OSError:
+        pass
+
+
+def make_profile_filepath(name, extension):
+    os.makedirs(profile_directory, exist_ok=True)
+    return path.join(profile_directory, re.sub('[^A-Za-z0-9_.-]+', '_', name) + extension)
+
+
+@contextmanager
+def stage(name, rows=None):
+
+    '''
+        Times a pipeline stage. The yielded report can be updated inside the block, e.g. report['rows'] = 10 or
+        report['objects'] = { 'patients': 10 }. When the block ends, the wall time, rows per second and peak RSS are
+        added to the report.
+    '''
+    global is_profiling
+
+    report = { 'name': name, 'rows': rows }
+
+    # Fold the memory used so far into the enclosing stage before resetting the peak for this one.
+    if running_stages:
+        running_stages[-1]['peak_rss_mb'] = max(running_stages[-1]['peak_rss_mb'], read_peak_rss_mb())
+    reset_peak_rss()
+    report['peak_rss_mb'] = read_peak_rss_mb()
+    running_stages.append(report)
+
+    profiler = None
+    is_profiled = ((name in profiled_stages) or ('*' in profiled_stages)) and not is_profiling
+    is_profiling = is_profiling or is_profiled
+    if is_profiled and profile_mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif is_profiled and profile_mode == 'tracemalloc':
+        tracemalloc.start()
+
+    start_time = time.perf_counter()
+    try:
+        yield report
+    finally:
+        wall_time = time.perf_counter() - start_time
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(make_profile_filepath(name, '.prof'))
+        elif is_profiled and profile_mode == 'tracemalloc':
+            current, peak = tracemalloc.get_traced_memory()
+            report['tracemalloc_peak_mb'] = peak / (1024.0 * 1024.0)
+            with open(make_profile_filepath(name, '.tracemalloc.txt'), 'w') as tracemalloc_file:
+                for statistic in tracemalloc.take_snapshot().statistics('lineno')[:50]:
+                    tracemalloc_file.write('%s\n' % statistic)
+            tracemalloc.stop()
+        if is_profiled:
+            is_profiling = False
+
+        running_stages.pop()
+        report['peak_rss_mb'] = max(report['peak_rss_mb'], read_peak_rss_mb())
+        if running_stages:
+            running_stages[-1]['peak_rss_mb'] = max(running_stages[-1]['peak_rss_mb'], report['peak_rss_mb'])
+
+        report['wall_time_seconds'] = wall_time
+        if report['rows'] is not None:
+            report['rows_per_second'] = report['rows'] / wall_time if wall_time > 0 else None
+        stage_reports.append(report)
+
+
+def write_run_report(filepath, **run_information):
+    report = dict(run_information)
+    report['stages'] = stage_reports
+    with open(filepath, 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+
+
+def print_stage_summary():
+    for report in stage_reports:
+        rows_per_second = report.get('rows_per_second')
+        print('%-45s %10.2f s %12s rows/s %10.1f MB peak RSS' % (
+            report['name'], report['wall_time_seconds'],
+            '%.0f' % rows_per_second if rows_per_second else '-', report['peak_rss_mb'],
+        ))
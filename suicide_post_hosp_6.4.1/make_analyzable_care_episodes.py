@@ -1,162 +1,69 @@
-import csv
+import argparse
 import operator
 import os
+import tempfile
+from contextlib import ExitStack
 from Patient import Patient, epic_medicine_categories, custom_medicine_categories, default_diagnoses_list, date_to_datetime
 from CareEpisode import encounter_diagnoses_list
+from Encounter import disposition_names, unknown_disposition_counts, print_unknown_dispositions
+from memoization import mark_modified, print_cache_statistics
+import output_sinks
+from output_sinks import make_sink, TeeSink
+from episode_store import EpisodeStore
+from pipelined_io import prefetch
+from instrumentation import stage, enable_profiling, print_stage_summary, write_run_report
+from source_files import source_files, read_source_rows
+from patient_store import PatientStore
+from id_interning import patient_ids, encounter_ids
+from external_sort import sort_source_file, merge_sources_by_patient
+from row_deduplication import RowDeduplicator
+from sampling import PatientShard, make_patient_sampler, find_suicide_related_patients
+from comorbidity import make_cohort_scores
+from windowed_features import windowed_features, compute_windowed_features
 from datetime import timedelta
-from statistics import median
-from os import path
 from progress.bar import Bar
 
-def make_source_filepath(filename):
-    return path.join('source_data', filename)
+def load_patients(patients, prefetch_sources=False, sampler=None):
 
-patients = {}
+    # When prefetching, the next rows (and then the next files) are read in the background while rows are applied.
+    source_rows = [ read_source_rows(source_file) for source_file in source_files ]
+    if prefetch_sources:
+        source_rows = prefetch(source_rows)
 
-# Load from charges.
-with open(make_source_filepath('Charges_12.20.csv'), 'r', encoding='iso-8859-1') as charges_file:
-    reader = csv.DictReader(charges_file)
+    for source_file, rows_to_load in zip(source_files, source_rows):
+        with stage('Load %s' % source_file.label) as report:
+            if sampler:
+                rows_to_load = sampler.filter_rows(source_file, rows_to_load)
+            rows = 0
+            for row in rows_to_load:
+                patient_id = patient_ids.intern(source_file.get_patient_id(row))
+                if patient_id not in patients:
+                    patients[patient_id] = Patient(patient_id)
+                getattr(patients[patient_id], source_file.patient_method_name)(row)
+                rows += 1
+            report['rows'] = rows
+            report['objects'] = count_objects(patients)
 
-    for row in reader:
-        patient_id = row['STUDY_ID'].strip()
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_episode_from_charges(row)
+        print('%s done' % source_file.label)
 
-print('Charges done')
 
-# Load from Readmission.
-with open(make_source_filepath('Readmission.csv'), 'r', encoding='iso-8859-1') as readmission_file:
-    reader = csv.DictReader(readmission_file)
+def count_objects(patients):
 
-    for row in reader:
-        patient_id = row['STUDY_ID'].strip()
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_episode_from_readmissions(row)
+    # Counting episodes and encounters would read every patient back from a PatientStore, so only count patients there.
+    if isinstance(patients, PatientStore):
+        return { 'patients': len(patients) }
 
-print('Readmission done')
-
-# Load from Demographics.
-with open(make_source_filepath('Demographics.csv'), 'r', encoding='iso-8859-1') as demographics_file:
-    reader = csv.DictReader(demographics_file)
-
-    for row in reader:
-        patient_id = row['ï»¿DEID_PATIENT_NUM']
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_demographics(row)
-
-print('Demographics done')
-
-# Load from epic medication categories.
-with open(make_source_filepath('Medications_1.21.18_TS.csv'), 'r', encoding='iso-8859-1') as medications_file:
-    reader = csv.DictReader(medications_file)
-
-    for row in reader:
-        patient_id = row['DEID_PATIENT_NUM']
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_epic_medication_categories(row)
-
-print('Epic medication categories done')
-
-# Load from Medications.
-with open(make_source_filepath('Medications.csv'), 'r', encoding='iso-8859-1') as medications_file:
-    reader = csv.DictReader(medications_file)
-
-    for row in reader:
-        patient_id = row['ï»¿DEID_PATIENT_NUM']
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_medications(row)
-
-print('Medications done')
-
-# Load from Pain Score.
-with open(make_source_filepath('Pain_Score.csv'), 'r', encoding='iso-8859-1') as pain_score_file:
-    reader = csv.DictReader(pain_score_file)
-
-    for row in reader:
-        patient_id = row['STUDY_ID'].strip()
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_pain_score(row)
-
-print('Pain Score done')
-
-# Load from Chief Complaint.
-with open(make_source_filepath('Chief_Complaints.csv'), 'r', encoding='iso-8859-1') as chief_complaints_file:
-    reader = csv.DictReader(chief_complaints_file)
-
-    for row in reader:
-        patient_id = row['STUDY_ID'].strip()
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_chief_complaints(row)
-
-print('Chief Complaint done')
-
-# Load from Diagnoses.
-with open(make_source_filepath('Diagnoses.csv'), 'r', encoding='iso-8859-1') as diagnoses_file:
-    reader = csv.DictReader(diagnoses_file)
-
-    for row in reader:
-        patient_id = row['ï»¿DEID_PATIENT_NUM'].strip()
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-
-        patients[patient_id].add_diagnoses_by_code(row['ICD_CODE'].replace('.', ''))
-
-print('Diagnoses done')
-
-# Load from visits.
-with open(make_source_filepath('Visit_Breakdown_Per_Year.csv'), 'r', encoding='iso-8859-1') as visits_file:
-    reader = csv.DictReader(visits_file)
-
-    for row in reader:
-        patient_id = row['STUDY_ID'].strip()
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-
-        patients[patient_id].add_visit(row)
-print('Visits done')
-
-# Load from ZIP code demographics.
-with open(make_source_filepath('Patient_Demographics_5.2018.csv'), 'r', encoding='iso-8859-1') as zip_demographics_file:
-    reader = csv.DictReader(zip_demographics_file)
-
-    for row in reader:
-        patient_id = row['STUDY_ID']
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_zip_demographics(row)
-print('ZIP demographics done')
-
-# Load from Encounter diagnoses.
-with open(make_source_filepath('Encounter_Diagnoses_5.2018.csv'), 'r', encoding='iso-8859-1') as encounter_diagnoses_file:
-    reader = csv.DictReader(encounter_diagnoses_file)
-
-    for row in reader:
-        patient_id = row['STUDY_ID']
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_encounter_diagnosis(row)
-print('Encounter diagnoses done')
-
-# Load from Encounters with length of stay and hospital discharge disposition.
-with open(make_source_filepath('Encounters_5.2018.csv'), 'r', encoding='iso-8859-1') as encounter_file:
-    reader = csv.DictReader(encounter_file)
-
-    for row in reader:
-        patient_id = row['STUDY_ID']
-        if patient_id not in patients:
-            patients[patient_id] = Patient(patient_id)
-        patients[patient_id].add_encounters(row)
-print('Encounter done')
+    care_episodes = 0
+    encounters = 0
+    for patient in patients.values():
+        care_episodes += len(patient.care_episodes)
+        for care_episode in patient.care_episodes.values():
+            encounters += len(care_episode.encounters)
+    return { 'patients': len(patients), 'care_episodes': care_episodes, 'encounters': encounters }
 
 
 def merge_two_care_episodes(episode_1, episode_2):
+    mark_modified()
 
     # Merge date via choosing the earliest date.
     episode_1.date = min(episode_1.date, episode_2.date)
@@ -221,8 +128,7 @@ def try_to_merge(care_episodes):
     return False
 
 # Merge care episodes that have the same date ranges.
-bar = Bar('Merging care episodes', max=len(patients))
-for patient_id, patient in patients.items():
+def merge_patient_care_episodes(patient):
     care_episodes = list(patient.care_episodes.values())
 
     iterations_without_merging = 0
@@ -238,253 +144,495 @@ for patient_id, patient in patients.items():
         iterations_without_merging += 1
 
     # Rebuild the care episodes for the patient based on the remaining care episodes.
-    patient.care_episodes = {}
-    for care_episode in care_episodes:
-        patient.care_episodes[care_episode.date] = care_episode
-    bar.next()
-bar.finish()
-
-def compute_chief_complaint(complaints):
-    had_complaints = [ complaint for complaint in complaints if complaint >= 0 ]
-    return max(had_complaints) if len(had_complaints) else -9999
-
-def make_care_episode_file(number_of_days_back):
+    patient.set_care_episodes(care_episodes)
 
-    # Print analyzable encounters.
-    with open('analyzable_care_episodes_%ddays.csv' % number_of_days_back, 'w') as analyzable_encounters_file:
-        column_names = [
-            'PatientID', 'CareEpisodeDate', 'does_include_hospitalization',
-            'previous_calendar_year_ambulatory_visits', 'previous_calendar_year_emergency_visits', 'previous_calendar_year_hospital_visits',
-            'previous_year_hospital_cares', 'previous_year_non_hospital_cares', 'previous_year_total_cares',
-            'is_transfer_psychiatric',
-            'is_primary_diagnosis_psychiatric', 'is_primary_diagnosis_medical',
-            'primary_diagnosis_icd_codes', 'primary_diagnosis_descriptions',
-            'chief_complaint_medical', 'chief_complaint_psychiatric', 'chief_complaint_suicidal', 'chief_complaint_substance_use',
-            'episode_chief_complaint_medical', 'episode_chief_complaint_psychiatric', 'episode_chief_complaint_suicidal', 'episode_chief_complaint_substance_use',
-
-            # Demographics
-            'AGE_AS_OF_1ST_ADMIT', 'gender', 'race', 'ethnicity', 'zip_code',
-            'Charges', 'pain_score',
-
-            'elixhauser_walraven_score',
+def merge_care_episodes(patients):
+    with stage('Merge care episodes') as report:
+        bar = Bar('Merging care episodes', max=len(patients))
+        for patient_id, patient in patients.items():
+            merge_patient_care_episodes(patient)
+            bar.next()
+        bar.finish()
+        report['rows'] = len(patients)
+        report['objects'] = count_objects(patients)
+
+def score_comorbidities(patients):
+    with stage('Score comorbidities') as report:
+        make_cohort_scores(patients)
+        report['rows'] = len(patients)
+
+care_episode_column_names = [
+    'PatientID', 'CareEpisodeDate', 'does_include_hospitalization',
+    'previous_calendar_year_ambulatory_visits', 'previous_calendar_year_emergency_visits', 'previous_calendar_year_hospital_visits',
+    'previous_year_hospital_cares', 'previous_year_non_hospital_cares', 'previous_year_total_cares',
+    'is_transfer_psychiatric',
+    'is_primary_diagnosis_psychiatric', 'is_primary_diagnosis_medical',
+    'primary_diagnosis_icd_codes', 'primary_diagnosis_descriptions',
+    'chief_complaint_medical', 'chief_complaint_psychiatric', 'chief_complaint_suicidal', 'chief_complaint_substance_use',
+    'episode_chief_complaint_medical', 'episode_chief_complaint_psychiatric', 'episode_chief_complaint_suicidal', 'episode_chief_complaint_substance_use',
+
+    # Demographics
+    'AGE_AS_OF_1ST_ADMIT', 'gender', 'race', 'ethnicity', 'zip_code',
+    'Charges', 'pain_score',
+
+    'elixhauser_walraven_score',
+]
+care_episode_column_names.extend(default_diagnoses_list)
+care_episode_column_names.extend(encounter_diagnoses_list)
+care_episode_column_names.extend(epic_medicine_categories)
+care_episode_column_names.extend(custom_medicine_categories)
+care_episode_column_names.extend([
+
+    # Dispositions.
+    'home', 'home_health', 'psychiatry', 'acute_care', 'operating_room', 'hospice', 'skilled_nursing_facility', 'planned_readmit', 'awol', 'died', 'rehab', 'long_term_care',
+
+    'start_day', 'discharge_day', 'length_of_stay',
+    'is_psychiatric_hospitalization', 'days_until_psychiatric_rehospitalization', 'is_30_day_psychiatric_rehospitalization',
+    'days_until_rehospitalization', 'is_30_day_rehospitalization',
+    'is_rehospitalized_for_suicide_attempt', 'is_rehospitalized_for_suicidal_ideation',
+    'is_rehospitalized_for_suicidal_attempt_broad', 'is_rehospitalized_for_cdc_suicide_self_injury'
+])
+
+# Types used by the Parquet and Arrow sinks. Columns not listed are counts or days, which are written as ints.
+column_types = {
+    'PatientID': 'string', 'CareEpisodeDate': 'string', 'gender': 'string', 'race': 'string', 'ethnicity': 'string', 'zip_code': 'string',
+    'primary_diagnosis_icd_codes': 'string', 'primary_diagnosis_descriptions': 'string',
+    'Charges': 'float', 'pain_score': 'float',
+}
+indicator_columns = [
+    'does_include_hospitalization', 'is_transfer_psychiatric', 'is_primary_diagnosis_psychiatric', 'is_primary_diagnosis_medical',
+    'chief_complaint_medical', 'chief_complaint_psychiatric', 'chief_complaint_suicidal', 'chief_complaint_substance_use',
+    'episode_chief_complaint_medical', 'episode_chief_complaint_psychiatric', 'episode_chief_complaint_suicidal', 'episode_chief_complaint_substance_use',
+    'home', 'home_health', 'psychiatry', 'acute_care', 'operating_room', 'hospice', 'skilled_nursing_facility', 'planned_readmit', 'awol', 'died', 'rehab', 'long_term_care',
+    'is_psychiatric_hospitalization', 'is_30_day_psychiatric_rehospitalization', 'is_30_day_rehospitalization',
+    'is_rehospitalized_for_suicide_attempt', 'is_rehospitalized_for_suicidal_ideation',
+    'is_rehospitalized_for_suicidal_attempt_broad', 'is_rehospitalized_for_cdc_suicide_self_injury',
+]
+indicator_columns.extend(default_diagnoses_list)
+indicator_columns.extend(encounter_diagnoses_list)
+indicator_columns.extend(epic_medicine_categories)
+indicator_columns.extend(custom_medicine_categories)
+for column in indicator_columns:
+    column_types[column] = 'indicator'
+
+class ColumnComputation:
+
+    '''
+        Computes column_names for a care episode. compute(patient_id, patient, care_episode, row) sets them in row,
+        which already holds the columns of the computations named in dependencies. Some columns are only computed for
+        their dependents, and are not in the files.
+    '''
+    def __init__(self, name, column_names, compute, dependencies=()):
+        self.name = name
+        self.column_names = list(column_names)
+        self.compute = compute
+        self.dependencies = list(dependencies)
+
+
+def compute_episode(patient_id, patient, care_episode, row):
+    row['PatientID'] = patient_ids.lookup(patient_id)
+    row['CareEpisodeDate'] = care_episode.date
+    row['does_include_hospitalization'] = 1 if care_episode.does_include_hospitalization else 0
+    row['previous_calendar_year_ambulatory_visits'] = care_episode.previous_calendar_year_ambulatory_visits
+    row['previous_calendar_year_emergency_visits'] = care_episode.previous_calendar_year_emergency_visits
+    row['previous_calendar_year_hospital_visits'] = care_episode.previous_calendar_year_hospital_visits
+
+def compute_previous_year_cares(patient_id, patient, care_episode, row):
+    row['previous_year_hospital_cares'], row['previous_year_non_hospital_cares'], row['previous_year_total_cares'] = patient.count_previous_year_cares(care_episode)
+
+def compute_is_transfer_psychiatric(patient_id, patient, care_episode, row):
+    row['is_transfer_psychiatric'] = care_episode.is_transfer_psychiatric()
+
+def compute_primary_diagnosis(patient_id, patient, care_episode, row):
+    (row['is_primary_diagnosis_psychiatric'], row['is_primary_diagnosis_medical'],
+    row['primary_diagnosis_icd_codes'], row['primary_diagnosis_descriptions']) = care_episode.get_primary_diagnosis()
+
+def compute_episode_chief_complaints(patient_id, patient, care_episode, row):
+    row['episode_chief_complaint_medical'] = care_episode.get_chief_complaint_medical()
+    row['episode_chief_complaint_psychiatric'] = care_episode.get_chief_complaint_psychiatric()
+    row['episode_chief_complaint_suicidal'] = care_episode.get_chief_complaint_suicidal()
+    row['episode_chief_complaint_substance_use'] = care_episode.get_chief_complaint_substance_use()
+
+def compute_demographics(patient_id, patient, care_episode, row):
+    row['AGE_AS_OF_1ST_ADMIT'] = patient.age_of_first_admit
+    row['gender'] = patient.gender
+    row['race'] = patient.race
+    row['ethnicity'] = patient.ethnicity
+    row['zip_code'] = patient.zip_code
+
+def compute_elixhauser_walraven_score(patient_id, patient, care_episode, row):
+    row['elixhauser_walraven_score'] = patient.get_elixhauser_walraven_score()
+
+def make_prior_diagnosis_computation(diagnosis):
+    def compute_prior_diagnosis(patient_id, patient, care_episode, row):
+        row[diagnosis] = patient.had_prior_diagnosis(care_episode, diagnosis)
+    return ColumnComputation(diagnosis, [ diagnosis ], compute_prior_diagnosis)
+
+def compute_episode_diagnoses(patient_id, patient, care_episode, row):
+    row.update(care_episode.get_episode_diagnoses())
+
+def compute_medicines(patient_id, patient, care_episode, row):
+    for category in epic_medicine_categories:
+        row[category] = patient.epic_medicines[category]
+    for category in custom_medicine_categories:
+        row[category] = patient.custom_medicines[category]
+
+def compute_dispositions(patient_id, patient, care_episode, row):
+    row.update(care_episode.get_dispositions())
+
+def compute_days(patient_id, patient, care_episode, row):
+    row['start_day'] = care_episode.get_start_day()
+    row['discharge_day'] = care_episode.get_discharge_day()
+    row['length_of_stay'] = care_episode.get_length_of_stay()
+
+def compute_is_psychiatric_hospitalization(patient_id, patient, care_episode, row):
+    row['is_psychiatric_hospitalization'] = care_episode.is_psychiatric_hospitalization()
+
+def compute_psychiatric_rehospitalization(patient_id, patient, care_episode, row):
+    days_until_psychiatric_rehospitalization = patient.get_days_until_psychiatric_rehospitalization(care_episode)
+    row['days_until_psychiatric_rehospitalization'] = days_until_psychiatric_rehospitalization
+    row['is_30_day_psychiatric_rehospitalization'] = 1 if 1 <= days_until_psychiatric_rehospitalization <= 30 else 0
+
+def compute_rehospitalization(patient_id, patient, care_episode, row):
+    days_until_rehospitalization = patient.get_days_until_rehospitalization(care_episode)
+    row['days_until_rehospitalization'] = days_until_rehospitalization
+    row['is_30_day_rehospitalization'] = 1 if 1 <= days_until_rehospitalization <= 30 else 0
+
+def make_rehospitalized_for_diagnosis_computation(column_name, diagnosis):
+    def compute_rehospitalized_for_diagnosis(patient_id, patient, care_episode, row):
+        row[column_name] = patient.get_whether_rehospitalized_for_diagnosis(care_episode, diagnosis)
+    return ColumnComputation(column_name, [ column_name ], compute_rehospitalized_for_diagnosis)
+
+def compute_rehospitalized_for_suicidal_attempt_broad(patient_id, patient, care_episode, row):
+    is_rehospitalized_for_suicide_attempt = row['is_rehospitalized_for_suicide_attempt']
+    is_rehospitalized_for_suicide_attempt_likely = row['is_rehospitalized_for_suicide_attempt_likely']
+
+    # suicidal_attempt_broad is suicide_attempt or suicide_attempt_likely.
+    is_rehospitalized_for_suicidal_attempt_broad = -9999
+    if (is_rehospitalized_for_suicide_attempt == 1) or (is_rehospitalized_for_suicide_attempt_likely == 1):
+        is_rehospitalized_for_suicidal_attempt_broad = 1
+    elif (is_rehospitalized_for_suicide_attempt != -9999) or (is_rehospitalized_for_suicide_attempt_likely != -9999):
+        is_rehospitalized_for_suicidal_attempt_broad = 0
+    row['is_rehospitalized_for_suicidal_attempt_broad'] = is_rehospitalized_for_suicidal_attempt_broad
+
+# Every column of the care episode files but the windowed features, in an order where dependencies come first.
+care_episode_computations = [
+    ColumnComputation('episode', [
+        'PatientID', 'CareEpisodeDate', 'does_include_hospitalization',
+        'previous_calendar_year_ambulatory_visits', 'previous_calendar_year_emergency_visits', 'previous_calendar_year_hospital_visits',
+    ], compute_episode),
+    ColumnComputation('previous_year_cares', [ 'previous_year_hospital_cares', 'previous_year_non_hospital_cares', 'previous_year_total_cares' ], compute_previous_year_cares),
+    ColumnComputation('is_transfer_psychiatric', [ 'is_transfer_psychiatric' ], compute_is_transfer_psychiatric),
+    ColumnComputation('primary_diagnosis', [
+        'is_primary_diagnosis_psychiatric', 'is_primary_diagnosis_medical', 'primary_diagnosis_icd_codes', 'primary_diagnosis_descriptions',
+    ], compute_primary_diagnosis),
+    ColumnComputation('episode_chief_complaints', [
+        'episode_chief_complaint_medical', 'episode_chief_complaint_psychiatric', 'episode_chief_complaint_suicidal', 'episode_chief_complaint_substance_use',
+    ], compute_episode_chief_complaints),
+    ColumnComputation('demographics', [ 'AGE_AS_OF_1ST_ADMIT', 'gender', 'race', 'ethnicity', 'zip_code' ], compute_demographics),
+    ColumnComputation('elixhauser_walraven_score', [ 'elixhauser_walraven_score' ], compute_elixhauser_walraven_score),
+]
+care_episode_computations.extend([ make_prior_diagnosis_computation(diagnosis) for diagnosis in default_diagnoses_list ])
+care_episode_computations.extend([
+    ColumnComputation('episode_diagnoses', encounter_diagnoses_list, compute_episode_diagnoses),
+    ColumnComputation('medicines', list(epic_medicine_categories) + list(custom_medicine_categories), compute_medicines),
+    ColumnComputation('dispositions', disposition_names, compute_dispositions),
+    ColumnComputation('days', [ 'start_day', 'discharge_day', 'length_of_stay' ], compute_days),
+    ColumnComputation('is_psychiatric_hospitalization', [ 'is_psychiatric_hospitalization' ], compute_is_psychiatric_hospitalization),
+    ColumnComputation('psychiatric_rehospitalization', [ 'days_until_psychiatric_rehospitalization', 'is_30_day_psychiatric_rehospitalization' ], compute_psychiatric_rehospitalization),
+    ColumnComputation('rehospitalization', [ 'days_until_rehospitalization', 'is_30_day_rehospitalization' ], compute_rehospitalization),
+    make_rehospitalized_for_diagnosis_computation('is_rehospitalized_for_suicide_attempt', 'episode_suicide_attempt'),
+    make_rehospitalized_for_diagnosis_computation('is_rehospitalized_for_suicide_attempt_likely', 'episode_suicide_attempt_likely'),
+    make_rehospitalized_for_diagnosis_computation('is_rehospitalized_for_suicidal_ideation', 'episode_suicidal_ideation'),
+    ColumnComputation('is_rehospitalized_for_suicidal_attempt_broad', [ 'is_rehospitalized_for_suicidal_attempt_broad' ], compute_rehospitalized_for_suicidal_attempt_broad,
+        dependencies=[ 'is_rehospitalized_for_suicide_attempt', 'is_rehospitalized_for_suicide_attempt_likely' ]),
+    make_rehospitalized_for_diagnosis_computation('is_rehospitalized_for_cdc_suicide_self_injury', 'episode_cdc_suicide_self_injury'),
+])
+
+class ColumnProjection:
+
+    '''
+        The columns of the care episode files to write, by default all of them, in file order, and only the
+        computations (and windowed features) they need, along with everything those depend on.
+    '''
+    def __init__(self, column_names=None):
+        column_names = set(care_episode_column_names if column_names is None else column_names)
+        unknown_column_names = column_names - set(care_episode_column_names)
+        if unknown_column_names:
+            raise ValueError('Unknown care episode columns: %s' % ', '.join(sorted(unknown_column_names)))
+        self.column_names = [ name for name in care_episode_column_names if name in column_names ]
+
+        name_to_computation = dict([ (computation.name, computation) for computation in care_episode_computations ])
+        needed_names = set()
+        names_to_visit = [ computation.name for computation in care_episode_computations if column_names.intersection(computation.column_names) ]
+        while names_to_visit:
+            name = names_to_visit.pop()
+            if name not in needed_names:
+                needed_names.add(name)
+                names_to_visit.extend(name_to_computation[name].dependencies)
+        self.computations = [ computation for computation in care_episode_computations if computation.name in needed_names ]
+        self.windowed_features = [ feature for feature in windowed_features if feature.column_name in column_names ]
+
+        # Columns computed along with the requested ones, or for them, which are dropped from the rows.
+        self.dropped_column_names = [ name for computation in self.computations for name in computation.column_names if name not in column_names ]
+
+
+def make_care_episode_rows(patient_id, patient, number_of_days_back, projection=None):
+    projection = projection or ColumnProjection()
+
+    # Only 18+ year olds.
+    if patient.age_of_first_admit >= 18:
+
+        # Sort care episodes from earliest to latest date.
+        care_episodes = patient.care_episodes.values()
+        sorted_care_episodes = sorted(care_episodes, key=operator.attrgetter('date'))
+
+        # Only print from 2007, and if there was an encounter and one of those encounters was a hospitalization.
+        row_care_episodes = [
+            care_episode for care_episode in sorted_care_episodes
+            if date_to_datetime(care_episode.date).year >= 2007 and len(care_episode.encounters) and care_episode.does_include_hospitalization
         ]
-        column_names.extend(default_diagnoses_list)
-        column_names.extend(encounter_diagnoses_list)
-        column_names.extend(epic_medicine_categories)
-        column_names.extend(custom_medicine_categories)
-        column_names.extend([
+        if row_care_episodes:
 
-            # Dispositions.
-            'home', 'home_health', 'psychiatry', 'acute_care', 'operating_room', 'hospice', 'skilled_nursing_facility', 'planned_readmit', 'awol', 'died', 'rehab', 'long_term_care',
+            # Charges, pain score and chief complaints over the care episodes going back |number_of_days_back| days.
+            windowed_values = compute_windowed_features(patient, row_care_episodes, number_of_days_back, projection.windowed_features)
 
-            'start_day', 'discharge_day', 'length_of_stay',
-            'is_psychiatric_hospitalization', 'days_until_psychiatric_rehospitalization', 'is_30_day_psychiatric_rehospitalization',
-            'days_until_rehospitalization', 'is_30_day_rehospitalization',
-            'is_rehospitalized_for_suicide_attempt', 'is_rehospitalized_for_suicidal_ideation',
-            'is_rehospitalized_for_suicidal_attempt_broad', 'is_rehospitalized_for_cdc_suicide_self_injury'
-        ])
+            for row_index, care_episode in enumerate(row_care_episodes):
+                row = {}
+                for computation in projection.computations:
+                    computation.compute(patient_id, patient, care_episode, row)
+                for column_name, values in windowed_values.items():
+                    row[column_name] = values[row_index]
+                for column_name in projection.dropped_column_names:
+                    del row[column_name]
 
-        writer = csv.DictWriter(analyzable_encounters_file, fieldnames=column_names)
-        writer.writeheader()
+                yield row
 
-        bar = Bar('Building csv file for %d days' % number_of_days_back, max=len(patients))
+def make_output_sink(output_format, filename, column_names, episode_store=None):
 
-        for patient_id, patient in patients.items():
-            bar.next()
+    # Rows also go to the episode store's table of the same name, if there is one.
+    sink = make_sink(output_format, filename, column_names, column_types)
+    return TeeSink([ sink, episode_store.make_sink(filename, column_names, column_types) ]) if episode_store else sink
 
-            # Only 18+ year olds.
-            if patient.age_of_first_admit >= 18:
-
-                # Sort care episodes from earliest to latest date.
-                care_episodes = patient.care_episodes.values()
-                sorted_care_episodes = sorted(care_episodes, key=operator.attrgetter('date'))
-
-                for care_episode in sorted_care_episodes:
-
-                    # Don't print before 2007.
-                    care_episode_datetime = date_to_datetime(care_episode.date)
-                    if care_episode_datetime.year >= 2007:
-
-                        # Only print if there was an encounter and one of those encounters was a hospitalization.
-                        if len(care_episode.encounters) and care_episode.does_include_hospitalization:
-                            previous_year_hospital_cares, previous_year_non_hospital_cares, previous_year_total_cares = patient.count_previous_year_cares(care_episode)
-
-                            start_datetime = care_episode_datetime
-                            end_datetime = care_episode_datetime - timedelta(days=number_of_days_back)
-
-                            # Find care episodes going back |number_of_days_back| days.
-                            care_episodes_in_range = [
-                                care_episode for care_episode in patient.care_episodes.values()
-                                if (end_datetime <= date_to_datetime(care_episode.date) <= start_datetime)
-                            ]
-
-                            charges_list = [ episodes.get_charges() for episodes in care_episodes_in_range if episodes.get_charges() >= 0 ]
-                            charges = sum(charges_list) if len(charges_list) else -9999
-
-                            pain_scores = [ episodes.get_pain_score() for episodes in care_episodes_in_range if episodes.get_pain_score() >= 0 ]
-                            pain_score = median(pain_scores) if len(pain_scores) else -9999
-
-                            is_transfer_psychiatric = care_episode.is_transfer_psychiatric()
-
-                            # Compute primary diagnosis.
-                            (is_primary_diagnosis_psychiatric, is_primary_diagnosis_medical,
-                            primary_diagnosis_icd_codes, primary_diagnosis_descriptions) = care_episode.get_primary_diagnosis()
-
-                            # Compute chief complaints.
-                            chief_complaint_medical = compute_chief_complaint(
-                                [ episodes.get_chief_complaint_medical() for episodes in care_episodes_in_range ]
-                            )
-                            chief_complaint_psychiatric = compute_chief_complaint(
-                                [ episodes.get_chief_complaint_psychiatric() for episodes in care_episodes_in_range ]
-                            )
-                            chief_complaint_suicidal = compute_chief_complaint(
-                                [ episodes.get_chief_complaint_suicidal() for episodes in care_episodes_in_range ]
-                            )
-                            chief_complaint_substance_use = compute_chief_complaint(
-                                [ episodes.get_chief_complaint_substance_use() for episodes in care_episodes_in_range ]
-                            )
-
-                            is_psychiatric_hospitalization = care_episode.is_psychiatric_hospitalization()
-
-                            start_day = care_episode.get_start_day()
-                            discharge_day = care_episode.get_discharge_day()
-                            length_of_stay = care_episode.get_length_of_stay()
-
-                            days_until_psychiatric_rehospitalization = patient.get_days_until_psychiatric_rehospitalization(care_episode)
-                            is_30_day_psychiatric_rehospitalization = 1 if 1 <= days_until_psychiatric_rehospitalization <= 30 else 0
-
-                            days_until_rehospitalization = patient.get_days_until_rehospitalization(care_episode)
-                            is_30_day_rehospitalization = 1 if 1 <= days_until_rehospitalization <= 30 else 0
-
-                            is_rehospitalized_for_suicide_attempt = patient.get_whether_rehospitalized_for_diagnosis(care_episode, 'episode_suicide_attempt')
-                            is_rehospitalized_for_suicide_attempt_likely = patient.get_whether_rehospitalized_for_diagnosis(care_episode, 'episode_suicide_attempt_likely')
-                            is_rehospitalized_for_cdc_suicide_self_injury = patient.get_whether_rehospitalized_for_diagnosis(care_episode, 'episode_cdc_suicide_self_injury')
-
-                            # suicidal_attempt_broad is suicide_attempt or suicide_attempt_likely.
-                            is_rehospitalized_for_suicidal_attempt_broad = -9999
-                            if (is_rehospitalized_for_suicide_attempt == 1) or (is_rehospitalized_for_suicide_attempt_likely == 1):
-                                is_rehospitalized_for_suicidal_attempt_broad = 1
-                            elif (is_rehospitalized_for_suicide_attempt != -9999) or (is_rehospitalized_for_suicide_attempt_likely != -9999):
-                                is_rehospitalized_for_suicidal_attempt_broad = 0
-
-                            row = {
-                                'PatientID': patient_id,
-                                'CareEpisodeDate': care_episode.date,
-                                'Charges': charges,
-                                'does_include_hospitalization': 1 if care_episode.does_include_hospitalization else 0,
-                                'previous_calendar_year_ambulatory_visits': care_episode.previous_calendar_year_ambulatory_visits,
-                                'previous_calendar_year_emergency_visits': care_episode.previous_calendar_year_emergency_visits,
-                                'previous_calendar_year_hospital_visits': care_episode.previous_calendar_year_hospital_visits,
-                                'previous_year_hospital_cares': previous_year_hospital_cares,
-                                'previous_year_non_hospital_cares': previous_year_non_hospital_cares,
-                                'previous_year_total_cares': previous_year_total_cares,
-                                'start_day': start_day,
-                                'discharge_day': discharge_day,
-                                'length_of_stay': length_of_stay,
-                                'days_until_psychiatric_rehospitalization': days_until_psychiatric_rehospitalization,
-                                'is_psychiatric_hospitalization': is_psychiatric_hospitalization,
-                                'is_30_day_psychiatric_rehospitalization': is_30_day_psychiatric_rehospitalization,
-                                'days_until_rehospitalization': days_until_rehospitalization,
-                                'is_30_day_rehospitalization': is_30_day_rehospitalization,
-                                'is_rehospitalized_for_suicide_attempt': is_rehospitalized_for_suicide_attempt,
-                                'is_rehospitalized_for_suicidal_ideation': patient.get_whether_rehospitalized_for_diagnosis(care_episode, 'episode_suicidal_ideation'),
-                                'is_rehospitalized_for_suicidal_attempt_broad': is_rehospitalized_for_suicidal_attempt_broad,
-                                'is_rehospitalized_for_cdc_suicide_self_injury': is_rehospitalized_for_cdc_suicide_self_injury,
-                                'AGE_AS_OF_1ST_ADMIT': patient.age_of_first_admit,
-                                'gender': patient.gender,
-                                'race': patient.race,
-                                'ethnicity': patient.ethnicity,
-                                'zip_code': patient.zip_code,
-                                'pain_score': pain_score,
-                                'is_transfer_psychiatric': is_transfer_psychiatric,
-                                'is_primary_diagnosis_psychiatric': is_primary_diagnosis_psychiatric,
-                                'is_primary_diagnosis_medical': is_primary_diagnosis_medical,
-                                'primary_diagnosis_icd_codes': primary_diagnosis_icd_codes,
-                                'primary_diagnosis_descriptions': primary_diagnosis_descriptions,
-                                'chief_complaint_medical': chief_complaint_medical,
-                                'chief_complaint_psychiatric': chief_complaint_psychiatric,
-                                'chief_complaint_suicidal': chief_complaint_suicidal,
-                                'chief_complaint_substance_use': chief_complaint_substance_use,
-                                'elixhauser_walraven_score': patient.get_elixhauser_walraven_score(),
-                                'episode_chief_complaint_medical': care_episode.get_chief_complaint_medical(),
-                                'episode_chief_complaint_psychiatric': care_episode.get_chief_complaint_psychiatric(),
-                                'episode_chief_complaint_suicidal': care_episode.get_chief_complaint_suicidal(),
-                                'episode_chief_complaint_substance_use': care_episode.get_chief_complaint_substance_use(),
-                            }
-
-                            # Add dispositions.
-                            for disposition, disposition_value in care_episode.get_dispositions().items():
-                                row[disposition] = disposition_value
-
-                            # Add each diagnoses category to the row.
-                            for diagnosis in default_diagnoses_list:
-                                row[diagnosis] = patient.had_prior_diagnosis(care_episode, diagnosis)
-
-                            episode_diagnoses = care_episode.get_episode_diagnoses()
-                            for diagnosis, value in episode_diagnoses.items():
-                                row[diagnosis] = value
-
-                            # Add each medicine category to the row.
-                            for category in epic_medicine_categories:
-                                row[category] = patient.epic_medicines[category]
-                            for category in custom_medicine_categories:
-                                row[category] = patient.custom_medicines[category]
-
-                            writer.writerow(row)
-        bar.finish()
+def make_care_episode_file(patients, number_of_days_back, output_format='csv', episode_store=None, projection=None, is_last_file=False):
 
-def make_patient_file():
+    '''
+        If is_last_file, no more care episode rows are built after this file, so each patient's memoized values are
+        freed once its rows are written.
+    '''
+    projection = projection or ColumnProjection()
 
     # Print analyzable encounters.
-    with open('analyzable_patients.csv', 'w') as analyzable_patients_file:
-        column_names = [
-            'PatientID',
-
-            # Demographics
-            'AGE_AS_OF_1ST_ADMIT', 'gender', 'race', 'ethnicity',
-        ]
-        column_names.extend(default_diagnoses_list)
-        column_names.extend(epic_medicine_categories)
-
-        writer = csv.DictWriter(analyzable_patients_file, fieldnames=column_names)
-        writer.writeheader()
+    with stage('Build care episode file for %d days' % number_of_days_back) as report, make_output_sink(output_format, 'analyzable_care_episodes_%ddays' % number_of_days_back, projection.column_names, episode_store) as sink:
+        report['rows'] = 0
+        bar = Bar('Building csv file for %d days' % number_of_days_back, max=len(patients))
 
         for patient_id, patient in patients.items():
+            bar.next()
 
-            # Only 18+ year olds.
-            if patient.age_of_first_admit >= 18:
-                row = {
-                    'PatientID': patient_id,
-                    'AGE_AS_OF_1ST_ADMIT': patient.age_of_first_admit,
-                    'gender': patient.gender,
-                    'race': patient.race,
-                    'ethnicity': patient.ethnicity,
-                }
-
-                # Add each diagnoses category to the row.
-                for diagnosis in default_diagnoses_list:
-                    row[diagnosis] = patient.diagnoses[diagnosis]
+            for row in make_care_episode_rows(patient_id, patient, number_of_days_back, projection):
+                sink.write(row)
+                report['rows'] += 1
+            if is_last_file:
+                patient.clear_memoized_values()
+        bar.finish()
+    print_cache_statistics()
 
-                # Add each medicine category to the row.
-                for medicine_category in epic_medicine_categories:
-                    row[medicine_category] = patient.epic_medicines[medicine_category]
+patient_column_names = [
+    'PatientID',
 
-                writer.writerow(row)
+    # Demographics
+    'AGE_AS_OF_1ST_ADMIT', 'gender', 'race', 'ethnicity',
+]
+patient_column_names.extend(default_diagnoses_list)
+patient_column_names.extend(epic_medicine_categories)
 
-# Year
-make_care_episode_file(365)
+def make_patient_row(patient_id, patient):
 
-os.system('say "365 done."')
+    # Only 18+ year olds.
+    if patient.age_of_first_admit < 18:
+        return None
 
-# 10 Years
-make_care_episode_file(3650)
+    row = {
+        'PatientID': patient_ids.lookup(patient_id),
+        'AGE_AS_OF_1ST_ADMIT': patient.age_of_first_admit,
+        'gender': patient.gender,
+        'race': patient.race,
+        'ethnicity': patient.ethnicity,
+    }
 
-# Half year
-make_care_episode_file(int(365 / 2))
+    # Add each diagnoses category to the row.
+    for diagnosis in default_diagnoses_list:
+        row[diagnosis] = patient.diagnoses[diagnosis]
 
-# 2 months
-make_care_episode_file(60)
+    # Add each medicine category to the row.
+    for medicine_category in epic_medicine_categories:
+        row[medicine_category] = patient.epic_medicines[medicine_category]
+    return row
 
-make_patient_file()
+def make_patient_file(patients, output_format='csv', episode_store=None):
 
-os.system('say "Script done."')
\ No newline at end of file
+    # Print analyzable encounters.
+    with stage('Build patient file') as report, make_output_sink(output_format, 'analyzable_patients', patient_column_names, episode_store) as sink:
+        report['rows'] = 0
+        for patient_id, patient in patients.items():
+            row = make_patient_row(patient_id, patient)
+            if row:
+                sink.write(row)
+                report['rows'] += 1
+
+# Look back windows of the care episode files, in days: a year, 10 years, half a year and 2 months.
+care_episode_horizons = [ 365, 3650, int(365 / 2), 60 ]
+
+def make_analyzable_files_by_patient(spill_directory=None, rows_per_chunk=1000000, output_format='csv', deduplicator=None, episode_store=None, projection=None, sampler=None):
+
+    '''
+        Builds every analyzable file in one pass, holding one patient in memory at a time. The source files are sorted
+        by patient id first, then streamed together: each patient is loaded from every source, their care episodes are
+        merged, and their rows are written to each file. Rows are in patient id order rather than load order.
+    '''
+    projection = projection or ColumnProjection()
+    with tempfile.TemporaryDirectory(prefix='sorted_sources_', dir=spill_directory) as sorted_directory:
+        sorted_sources = []
+        for source_file in source_files:
+            with stage('Sort %s' % source_file.label) as report:
+                report['rows'], sorted_source = sort_source_file(source_file, sorted_directory, rows_per_chunk, sampler.is_sampled if sampler else None)
+                sorted_sources.append(sorted_source)
+
+        with stage('Build analyzable files by patient') as report, ExitStack() as sinks:
+            care_episode_sinks = [
+                sinks.enter_context(make_output_sink(output_format, 'analyzable_care_episodes_%ddays' % number_of_days_back, projection.column_names, episode_store))
+                for number_of_days_back in care_episode_horizons
+            ]
+            patient_sink = sinks.enter_context(make_output_sink(output_format, 'analyzable_patients', patient_column_names, episode_store))
+
+            report['rows'] = 0
+            for patient_id, rows_by_source in merge_sources_by_patient(sorted_sources):
+                patient_id = patient_ids.intern(patient_id)
+                patient = Patient(patient_id)
+                for source_file, rows in zip(source_files, rows_by_source):
+                    add_row = getattr(patient, source_file.patient_method_name)
+                    if deduplicator:
+                        deduplicator.reset()
+                        rows = deduplicator.filter_rows(source_file, rows)
+                    for row in rows:
+                        add_row(row)
+                merge_patient_care_episodes(patient)
+
+                for number_of_days_back, sink in zip(care_episode_horizons, care_episode_sinks):
+                    for row in make_care_episode_rows(patient_id, patient, number_of_days_back, projection):
+                        sink.write(row)
+                row = make_patient_row(patient_id, patient)
+                if row:
+                    patient_sink.write(row)
+                report['rows'] += 1
+
+                # Ids only need to be unique within a patient here, so the tables are cleared to keep memory bounded.
+                patient_ids.clear()
+                encounter_ids.clear()
+    print_cache_statistics()
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the analyzable care episode and patient files')
+    parser.add_argument('--output_format', default='csv', choices=['csv', 'parquet', 'arrow'], help='parquet and arrow need pyarrow, and write -9999 as null')
+    parser.add_argument('--run_report', default='run_report.json', help='JSON file to write stage timings and memory use to')
+    parser.add_argument('--profile', nargs='*', default=[], help='names of stages to profile, or * for every stage')
+    parser.add_argument('--profile_mode', default='cprofile', choices=['cprofile', 'tracemalloc'], help='how to profile the --profile stages')
+    parser.add_argument('--patient_store', default=None, help='SQLite file to keep patients in instead of memory, for cohorts larger than RAM')
+    parser.add_argument('--memory_budget_mb', default=2048, type=int, help='memory for the patients held in memory when using --patient_store')
+    parser.add_argument('--overlap_io', action='store_true', help='read the source files ahead and write the output files from background threads')
+    parser.add_argument('--stream_by_patient', action='store_true', help='sort the source files by patient, then build every file one patient at a time in bounded memory')
+    parser.add_argument('--spill_directory', default=None, help='directory for the sorted chunks of the source files when using --stream_by_patient')
+    parser.add_argument('--rows_per_chunk', default=1000000, type=int, help='rows sorted in memory at a time when using --stream_by_patient')
+    parser.add_argument('--episode_store', default=None, help='SQLite file to also write the analyzable files to as indexed tables, for querying with episode_store.EpisodeStore')
+    parser.add_argument('--columns', nargs='+', metavar='COLUMN', help='only compute and write these columns of the care episode files')
+    parser.add_argument('--sample_fraction', type=float, help='only build the files for this fraction of patients, chosen by a hash of their id, e.g. 0.05 for fast iteration runs')
+    parser.add_argument('--sample_seed', default='', help='salt of the patient id hash, to draw a different sample')
+    parser.add_argument('--sample_stratify', action='store_true', help='sample patients with a suicide related diagnosis separately, at exactly --sample_suicide_related_fraction')
+    parser.add_argument('--sample_suicide_related_fraction', type=float, help='fraction of the patients with a suicide related diagnosis to sample, by default --sample_fraction')
+    parser.add_argument('--sample_manifest', default='sample_manifest.json', help='JSON file recording the sample, which the classifier scripts can read to sample full files the same way')
+    parser.add_argument('--shard', nargs=2, type=int, metavar=('INDEX', 'NUMBER'), help='only build the files for shard INDEX (from 0) of NUMBER shards of patients, as shard_queue.py runs it')
+    parser.add_argument('--deduplicate', nargs='*', metavar='FILENAME', help='drop repeated rows of the named source files, or of every source file if none are named; needs --stream_by_patient')
+    command_args = vars(parser.parse_args())
+
+    # Rows are only compared within a patient, which bounds the rows kept, so deduplication needs streaming by patient.
+    if command_args['deduplicate'] is not None and not command_args['stream_by_patient']:
+        parser.error('--deduplicate needs --stream_by_patient')
+    source_filenames = [ source_file.filename for source_file in source_files ]
+    for filename in command_args['deduplicate'] or []:
+        if filename not in source_filenames:
+            parser.error('--deduplicate: unknown source file %s' % filename)
+    deduplicator = RowDeduplicator(command_args['deduplicate']) if command_args['deduplicate'] is not None else None
+    try:
+        projection = ColumnProjection(command_args['columns'])
+    except ValueError as error:
+        parser.error('--columns: %s' % error)
+
+    for name in ['sample_fraction', 'sample_suicide_related_fraction']:
+        if command_args[name] is not None and not 0 < command_args[name] <= 1:
+            parser.error('--%s must be in (0, 1]' % name)
+    if command_args['sample_fraction'] is None and (command_args['sample_stratify'] or command_args['sample_suicide_related_fraction'] is not None):
+        parser.error('--sample_stratify and --sample_suicide_related_fraction need --sample_fraction')
+    if command_args['shard'] and not 0 <= command_args['shard'][0] < command_args['shard'][1]:
+        parser.error('--shard: INDEX must be in [0, NUMBER)')
+
+    enable_profiling(command_args['profile'], command_args['profile_mode'])
+    output_sinks.background_writer = command_args['overlap_io']
+
+    episode_store = EpisodeStore(command_args['episode_store']) if command_args['episode_store'] else None
+    patients = PatientStore(command_args['patient_store'], command_args['memory_budget_mb']) if command_args['patient_store'] else {}
+    with stage('Total'):
+        sampler = None
+        if command_args['sample_fraction'] is not None:
+            suicide_related_patient_ids = None
+            if command_args['sample_stratify']:
+                with stage('Find suicide related patients') as report:
+                    suicide_related_patient_ids = find_suicide_related_patients()
+                    report['rows'] = len(suicide_related_patient_ids)
+            sampler = make_patient_sampler(command_args['sample_fraction'], command_args['sample_seed'], suicide_related_patient_ids, command_args['sample_suicide_related_fraction'])
+            sampler.write_manifest(command_args['sample_manifest'])
+        if command_args['shard']:
+            sampler = PatientShard(command_args['shard'][0], command_args['shard'][1], sampler)
+
+        if command_args['stream_by_patient']:
+            make_analyzable_files_by_patient(command_args['spill_directory'], command_args['rows_per_chunk'], command_args['output_format'], deduplicator, episode_store, projection, sampler)
+        else:
+            load_patients(patients, command_args['overlap_io'], sampler)
+            merge_care_episodes(patients)
+            score_comorbidities(patients)
+
+            # Year
+            make_care_episode_file(patients, 365, command_args['output_format'], episode_store, projection)
+
+            os.system('say "365 done."')
+
+            # 10 Years
+            make_care_episode_file(patients, 3650, command_args['output_format'], episode_store, projection)
+
+            # Half year
+            make_care_episode_file(patients, int(365 / 2), command_args['output_format'], episode_store, projection)
+
+            # 2 months
+            make_care_episode_file(patients, 60, command_args['output_format'], episode_store, projection, is_last_file=True)
+
+            make_patient_file(patients, command_args['output_format'], episode_store)
+
+    print_stage_summary()
+    print_unknown_dispositions()
+    run_information = { 'command_args': command_args, 'unknown_dispositions': dict(unknown_disposition_counts) }
+    if deduplicator:
+        deduplicator.print_duplicate_counts()
+        run_information['duplicate_rows'] = dict(deduplicator.duplicate_counts)
+    if isinstance(patients, PatientStore):
+        run_information['patient_store'] = patients.get_statistics()
+        patients.close()
+    if episode_store:
+        run_information['episode_store'] = episode_store.get_table_names()
+        episode_store.close()
+    write_run_report(command_args['run_report'], **run_information)
+
+    os.system('say "Script done."')
+
+
+if __name__ == '__main__':
+    main()
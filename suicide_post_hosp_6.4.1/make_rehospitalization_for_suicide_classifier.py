@@ -1,5 +1,7 @@
 from HospitalizationEpisode import get_medical_hospitalization_episodes
-from decision_tree_utilities import make_decision_tree_fit_statistics_and_picture
+from decision_tree_utilities import make_decision_tree_fit_statistics_and_picture, parse_command_args
+from output_sinks import read_rows
+from sampling import read_sample_manifest
 import csv
 
 use_suicidal_ideation = False
@@ -9,6 +11,14 @@ use_cdc_suicide_self_injury = True
 use_serious_mental_illness_only = False
 aggregated_days = 365
 
+# Format that make_analyzable_care_episodes.py wrote the analyzable care episodes in: 'csv', 'parquet' or 'arrow'.
+input_format = 'csv'
+
+# Sample manifest written by a sampled make_analyzable_care_episodes.py run, to classify the same patients from full
+# files, or None for every patient.
+sample_manifest = None
+sampler = read_sample_manifest(sample_manifest) if sample_manifest else None
+
 if not use_suicidal_ideation and not use_suicide_attempt and not use_suicide_attempt_broad and not use_cdc_suicide_self_injury:
     print('Must specify at least one type of suicide outcome... canceling run')
     exit()
@@ -19,7 +29,12 @@ predictors_labeled, predictors, outcomes, care_episode_indices = get_medical_hos
     use_suicidal_ideation=use_suicidal_ideation,
     use_suicide_attempt=use_suicide_attempt,
     use_suicide_attempt_broad=use_suicide_attempt_broad,
-    use_cdc_suicide_self_injury=use_cdc_suicide_self_injury
+    use_cdc_suicide_self_injury=use_cdc_suicide_self_injury,
+    input_format=input_format,
+    sampler=sampler,
+
+    # Other than dense, the getter builds the FeatureMatrix itself, without a dense float64 copy.
+    predictor_layout=parse_command_args()['predictor_layout']
 )
 
 # Build filename.
@@ -38,18 +53,34 @@ care_episode_index_results = make_decision_tree_fit_statistics_and_picture(
 )
 
 with open('analyzable_care_episodes_%ddays_classifier_results.csv' % aggregated_days, 'w') as output_file:
-    with open('analyzable_care_episodes_%ddays.csv' % aggregated_days, 'r', encoding='iso-8859-1') as input_file:
-        reader = csv.DictReader(input_file)
+    rows, input_column_names = read_rows('analyzable_care_episodes_%ddays' % aggregated_days, input_format)
+
+    # Result indices count the sampled episodes, so only their rows are written.
+    if sampler:
+        rows = [ row for row in rows if sampler.is_sampled(row['PatientID']) ]
+
+    # With --explain, each episode's out-of-fold probability and tree rules are written beside its result.
+    is_explained = any([ result.explanation is not None for result in care_episode_index_results ])
+    result_column_names = [ 'classifier_prediction_result' ]
+    if is_explained:
+        result_column_names += [ 'classifier_probability', 'classifier_explanation' ]
+    column_names = result_column_names + input_column_names
+    writer = csv.DictWriter(output_file, fieldnames=column_names)
+    writer.writeheader()
+
+    results = [ None ] * len(rows)
+    for result in care_episode_index_results:
+        results[result.index] = result
 
-        column_names = [ 'classifier_prediction_result' ] + reader.fieldnames
-        writer = csv.DictWriter(output_file, fieldnames=column_names)
-        writer.writeheader()
+    for index, row in enumerate(rows):
 
-        rows = list(reader)
-        results = [ '' ] * len(rows)
-        for result in care_episode_index_results:
-            results[result.index] = result.result
+        # Parquet and Arrow files read nulls as None, which the CSV files write as -9999.
+        if input_format != 'csv':
+            row = dict([ (name, -9999 if value is None else value) for name, value in row.items() ])
 
-        for index, row in enumerate(rows):
-            row['classifier_prediction_result'] = results[index]
-            writer.writerow(row)
\ No newline at end of file
+        result = results[index]
+        row['classifier_prediction_result'] = result.result if result else ''
+        if is_explained:
+            row['classifier_probability'] = result.probability if result else ''
+            row['classifier_explanation'] = result.explanation if result else ''
+        writer.writerow(row)
\ No newline at end of file
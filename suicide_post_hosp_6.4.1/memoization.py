@@ -0,0 +1,46 @@
+from functools import wraps
+
+# Every mutating method on Patient, CareEpisode and Encounter calls mark_modified(), which bumps this generation.
+# A memoized value is only reused if it was computed during the current generation, so any change anywhere
+# invalidates every cached value. All mutation happens during ingest and merging, so during CSV generation the
+# generation is stable and the caches are hit.
+generation = 0
+
+# Hit and miss counters for each memoized method, keyed by the method's qualified name.
+cache_statistics = {}
+
+def mark_modified():
+    global generation
+    generation += 1
+
+
+def memoized(method):
+    name = method.__qualname__
+    statistics = cache_statistics.setdefault(name, { 'hits': 0, 'misses': 0 })
+
+    @wraps(method)
+    def wrapper(self, *args):
+        key = (name, args)
+        cached = self.memoized_values.get(key)
+        if cached is not None and cached[0] == generation:
+            statistics['hits'] += 1
+            return cached[1]
+
+        statistics['misses'] += 1
+        value = method(self, *args)
+        self.memoized_values[key] = (generation, value)
+        return value
+    return wrapper
+
+
+def reset_cache_statistics():
+    for statistics in cache_statistics.values():
+        statistics['hits'] = 0
+        statistics['misses'] = 0
+
+
+def print_cache_statistics():
+    for name, statistics in sorted(cache_statistics.items()):
+        lookups = statistics['hits'] + statistics['misses']
+        if lookups:
+            print('%s: %d hits, %d misses (%.1f%% hit rate)' % (name, statistics['hits'], statistics['misses'], 100.0 * statistics['hits'] / lookups))
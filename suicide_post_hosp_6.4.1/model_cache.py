@@ -0,0 +1,90 @@
+'''
+    A content-addressed cache of fitted trees and their fold predictions on disk. A fit is keyed by a hash of the
+    predictors and outcomes, the train and test row indices, the classifier parameters and the scikit-learn version, so a
+    rerun on the same data with the same parameters, e.g. to redraw the tree or recompute metrics, loads every fit
+    instead of refitting, and any change to the data or parameters misses the cache.
+'''
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import numpy
+from os import path
+
+def hash_array(hasher, values):
+    values = numpy.ascontiguousarray(values)
+    hasher.update(repr((values.dtype.str, values.shape)).encode('utf-8'))
+    hasher.update(values.tobytes())
+
+
+def make_data_key(predictors, outcomes):
+
+    '''
+        The hash of the predictors (an array, or a FeatureMatrix) and outcomes, computed once per data set.
+    '''
+    hasher = hashlib.sha256()
+    if hasattr(predictors, 'update_hash'):
+        predictors.update_hash(hasher)
+    else:
+        hash_array(hasher, predictors)
+    hash_array(hasher, numpy.asarray(outcomes, dtype=float))
+    return hasher.hexdigest()
+
+
+class ModelCache:
+    def __init__(self, directory='model_cache'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, data_key, train_index, test_index, parameters):
+        from sklearn import __version__ as sklearn_version
+
+        hasher = hashlib.sha256()
+        hasher.update(data_key.encode('utf-8'))
+        for indices in [ train_index, test_index ]:
+            hash_array(hasher, numpy.asarray(indices, dtype=numpy.int64))
+        hasher.update(json.dumps(parameters, sort_keys=True).encode('utf-8'))
+        hasher.update(sklearn_version.encode('utf-8'))
+        return hasher.hexdigest()
+
+    def get_filepath(self, key):
+        return path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        try:
+            with open(self.get_filepath(key), 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, key, value):
+
+        # Write to a temporary file and rename it, so a reader never sees a partly written entry.
+        file_descriptor, temporary_filepath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as cache_file:
+                pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_filepath, self.get_filepath(key))
+        except BaseException:
+            os.remove(temporary_filepath)
+            raise
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def get_statistics(self):
+        return { 'directory': self.directory, 'hits': self.hits, 'misses': self.misses }
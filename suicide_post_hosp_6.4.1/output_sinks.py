@@ -0,0 +1,156 @@
+import csv
+from pipelined_io import ThreadedSink
+
+# Whether make_sink writes rows from a background thread, overlapping the writes with building the next rows.
+background_writer = False
+
+output_format_extensions = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+class Sink:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+class CsvSink(Sink):
+    def __init__(self, filepath, column_names, column_types=None):
+        self.file = open(filepath, 'w')
+        self.writer = csv.DictWriter(self.file, fieldnames=column_names)
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarSink(Sink):
+
+    '''
+        Buffers rows as typed columns and writes them in batches of rows_per_batch rows. -9999 (our missing value)
+        is written as a null rather than as a value.
+    '''
+    def __init__(self, filepath, column_names, column_types=None, rows_per_batch=65536, compression='zstd'):
+        import pyarrow
+
+        self.pyarrow = pyarrow
+        self.filepath = filepath
+        self.column_names = list(column_names)
+        self.rows_per_batch = rows_per_batch
+        self.compression = compression
+
+        # Columns are 'string', 'float', 'int' or 'indicator' (0/1). Anything not in column_types is an 'int'.
+        column_types = column_types or {}
+        arrow_types = {
+            'string': pyarrow.string(),
+            'float': pyarrow.float64(),
+            'int': pyarrow.int32(),
+            'indicator': pyarrow.int8(),
+        }
+        self.schema = pyarrow.schema([ (name, arrow_types[column_types.get(name, 'int')]) for name in self.column_names ])
+        self.columns = [ [] for name in self.column_names ]
+        self.number_of_buffered_rows = 0
+        self.open_writer()
+
+    def write(self, row):
+        for name, values in zip(self.column_names, self.columns):
+            value = row[name]
+            values.append(None if value == -9999 else value)
+
+        self.number_of_buffered_rows += 1
+        if self.number_of_buffered_rows >= self.rows_per_batch:
+            self.flush()
+
+    def flush(self):
+        if self.number_of_buffered_rows:
+            arrays = [ self.pyarrow.array(values, type=field.type) for values, field in zip(self.columns, self.schema) ]
+            self.write_batch(self.pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+            self.columns = [ [] for name in self.column_names ]
+            self.number_of_buffered_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ParquetSink(ColumnarSink):
+    def open_writer(self):
+        import pyarrow.parquet
+        self.writer = pyarrow.parquet.ParquetWriter(self.filepath, self.schema, compression=self.compression)
+
+    def write_batch(self, batch):
+        self.writer.write_table(self.pyarrow.Table.from_batches([ batch ]), row_group_size=self.rows_per_batch)
+
+
+class ArrowSink(ColumnarSink):
+    def open_writer(self):
+        import pyarrow.ipc
+        options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+        self.writer = pyarrow.ipc.new_file(self.filepath, self.schema, options=options)
+
+    def write_batch(self, batch):
+        self.writer.write_batch(batch)
+
+
+class TeeSink(Sink):
+
+    '''
+        Writes every row to each of sinks.
+    '''
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, row):
+        for sink in self.sinks:
+            sink.write(row)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+output_format_to_sink = {
+    'csv': CsvSink,
+    'parquet': ParquetSink,
+    'arrow': ArrowSink,
+}
+
+def make_sink(output_format, filename, column_names, column_types=None):
+    if output_format not in output_format_to_sink:
+        raise ValueError('Unknown output format %s, expected one of %s' % (output_format, ', '.join(output_format_to_sink)))
+    filepath = filename + output_format_extensions[output_format]
+    sink = output_format_to_sink[output_format](filepath, column_names, column_types)
+    return ThreadedSink(sink) if background_writer else sink
+
+
+def read_rows(filename, input_format='csv', columns=None):
+
+    '''
+        Returns the rows of a file written by one of the sinks above as a list of dicts, along with the column names.
+        Parquet and Arrow files only read |columns| (if given), and nulls are returned as None. CSV rows are returned
+        as strings.
+    '''
+    filepath = filename + output_format_extensions[input_format]
+    if input_format == 'csv':
+        with open(filepath, 'r', encoding='iso-8859-1') as input_file:
+            reader = csv.DictReader(input_file)
+            return list(reader), reader.fieldnames
+
+    if input_format == 'parquet':
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(filepath, columns=columns)
+    elif input_format == 'arrow':
+        import pyarrow.ipc
+        table = pyarrow.ipc.open_file(filepath).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    else:
+        raise ValueError('Unknown input format %s, expected one of %s' % (input_format, ', '.join(output_format_extensions)))
+    return table.to_pylist(), table.column_names
@@ -0,0 +1,159 @@
+import os
+import pickle
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import memoization
+
+class PatientStore(MutableMapping):
+
+    '''
+        A dict of patient id to Patient that keeps patients in a SQLite file, so cohorts larger than memory can be
+        processed. Recently used patients are kept in memory, up to roughly memory_budget_mb, and the least recently
+        used are pickled to the file as the budget is exceeded. Iteration follows insertion order, like a dict.
+
+        A patient returned by the store may be changed in place, as the loaders and merge do. It is only written back
+        if something was modified (see memoization.mark_modified) while it was in memory, so reading patients to build
+        the analyzable files does not write anything.
+    '''
+    def __init__(self, filepath=None, memory_budget_mb=2048, initial_patient_bytes=64 * 1024, in_memory_expansion=3.5):
+        self.is_temporary = filepath is None
+        if self.is_temporary:
+            file_descriptor, filepath = tempfile.mkstemp(suffix='.sqlite', prefix='patients_')
+            os.close(file_descriptor)
+        self.filepath = filepath
+
+        # The file is scratch space, so any existing contents are replaced, and durability is traded for speed.
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('DROP TABLE IF EXISTS patients')
+
+        # The id column has no type, so ids keep theirs, e.g. interned integer ids are not turned into text.
+        self.connection.execute('CREATE TABLE patients (position INTEGER PRIMARY KEY, id UNIQUE NOT NULL, patient BLOB)')
+
+        # Patient id to (patient, generation when it was last written or read), least recently used first.
+        # A generation of None means the patient has never been written.
+        self.cache = OrderedDict()
+        self.number_of_patients = 0
+
+        # The in-memory size of a patient is estimated from its pickled size, averaged over every patient written or read.
+        self.memory_budget_bytes = memory_budget_mb * 1024 * 1024
+        self.in_memory_expansion = in_memory_expansion
+        self.average_patient_bytes = float(initial_patient_bytes)
+        self.measured_patients = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.writes_since_commit = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_cache_capacity(self):
+        return max(1, int(self.memory_budget_bytes / (self.average_patient_bytes * self.in_memory_expansion)))
+
+    def measure(self, blob):
+        self.measured_patients += 1
+        self.average_patient_bytes += (len(blob) - self.average_patient_bytes) / self.measured_patients
+
+    def write(self, patient_id, patient):
+        blob = pickle.dumps(patient, pickle.HIGHEST_PROTOCOL)
+        self.measure(blob)
+        self.connection.execute('UPDATE patients SET patient = ? WHERE id = ?', (blob, patient_id))
+        self.writes += 1
+        self.writes_since_commit += 1
+        if self.writes_since_commit >= 10000:
+            self.connection.commit()
+            self.writes_since_commit = 0
+
+    def evict(self):
+        while len(self.cache) > self.get_cache_capacity():
+            patient_id, (patient, generation) = self.cache.popitem(last=False)
+            if generation != memoization.generation:
+                self.write(patient_id, patient)
+
+    def __getitem__(self, patient_id):
+        cached = self.cache.get(patient_id)
+        if cached is not None:
+            self.hits += 1
+            self.cache.move_to_end(patient_id)
+            return cached[0]
+
+        self.misses += 1
+        result = self.connection.execute('SELECT patient FROM patients WHERE id = ?', (patient_id,)).fetchone()
+        if result is None:
+            raise KeyError(patient_id)
+        self.measure(result[0])
+        patient = pickle.loads(result[0])
+        self.cache[patient_id] = (patient, memoization.generation)
+        self.evict()
+        return patient
+
+    def __setitem__(self, patient_id, patient):
+        if patient_id not in self:
+            self.connection.execute('INSERT INTO patients (id) VALUES (?)', (patient_id,))
+            self.number_of_patients += 1
+        self.cache[patient_id] = (patient, None)
+        self.cache.move_to_end(patient_id)
+        self.evict()
+
+    def __delitem__(self, patient_id):
+        if patient_id not in self:
+            raise KeyError(patient_id)
+        self.cache.pop(patient_id, None)
+        self.connection.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
+        self.number_of_patients -= 1
+
+    def __contains__(self, patient_id):
+        if patient_id in self.cache:
+            return True
+        return self.connection.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,)).fetchone() is not None
+
+    def __iter__(self):
+
+        # Read ids in batches rather than holding a cursor open, since patients are written back while iterating.
+        last_position = 0
+        while True:
+            batch = self.connection.execute(
+                'SELECT position, id FROM patients WHERE position > ? ORDER BY position LIMIT 4096', (last_position,)
+            ).fetchall()
+            if not batch:
+                return
+            for last_position, patient_id in batch:
+                yield patient_id
+
+    def __len__(self):
+        return self.number_of_patients
+
+    def flush(self):
+        for patient_id, (patient, generation) in self.cache.items():
+            if generation != memoization.generation:
+                self.write(patient_id, patient)
+                self.cache[patient_id] = (patient, memoization.generation)
+        self.connection.commit()
+        self.writes_since_commit = 0
+
+    def close(self):
+        if not self.is_temporary:
+            self.flush()
+        self.connection.close()
+        self.cache.clear()
+        if self.is_temporary:
+            os.remove(self.filepath)
+
+    def get_statistics(self):
+        return {
+            'patients': self.number_of_patients,
+            'cached_patients': len(self.cache),
+            'cache_capacity': self.get_cache_capacity(),
+            'average_patient_bytes': self.average_patient_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+        }
@@ -0,0 +1,221 @@
+'''
+    Ranks predictors by permutation importance: how much the out-of-fold AUC of the cross validated trees drops when a
+    predictor's values are shuffled among each fold's test rows. The fold trees are the ones cross validation fits, and
+    are loaded from the model cache when an earlier run, or an experiment_runner.py run of the same outcome and cohort
+    without --exclude_medicines_and_diagnoses, fit them on the same predictors.
+
+    A tree only reads the few predictors it splits on, so predictors no fold tree uses have an importance of 0 and
+    are not permuted, and predictions are made by walking each tree over just the columns it uses. A task permutes one
+    predictor once (one repeat) across every fold, copying only that column. Tasks run across a process pool whose
+    workers share the fold columns, inherited on fork.
+
+    A table ranked with --exclude_medicines_and_diagnoses can feed the feature selection of get_bipolar_episodes,
+    which only has those predictors, e.g.
+
+        predictor_names = care_episodes[0].get_predictors(exclude_medicines_and_diagnoses=True)
+        get_bipolar_episodes(..., predictors_to_use=read_ranked_predictors('permutation_importance.csv', 20, predictor_names))
+'''
+import argparse
+import csv
+import multiprocessing
+import os
+import numpy
+from multiprocessing.dummy import Pool as ThreadPool
+from sklearn.model_selection import KFold
+from evaluation import compute_auc
+from explanations import get_node_positive_probabilities
+from feature_matrix import read_predictor_columns
+from model_cache import ModelCache, make_data_key
+from HospitalizationEpisode import load_episodes
+from sampling import read_sample_manifest
+from experiment_runner import outcome_to_flags, cohort_to_filter, default_experiment, make_experiment, select_cohort, impute_predictors
+from decision_tree_utilities import fit_and_evaluate_fold
+from instrumentation import stage, print_stage_summary, write_run_report
+
+importance_column_names = [ 'rank', 'predictor', 'importance', 'importance_std', 'baseline_auc', 'folds_using' ]
+
+def get_used_features(decision_tree):
+    tree = decision_tree.tree_
+    return set(tree.feature[tree.children_left != -1].tolist())
+
+
+def predict_positive_probabilities(decision_tree, columns, number_of_rows, column_overrides=None):
+
+    '''
+        decision_tree.predict_proba(...) of class 1 for number_of_rows rows, up to rounding, where columns maps each
+        feature index the tree uses to its float32 values, and column_overrides replaces some of them. A tree that
+        never saw class 1 predicts 0. Children always come after their parent in the tree's node order, so one pass
+        over the nodes routes every row to its leaf.
+    '''
+    tree = decision_tree.tree_
+    column_overrides = column_overrides or {}
+    node_of_row = numpy.zeros(number_of_rows, dtype=numpy.intp)
+    for node in range(tree.node_count):
+        left_child = tree.children_left[node]
+        if left_child == -1:
+            continue
+        rows = numpy.flatnonzero(node_of_row == node)
+        feature = tree.feature[node]
+        values = column_overrides.get(feature, columns[feature])[rows]
+
+        # scikit-learn compares the float32 value with the float64 threshold in float64.
+        is_left = values.astype(float) <= tree.threshold[node]
+        node_of_row[rows[is_left]] = left_child
+        node_of_row[rows[~is_left]] = tree.children_right[node]
+
+    return get_node_positive_probabilities(decision_tree)[node_of_row]
+
+
+# The folds being permuted, set in each worker process by set_importance_data.
+importance_data = None
+
+def set_importance_data(data):
+    global importance_data
+    importance_data = data
+
+
+def compute_permuted_auc(task):
+    feature, repeat = task
+    probabilities = []
+    for fold_index, fold in enumerate(importance_data['folds']):
+        column_overrides = None
+        if feature in fold['columns']:
+            random_state = numpy.random.RandomState([ importance_data['seed'], feature, repeat, fold_index ])
+            column_overrides = { feature: random_state.permutation(fold['columns'][feature]) }
+        probabilities.append(predict_positive_probabilities(fold['decision_tree'], fold['columns'], fold['number_of_rows'], column_overrides))
+    return feature, repeat, compute_auc(importance_data['labels'], numpy.concatenate(probabilities))
+
+
+def compute_permutation_importance(predictors, outcomes, fold_results, test_indices, number_of_repeats=5, seed=314, processes=None):
+
+    '''
+        Returns a row for each of predictors.column_names, ranked by importance, the mean drop in out-of-fold AUC over
+        number_of_repeats permutations. predictors is a compact FeatureMatrix, and fold_results are the
+        fit_and_evaluate_fold results of the folds whose test rows are test_indices.
+    '''
+    folds = []
+    used_features = set()
+    for fold_result, test_index in zip(fold_results, test_indices):
+        decision_tree = fold_result['decision_tree']
+        fold_features = sorted(get_used_features(decision_tree))
+        fold_rows = predictors[test_index]
+        folds.append({
+            'decision_tree': decision_tree,
+            'columns': dict([ (feature, numpy.ascontiguousarray(fold_rows[:, feature])) for feature in fold_features ]),
+            'number_of_rows': len(test_index),
+        })
+        used_features.update(fold_features)
+    labels = numpy.concatenate([ outcomes[test_index] for test_index in test_indices ])
+
+    data = { 'folds': folds, 'labels': labels, 'seed': seed }
+    set_importance_data(data)
+    baseline_auc = compute_auc(labels, numpy.concatenate([ predict_positive_probabilities(fold['decision_tree'], fold['columns'], fold['number_of_rows']) for fold in folds ]))
+
+    tasks = [ (feature, repeat) for feature in sorted(used_features) for repeat in range(number_of_repeats) ]
+    processes = min(processes or os.cpu_count() or 1, len(tasks))
+    if processes <= 1:
+        permuted_aucs = [ compute_permuted_auc(task) for task in tasks ]
+    else:
+
+        # Forked workers share the fold columns with this process instead of receiving a pickled copy.
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing
+        with context.Pool(processes, initializer=set_importance_data, initargs=(data,)) as pool:
+            permuted_aucs = pool.map(compute_permuted_auc, tasks, chunksize=max(1, len(tasks) // (processes * 4)))
+
+    feature_to_drops = {}
+    for feature, repeat, permuted_auc in permuted_aucs:
+        feature_to_drops.setdefault(feature, []).append(baseline_auc - permuted_auc)
+
+    rows = []
+    for feature, name in enumerate(predictors.column_names):
+        drops = feature_to_drops.get(feature, [ 0.0 ])
+        rows.append({
+            'predictor': name,
+            'importance': float(numpy.mean(drops)),
+            'importance_std': float(numpy.std(drops)),
+            'baseline_auc': baseline_auc,
+            'folds_using': sum([ 1 for fold in folds if feature in fold['columns'] ]),
+        })
+    rows.sort(key=lambda row: (-row['importance'], row['predictor']))
+    for rank, row in enumerate(rows):
+        row['rank'] = rank + 1
+    return rows
+
+
+def write_importance_table(filepath, rows):
+    with open(filepath, 'w', newline='') as importance_file:
+        writer = csv.DictWriter(importance_file, fieldnames=importance_column_names)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_ranked_predictors(filepath, number_of_predictors=None, predictor_names=None):
+
+    '''
+        The names of the predictors with a positive importance, most important first, at most number_of_predictors.
+        If predictor_names, the predictors of the episodes the selection is for, is given, every name in the table
+        must be one of them, since a predictor missing there would be dropped from the selection without notice.
+    '''
+    with open(filepath, 'r', newline='') as importance_file:
+        rows = list(csv.DictReader(importance_file))
+    if predictor_names is not None:
+        unknown_predictors = sorted(set([ row['predictor'] for row in rows ]) - set(predictor_names))
+        if unknown_predictors:
+            raise ValueError('%s ranks predictors the episodes do not have, e.g. %s; rank them with the same predictors' % (filepath, ', '.join(unknown_predictors[:5])))
+    rows = [ row for row in rows if float(row['importance']) > 0 ]
+    rows.sort(key=lambda row: int(row['rank']))
+    return [ row['predictor'] for row in rows ][:number_of_predictors]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank predictors by permutation importance over the cross validated trees')
+    parser.add_argument('--aggregated_days', default=365, type=int, help='which analyzable_care_episodes_<days>days file to read')
+    parser.add_argument('--input_format', default='csv', choices=['csv', 'parquet', 'arrow'], help='format of the analyzable care episodes file')
+    parser.add_argument('--outcome', default=default_experiment['outcome'], choices=list(outcome_to_flags), help='outcome to classify')
+    parser.add_argument('--cohort', default=default_experiment['cohort'], choices=list(cohort_to_filter), help='cohort to classify')
+    parser.add_argument('--cv_fold', default=default_experiment['cv_fold'], type=int, help='specifies fold number for cross-validation')
+    parser.add_argument('--balancing', default=default_experiment['balancing'], help='specifies the tree class_weight, or none')
+    parser.add_argument('--random_seed', default=default_experiment['random_seed'], type=int, help='randomization seed')
+    parser.add_argument('--max_leaf_nodes', default=default_experiment['max_leaf_nodes'], type=int, help='max # of leaf nodes')
+    parser.add_argument('--repeats', default=5, type=int, help='permutations of each predictor')
+    parser.add_argument('--processes', type=int, help='worker processes, by default one per CPU')
+    parser.add_argument('--model_cache', help='directory caching fitted trees and fold predictions, so reruns with the same data and parameters skip the fits')
+    parser.add_argument('--exclude_medicines_and_diagnoses', action='store_true', help='rank only the predictors get_bipolar_episodes selects from, without medicines and diagnoses')
+    parser.add_argument('--sample_manifest', help='sample manifest written by make_analyzable_care_episodes.py, to only classify the care episodes of its patients')
+    parser.add_argument('--importance', default='permutation_importance.csv', help='ranked table to write')
+    command_args = vars(parser.parse_args())
+    experiment = make_experiment(outcome=command_args['outcome'], cohort=command_args['cohort'], cv_fold=command_args['cv_fold'],
+        balancing=command_args['balancing'], random_seed=command_args['random_seed'], max_leaf_nodes=command_args['max_leaf_nodes'])
+
+    sampler = read_sample_manifest(command_args['sample_manifest']) if command_args['sample_manifest'] else None
+    care_episodes = load_episodes(command_args['aggregated_days'], command_args['input_format'], sampler)
+    with stage('Impute %s %s' % (experiment['outcome'], experiment['cohort'])) as report:
+        column_names, columns = read_predictor_columns((episode.get_predictors(command_args['exclude_medicines_and_diagnoses']) for episode in care_episodes), len(care_episodes))
+        indices, outcomes = select_cohort(care_episodes, experiment['outcome'], experiment['cohort'])
+        predictors = impute_predictors(column_names, columns, indices, 'compact')
+        report['rows'] = len(indices)
+
+    model_cache = ModelCache(command_args['model_cache']) if command_args['model_cache'] else None
+    data_key = make_data_key(predictors, outcomes) if model_cache else None
+    folds = KFold(n_splits=experiment['cv_fold'], shuffle=True, random_state=experiment['random_seed'])
+    splits = list(folds.split(predictors))
+    with stage('Cross validation fits', rows=len(predictors) * experiment['cv_fold']):
+        pool = ThreadPool(10)
+        fold_results = pool.map(lambda split: fit_and_evaluate_fold(predictors, outcomes, split[0], split[1], experiment['balancing'],
+            experiment['random_seed'], experiment['max_leaf_nodes'], model_cache, data_key), splits)
+        pool.close()
+
+    with stage('Permutation importance', rows=len(predictors) * command_args['repeats']):
+        rows = compute_permutation_importance(predictors, outcomes, fold_results, [ test_index for _, test_index in splits ],
+            command_args['repeats'], experiment['random_seed'], command_args['processes'])
+    write_importance_table(command_args['importance'], rows)
+
+    print_stage_summary()
+    run_information = { 'command_args': command_args }
+    if model_cache:
+        run_information['model_cache'] = model_cache.get_statistics()
+    write_run_report(command_args['importance'].rsplit('.', 1)[0] + '_run_report.json', **run_information)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+'''
+    Overlaps file I/O with computation. prefetch reads and parses source files in a background thread while the main
+    thread applies rows to patients, and ThreadedSink hands rows to a background thread that writes them. Both pass
+    rows through bounded queues in batches, so memory stays bounded and the queue overhead is paid once per batch.
+    Reads and writes release the GIL, which hides disk latency on slow or network-mounted storage.
+'''
+import itertools
+import queue
+import threading
+
+# Queue items marking the end of one iterable, and a failure in the background thread.
+end_of_iterable = object()
+
+class BackgroundError:
+    def __init__(self, error):
+        self.error = error
+
+
+def put_unless_stopped(item_queue, item, stop):
+    while not stop.is_set():
+        try:
+            item_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def read_ahead(iterables, item_queue, rows_per_batch, stop):
+    try:
+        for iterable in iterables:
+            iterator = iter(iterable)
+            while True:
+                batch = list(itertools.islice(iterator, rows_per_batch))
+                if not batch:
+                    break
+                if not put_unless_stopped(item_queue, batch, stop):
+                    return
+            if not put_unless_stopped(item_queue, end_of_iterable, stop):
+                return
+    except BaseException as error:
+        put_unless_stopped(item_queue, BackgroundError(error), stop)
+
+
+def iterate_queued_rows(item_queue):
+    while True:
+        item = item_queue.get()
+        if item is end_of_iterable:
+            return
+        if isinstance(item, BackgroundError):
+            raise item.error
+        for row in item:
+            yield row
+
+
+def prefetch(iterables, batches_ahead=64, rows_per_batch=1024):
+
+    '''
+        Yields an iterator over each of iterables, in order, while a background thread reads up to batches_ahead
+        batches ahead, continuing into the next iterable once one is read. Iterables should be lazy (e.g. generators)
+        so the reading happens in the background, e.g. prefetch([ read_source_rows(source_file) for ... ]).
+        An error while reading is raised by the iterator that would have returned the failed rows.
+    '''
+    item_queue = queue.Queue(maxsize=batches_ahead)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_ahead, args=(iterables, item_queue, rows_per_batch, stop), daemon=True)
+    reader.start()
+    try:
+        for _ in iterables:
+            rows = iterate_queued_rows(item_queue)
+            yield rows
+
+            # Skip whatever the caller didn't read, so the next iterator starts at the next iterable.
+            for _ in rows:
+                pass
+    finally:
+        stop.set()
+        reader.join()
+
+
+class ThreadedSink:
+
+    '''
+        Wraps a sink (see output_sinks) so rows are written by a background thread. Rows are queued in batches of
+        rows_per_batch, with at most batches_ahead batches waiting. An error while writing stops the writes, and is
+        raised once, by the next write or by close.
+    '''
+    def __init__(self, sink, batches_ahead=4, rows_per_batch=256):
+        self.sink = sink
+        self.rows_per_batch = rows_per_batch
+        self.batch = []
+        self.error = None
+        self.is_error_raised = False
+        self.item_queue = queue.Queue(maxsize=batches_ahead)
+        self.writer = threading.Thread(target=self.write_batches, daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def write_batches(self):
+        while True:
+            batch = self.item_queue.get()
+            if batch is end_of_iterable:
+                return
+            if self.error is None:
+                try:
+                    for row in batch:
+                        self.sink.write(row)
+                except BaseException as error:
+                    self.error = error
+
+    def raise_error(self):
+        if self.error is not None and not self.is_error_raised:
+            self.is_error_raised = True
+            raise self.error
+
+    def write(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.rows_per_batch:
+            self.raise_error()
+            self.item_queue.put(self.batch)
+            self.batch = []
+
+    def close(self):
+        if self.batch:
+            self.item_queue.put(self.batch)
+            self.batch = []
+        self.item_queue.put(end_of_iterable)
+        self.writer.join()
+        self.sink.close()
+        self.raise_error()
@@ -0,0 +1,196 @@
+'''
+    Runs a reference implementation of make_analyzable_care_episodes.py (by default, the code at a git ref) and a
+    candidate implementation (by default, this directory) on the same synthetic cohorts, then diffs every analyzable
+    file cell by cell. Any mismatch fails the run, so performance work can show that it did not change the features.
+    Both implementations use this directory's icd_code_maps, so only code differences are compared.
+'''
+import argparse
+import csv
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from os import path
+from synthetic_cohort import generate_cohort
+
+module_directory = path.dirname(path.abspath(__file__))
+
+def export_git_ref(ref, destination):
+    repository_root = subprocess.check_output([ 'git', 'rev-parse', '--show-toplevel' ], cwd=module_directory, universal_newlines=True).strip()
+    prefix = subprocess.check_output([ 'git', 'rev-parse', '--show-prefix' ], cwd=module_directory, universal_newlines=True).strip()
+    os.makedirs(destination, exist_ok=True)
+    archive = subprocess.Popen([ 'git', 'archive', ref, prefix ], cwd=repository_root, stdout=subprocess.PIPE)
+    subprocess.check_call([ 'tar', '-x', '-C', destination ], stdin=archive.stdout)
+    if archive.wait():
+        raise RuntimeError('git archive of %s failed' % ref)
+    return path.join(destination, prefix)
+
+
+def run_implementation(source_directory, run_directory, cohort_directory, extra_args):
+    if path.exists(run_directory):
+        shutil.rmtree(run_directory)
+    os.makedirs(run_directory)
+    for filepath in glob.glob(path.join(source_directory, '*.py')):
+        shutil.copy(filepath, run_directory)
+    shutil.copytree(path.join(module_directory, 'icd_code_maps'), path.join(run_directory, 'icd_code_maps'))
+    os.symlink(path.abspath(cohort_directory), path.join(run_directory, 'source_data'))
+
+    start_time = time.perf_counter()
+    with open(path.join(run_directory, 'run.log'), 'w') as log_file:
+        return_code = subprocess.call([ sys.executable, 'make_analyzable_care_episodes.py' ] + extra_args, cwd=run_directory, stdout=log_file, stderr=subprocess.STDOUT)
+    wall_time = time.perf_counter() - start_time
+    if return_code:
+        raise RuntimeError('%s failed, see %s' % (source_directory, path.join(run_directory, 'run.log')))
+    return wall_time
+
+
+def load_rows_by_key(filepath):
+    with open(filepath, 'r', encoding='iso-8859-1') as input_file:
+        reader = csv.DictReader(input_file)
+        key_columns = [ column for column in [ 'PatientID', 'CareEpisodeDate' ] if column in reader.fieldnames ]
+        rows = {}
+        duplicate_keys = 0
+        for row in reader:
+            key = tuple(row[column] for column in key_columns)
+            if key in rows:
+                duplicate_keys += 1
+            rows[key] = row
+    return reader.fieldnames, rows, duplicate_keys
+
+
+def values_match(reference_value, candidate_value, tolerance):
+    if reference_value == candidate_value:
+        return True
+
+    # Floats (charges, pain scores) may differ in the last digits if they were summed in another order.
+    try:
+        reference_float = float(reference_value)
+        candidate_float = float(candidate_value)
+    except (TypeError, ValueError):
+        return False
+    return abs(reference_float - candidate_float) <= tolerance * max(1.0, abs(reference_float))
+
+
+def compare_files(reference_filepath, candidate_filepath, tolerance, examples_per_column):
+    report = { 'file': path.basename(reference_filepath) }
+    if not path.exists(candidate_filepath):
+        report['error'] = 'candidate did not write this file'
+        report['mismatches'] = 1
+        return report
+
+    reference_columns, reference_rows, reference_duplicates = load_rows_by_key(reference_filepath)
+    candidate_columns, candidate_rows, candidate_duplicates = load_rows_by_key(candidate_filepath)
+
+    report['rows'] = len(reference_rows)
+    report['missing_columns'] = [ column for column in reference_columns if column not in candidate_columns ]
+    report['extra_columns'] = [ column for column in candidate_columns if column not in reference_columns ]
+    report['column_order_matches'] = reference_columns == candidate_columns
+    report['missing_rows'] = [ list(key) for key in reference_rows if key not in candidate_rows ][:examples_per_column]
+    report['number_of_missing_rows'] = sum(1 for key in reference_rows if key not in candidate_rows)
+    report['number_of_extra_rows'] = sum(1 for key in candidate_rows if key not in reference_rows)
+    report['duplicate_keys'] = { 'reference': reference_duplicates, 'candidate': candidate_duplicates }
+
+    column_mismatches = {}
+    shared_columns = [ column for column in reference_columns if column in candidate_columns ]
+    for key, reference_row in reference_rows.items():
+        candidate_row = candidate_rows.get(key)
+        if candidate_row is None:
+            continue
+        for column in shared_columns:
+            if not values_match(reference_row[column], candidate_row[column], tolerance):
+                mismatch = column_mismatches.setdefault(column, { 'count': 0, 'examples': [] })
+                mismatch['count'] += 1
+                if len(mismatch['examples']) < examples_per_column:
+                    mismatch['examples'].append({ 'key': list(key), 'reference': reference_row[column], 'candidate': candidate_row[column] })
+    report['column_mismatches'] = column_mismatches
+
+    report['mismatches'] = (
+        len(report['missing_columns']) + len(report['extra_columns']) + (0 if report['column_order_matches'] else 1) +
+        report['number_of_missing_rows'] + report['number_of_extra_rows'] +
+        sum(mismatch['count'] for mismatch in column_mismatches.values())
+    )
+    return report
+
+
+def print_file_report(report):
+    print('    %s: %s rows, %d mismatches' % (report['file'], report.get('rows', '?'), report['mismatches']))
+    if 'error' in report:
+        print('        %s' % report['error'])
+        return
+    if report['missing_columns'] or report['extra_columns']:
+        print('        missing columns: %s, extra columns: %s' % (report['missing_columns'], report['extra_columns']))
+    if not report['column_order_matches']:
+        print('        column order differs')
+    if report['number_of_missing_rows'] or report['number_of_extra_rows']:
+        print('        %d missing rows, %d extra rows' % (report['number_of_missing_rows'], report['number_of_extra_rows']))
+    for column, mismatch in sorted(report['column_mismatches'].items(), key=lambda item: -item[1]['count']):
+        example = mismatch['examples'][0]
+        print('        %-50s %8d cells, e.g. %s: %s != %s' % (column, mismatch['count'], example['key'], example['reference'], example['candidate']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that a candidate implementation writes the same analyzable files as a reference implementation')
+    parser.add_argument('--reference_ref', default='HEAD', help='git ref of the reference implementation')
+    parser.add_argument('--reference_directory', default=None, help='directory of the reference implementation, instead of --reference_ref')
+    parser.add_argument('--candidate_directory', default=module_directory, help='directory of the candidate implementation')
+    parser.add_argument('--candidate_args', nargs=argparse.REMAINDER, default=[], help='arguments for the candidate make_analyzable_care_episodes.py, must be last')
+    parser.add_argument('--patients', default=2000, type=int, help='number of patients in each synthetic cohort')
+    parser.add_argument('--episodes_per_patient', default=4, type=float, help='mean number of care episodes per patient')
+    parser.add_argument('--random_seeds', nargs='+', default=[314], type=int, help='one synthetic cohort is generated per seed')
+    parser.add_argument('--work_directory', default='regression_harness', help='directory for the cohorts and both implementations\' outputs')
+    parser.add_argument('--tolerance', default=1e-9, type=float, help='relative tolerance for numeric cells')
+    parser.add_argument('--examples_per_column', default=5, type=int, help='number of mismatching cells to report per column')
+    parser.add_argument('--report', default='regression_report.json', help='JSON file to write the comparison to')
+    command_args = vars(parser.parse_args())
+
+    work_directory = path.abspath(command_args['work_directory'])
+    if command_args['reference_directory']:
+        reference_directory = path.abspath(command_args['reference_directory'])
+    else:
+        reference_directory = export_git_ref(command_args['reference_ref'], path.join(work_directory, 'reference_source'))
+    candidate_directory = path.abspath(command_args['candidate_directory'])
+
+    report = { 'command_args': command_args, 'cohorts': [] }
+    total_mismatches = 0
+    for seed in command_args['random_seeds']:
+        cohort_directory = path.join(work_directory, 'cohort_%d_patients_seed_%d' % (command_args['patients'], seed))
+        if not path.exists(path.join(cohort_directory, 'Encounters_5.2018.csv')):
+            generate_cohort(cohort_directory, command_args['patients'], command_args['episodes_per_patient'], seed)
+
+        reference_run_directory = path.join(work_directory, 'reference_seed_%d' % seed)
+        candidate_run_directory = path.join(work_directory, 'candidate_seed_%d' % seed)
+        print('Running reference on seed %d' % seed)
+        reference_time = run_implementation(reference_directory, reference_run_directory, cohort_directory, [])
+        print('Running candidate on seed %d' % seed)
+        candidate_time = run_implementation(candidate_directory, candidate_run_directory, cohort_directory, command_args['candidate_args'])
+
+        cohort_report = {
+            'seed': seed,
+            'reference_seconds': reference_time,
+            'candidate_seconds': candidate_time,
+            'speedup': reference_time / candidate_time,
+            'files': [],
+        }
+        print('Seed %d: reference %.1f s, candidate %.1f s, %.2fx speedup' % (seed, reference_time, candidate_time, cohort_report['speedup']))
+        for reference_filepath in sorted(glob.glob(path.join(reference_run_directory, 'analyzable_*.csv'))):
+            candidate_filepath = path.join(candidate_run_directory, path.basename(reference_filepath))
+            file_report = compare_files(reference_filepath, candidate_filepath, command_args['tolerance'], command_args['examples_per_column'])
+            print_file_report(file_report)
+            cohort_report['files'].append(file_report)
+            total_mismatches += file_report['mismatches']
+        report['cohorts'].append(cohort_report)
+
+    report['total_mismatches'] = total_mismatches
+    with open(command_args['report'], 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+
+    print('Equivalent' if total_mismatches == 0 else '%d mismatches, see %s' % (total_mismatches, command_args['report']))
+    if total_mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+    Drops rows repeated within a source file, e.g. by overlapping re-pulls of an extract, which would otherwise be
+    applied twice (a repeated charge is added to the encounter's charge twice). Each row is kept as the tuple of its
+    values in a set, so a row is only dropped when every value matches a kept row, never by a hash collision.
+
+    The '' column, the row number that pandas writes as an unnamed first column, is left out of the comparison, since
+    it differs between pulls of the same row.
+
+    Rows are deduplicated while streaming by patient, for one patient's rows of one source file at a time. A repeated
+    row has the same patient id, so this finds every duplicate, and memory is bounded by the largest patient, whose
+    rows are held anyway.
+'''
+from collections import Counter
+
+ignored_column_names = ('',)
+
+def make_row_key(row):
+    if any([ name in row for name in ignored_column_names ]):
+        values = tuple([ value for name, value in row.items() if name not in ignored_column_names ])
+    else:
+        values = tuple(row.values())
+    try:
+        hash(values)
+        return values
+    except TypeError:
+
+        # A row with more values than the header has a list of the extra values.
+        return tuple([ str(value) for value in values ])
+
+
+class RowDeduplicator:
+
+    '''
+        Deduplicates the rows of the source files named in source_filenames, or of every source file if None.
+        duplicate_counts counts the rows dropped from each file.
+    '''
+    def __init__(self, source_filenames=None):
+        self.source_filenames = set(source_filenames) if source_filenames else None
+        self.row_keys = set()
+        self.duplicate_counts = Counter()
+
+    def is_deduplicated(self, source_file):
+        return self.source_filenames is None or source_file.filename in self.source_filenames
+
+    def reset(self):
+        self.row_keys = set()
+
+    def filter_rows(self, source_file, rows):
+
+        '''
+            Yields rows not seen since the last reset.
+        '''
+        if not self.is_deduplicated(source_file):
+            for row in rows:
+                yield row
+            return
+
+        row_keys = self.row_keys
+        for row in rows:
+            row_key = make_row_key(row)
+            if row_key in row_keys:
+                self.duplicate_counts[source_file.filename] += 1
+                continue
+            row_keys.add(row_key)
+            yield row
+
+    def print_duplicate_counts(self):
+        for filename, count in sorted(self.duplicate_counts.items()):
+            print('%s: %d duplicate rows dropped' % (filename, count))
@@ -0,0 +1,156 @@
+'''
+    Samples a stable fraction of patients, for fast iteration runs. A patient is sampled by a hash of their id, so the
+    same patients are sampled in every run, and by the classifier scripts reading a sample manifest. Rows of patients
+    not sampled are dropped as they are read, before any Patient is built. PatientShard splits patients the same way,
+    so a run can build one shard of the files.
+
+    Optionally the sample is stratified on whether a patient ever had a suicide related diagnosis, which is rare. Those
+    patients are found by a first pass over the diagnosis files, and exactly suicide_related_fraction of them (at least
+    one) are sampled, those with the lowest hashes, rather than however many fall under the hash threshold.
+'''
+import hashlib
+import json
+import os
+from icd_code_to_category import icd_code_to_custom_categories_mapping
+from source_files import source_files, read_source_rows
+
+suicide_related_categories = ['suicide_attempt', 'suicidal_ideation', 'injury_of_unknown_intent', 'cdc_suicide_self_injury']
+
+# The source files with ICD codes, in an ICD_CODE column.
+diagnosis_source_filenames = ['Diagnoses.csv', 'Encounter_Diagnoses_5.2018.csv']
+
+def hash_patient_id(patient_id, seed=''):
+
+    '''
+        A number in [0, 1), uniform over patients, that only depends on the patient id and seed.
+    '''
+    digest = hashlib.sha256(('%s:%s' % (seed, patient_id)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2.0 ** 64
+
+
+def filter_patient_rows(is_sampled, source_file, rows):
+
+    # Rows of the same patient tend to be together, so the last patient's decision is reused.
+    last_patient_id = None
+    is_last_patient_sampled = False
+    for row in rows:
+        patient_id = source_file.get_patient_id(row)
+        if patient_id != last_patient_id:
+            last_patient_id = patient_id
+            is_last_patient_sampled = is_sampled(patient_id)
+        if is_last_patient_sampled:
+            yield row
+
+
+def find_suicide_related_patients():
+    suicide_related_codes = set([
+        code for code, categories in icd_code_to_custom_categories_mapping.items()
+        if any([ category in suicide_related_categories for category in categories ])
+    ])
+    patient_ids = set()
+    for source_file in source_files:
+        if source_file.filename in diagnosis_source_filenames:
+            for row in read_source_rows(source_file):
+                if row['ICD_CODE'].replace('.', '') in suicide_related_codes:
+                    patient_ids.add(source_file.get_patient_id(row))
+    return patient_ids
+
+
+class PatientSampler:
+
+    '''
+        Samples fraction of patients by the hash of their id, except that included_patient_ids are always sampled and
+        excluded_patient_ids never are. make_patient_sampler fills those in to stratify the sample.
+    '''
+    def __init__(self, fraction, seed='', included_patient_ids=(), excluded_patient_ids=(), suicide_related_fraction=None):
+        self.fraction = fraction
+        self.seed = seed
+        self.included_patient_ids = set(included_patient_ids)
+        self.excluded_patient_ids = set(excluded_patient_ids)
+
+        # Only recorded, for the manifest. None if the sample is not stratified.
+        self.suicide_related_fraction = suicide_related_fraction
+
+    def is_stratified(self):
+        return self.suicide_related_fraction is not None
+
+    def is_sampled(self, patient_id):
+        if patient_id in self.included_patient_ids:
+            return True
+        if patient_id in self.excluded_patient_ids:
+            return False
+        return hash_patient_id(patient_id, self.seed) < self.fraction
+
+    def filter_rows(self, source_file, rows):
+        return filter_patient_rows(self.is_sampled, source_file, rows)
+
+    def write_manifest(self, filepath):
+
+        '''
+            Writes what reproduces the sample: the fraction and seed, and, if stratified, the suicide related patients
+            sampled and those left out that the hash alone would sample. The file holds patient ids, so only its owner
+            can read it.
+        '''
+        manifest = {
+            'fraction': self.fraction,
+            'seed': self.seed,
+            'suicide_related_fraction': self.suicide_related_fraction,
+            'included_patient_ids': sorted(self.included_patient_ids),
+            'excluded_patient_ids': sorted(self.excluded_patient_ids),
+        }
+        with open(os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+
+def make_patient_sampler(fraction, seed='', suicide_related_patient_ids=None, suicide_related_fraction=None):
+
+    '''
+        Samples fraction of patients. If suicide_related_patient_ids is given, exactly suicide_related_fraction of them,
+        by default fraction, are sampled, and the rest of the patients at fraction.
+    '''
+    if suicide_related_patient_ids is None:
+        return PatientSampler(fraction, seed)
+    suicide_related_fraction = fraction if suicide_related_fraction is None else suicide_related_fraction
+
+    patient_id_to_hash = dict([ (patient_id, hash_patient_id(patient_id, seed)) for patient_id in suicide_related_patient_ids ])
+    ranked_patient_ids = sorted(patient_id_to_hash, key=lambda patient_id: (patient_id_to_hash[patient_id], patient_id))
+    number_to_sample = max(1, int(round(suicide_related_fraction * len(ranked_patient_ids)))) if ranked_patient_ids else 0
+
+    # Suicide related patients past the quota only need excluding if the hash would sample them.
+    excluded_patient_ids = [ patient_id for patient_id in ranked_patient_ids[number_to_sample:] if patient_id_to_hash[patient_id] < fraction ]
+    return PatientSampler(fraction, seed, ranked_patient_ids[:number_to_sample], excluded_patient_ids, suicide_related_fraction)
+
+
+# Salts the hash shards are split by, so shards are independent of the sample.
+shard_seed = 'shard'
+
+class PatientShard:
+
+    '''
+        The patients of shard shard_index of number_of_shards, split by a hash of their id, and sampled by sampler if
+        given. Filters rows as a PatientSampler does, so it passes wherever a sampler does.
+    '''
+    def __init__(self, shard_index, number_of_shards, sampler=None):
+        if not 0 <= shard_index < number_of_shards:
+            raise ValueError('Shard %d is not one of %d shards' % (shard_index, number_of_shards))
+        self.shard_index = shard_index
+        self.number_of_shards = number_of_shards
+        self.sampler = sampler
+
+    def is_sampled(self, patient_id):
+        if int(hash_patient_id(patient_id, shard_seed) * self.number_of_shards) != self.shard_index:
+            return False
+        return self.sampler is None or self.sampler.is_sampled(patient_id)
+
+    def filter_rows(self, source_file, rows):
+        return filter_patient_rows(self.is_sampled, source_file, rows)
+
+
+def read_sample_manifest(filepath):
+
+    '''
+        The PatientSampler that wrote the manifest at filepath, to sample the same patients from full files.
+    '''
+    with open(filepath, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    return PatientSampler(manifest['fraction'], manifest['seed'], manifest['included_patient_ids'], manifest['excluded_patient_ids'], manifest['suicide_related_fraction'])
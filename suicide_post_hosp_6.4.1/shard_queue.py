@@ -0,0 +1,389 @@
+'''
+    Spreads a make_analyzable_care_episodes.py build over several processes or batch nodes sharing a filesystem. The
+    coordinator splits patients into shards by a hash of their id (see sampling.PatientShard) and publishes the shards to
+    a work queue, a SQLite file. Workers on any node claim a shard, build its files with --shard in a directory of their
+    own, and rename the directory into place once it is complete, so a part is either whole or absent. When every shard
+    is done the coordinator concatenates the parts into the usual analyzable files, in shard order.
+
+    A claim is a lease that the worker renews while the shard runs. A worker that crashes stops renewing, so once its
+    lease expires the shard goes back to the queue for another worker, and the coordinator replaces crashed local
+    workers. A shard that fails or is abandoned max_attempts times is marked
+    failed, which fails the coordinator. SQLite needs working file locks, so on NFS the queue file should be on a mount
+    with locking enabled, and the nodes' clocks should agree to well within the lease.
+
+        python shard_queue.py coordinate --queue build/shards.sqlite --shards 64 --local_workers 8 -- --stream_by_patient
+        python shard_queue.py work --queue build/shards.sqlite    # on each other node
+
+    Everything runs on one machine with --local_workers, which starts that many worker processes.
+'''
+import argparse
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import Counter
+from os import path
+from output_sinks import output_format_extensions
+from instrumentation import stage, print_stage_summary, write_run_report
+
+module_directory = path.dirname(path.abspath(__file__))
+
+shard_states = ['pending', 'claimed', 'done', 'failed']
+
+# make_analyzable_care_episodes.py arguments the queue sets itself, or whose outputs it cannot merge.
+reserved_arguments = ['--shard', '--episode_store']
+
+def make_part_directory(parts_directory, shard_index):
+    return path.join(parts_directory, 'shard_%05d' % shard_index)
+
+
+class ShardQueue:
+
+    '''
+        The shards of one build, in a SQLite file, with the arguments every shard is built with. The parts are written
+        to a directory next to the file.
+    '''
+    def __init__(self, filepath):
+        self.filepath = path.abspath(filepath)
+        self.parts_directory = path.splitext(self.filepath)[0] + '_parts'
+        os.makedirs(path.dirname(self.filepath), exist_ok=True)
+
+        # Transactions are begun explicitly, so a claim can lock the queue before reading it.
+        self.connection = sqlite3.connect(self.filepath, timeout=60, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shard_queue_job (arguments TEXT, number_of_shards INTEGER, source_directory TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shard_queue (shard_index INTEGER PRIMARY KEY, state TEXT, worker TEXT, lease_expires REAL, attempts INTEGER, error TEXT)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def publish(self, arguments, number_of_shards, source_directory):
+
+        '''
+            Adds a shard for each of number_of_shards. Publishing the same job again resumes it: shards already done
+            are kept and failed shards are retried.
+        '''
+        job = (json.dumps(arguments), number_of_shards, path.abspath(source_directory))
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            published_job = self.connection.execute('SELECT arguments, number_of_shards, source_directory FROM shard_queue_job').fetchone()
+            if published_job is None:
+                self.connection.execute('INSERT INTO shard_queue_job VALUES (?, ?, ?)', job)
+                self.connection.executemany("INSERT INTO shard_queue VALUES (?, 'pending', NULL, NULL, 0, NULL)", [ (shard_index,) for shard_index in range(number_of_shards) ])
+            elif published_job != job:
+                raise ValueError('%s already holds a different job, started with %s' % (self.filepath, published_job[0]))
+            else:
+                self.connection.execute("UPDATE shard_queue SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        os.makedirs(self.parts_directory, exist_ok=True)
+
+    def get_job(self):
+
+        '''
+            Returns the arguments, number of shards and source directory of the published job.
+        '''
+        arguments, number_of_shards, source_directory = self.connection.execute('SELECT arguments, number_of_shards, source_directory FROM shard_queue_job').fetchone()
+        return json.loads(arguments), number_of_shards, source_directory
+
+    def claim(self, worker, lease_seconds, max_attempts):
+
+        '''
+            Returns the index of a pending shard, or of one whose lease expired, now leased to worker, or None if there
+            is none.
+        '''
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            self.expire_leases(now, max_attempts)
+            shard = self.connection.execute("SELECT shard_index FROM shard_queue WHERE state = 'pending' ORDER BY shard_index LIMIT 1").fetchone()
+            if shard:
+                self.connection.execute("UPDATE shard_queue SET state = 'claimed', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE shard_index = ?", (worker, now + lease_seconds, shard[0]))
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        return shard[0] if shard else None
+
+    def expire_leases(self, now, max_attempts):
+
+        # Shards whose worker stopped renewing go back to pending, or are failed after max_attempts.
+        self.connection.execute("UPDATE shard_queue SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, error = 'lease expired' WHERE state = 'claimed' AND lease_expires < ?",
+            (max_attempts, now))
+
+    def reclaim_expired_shards(self, max_attempts):
+
+        '''
+            Applies expire_leases outside of a claim, so shards of crashed workers are retried or failed even when no
+            worker is left to claim them.
+        '''
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.expire_leases(time.time(), max_attempts)
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def renew(self, shard_index, worker, lease_seconds):
+
+        '''
+            Extends worker's lease on the shard. Returns False if the lease was lost, i.e. it expired and another
+            worker claimed the shard.
+        '''
+        cursor = self.connection.execute("UPDATE shard_queue SET lease_expires = ? WHERE shard_index = ? AND worker = ? AND state = 'claimed'", (time.time() + lease_seconds, shard_index, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, shard_index):
+        self.connection.execute("UPDATE shard_queue SET state = 'done', worker = NULL, error = NULL WHERE shard_index = ?", (shard_index,))
+
+    def release(self, shard_index, worker, error, max_attempts):
+
+        '''
+            Returns a shard worker failed on to the queue, or marks it failed after max_attempts.
+        '''
+        self.connection.execute("UPDATE shard_queue SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, error = ? WHERE shard_index = ? AND worker = ? AND state = 'claimed'",
+            (max_attempts, error, shard_index, worker))
+
+    def get_state_counts(self):
+        state_counts = Counter(dict([ (state, 0) for state in shard_states ]))
+        state_counts.update(dict(self.connection.execute('SELECT state, COUNT(*) FROM shard_queue GROUP BY state')))
+        return state_counts
+
+    def get_shards(self):
+        column_names = [ 'shard_index', 'state', 'worker', 'attempts', 'error' ]
+        return [ dict(zip(column_names, shard)) for shard in self.connection.execute('SELECT %s FROM shard_queue ORDER BY shard_index' % ', '.join(column_names)) ]
+
+    def is_finished(self):
+        state_counts = self.get_state_counts()
+        return state_counts['pending'] == 0 and state_counts['claimed'] == 0
+
+
+def make_worker_name():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def build_shard(queue, shard_index, worker, lease_seconds):
+
+    '''
+        Builds the shard's files in a directory of worker's own, renewing the lease while it runs, then renames the
+        directory to the shard's part directory. Returns False if the lease was lost before the build finished.
+    '''
+    arguments, number_of_shards, source_directory = queue.get_job()
+    part_directory = make_part_directory(queue.parts_directory, shard_index)
+    work_directory = '%s.%s.tmp' % (part_directory, worker)
+    if path.exists(work_directory):
+        shutil.rmtree(work_directory)
+    os.makedirs(work_directory)
+    os.symlink(source_directory, path.join(work_directory, 'source_data'))
+
+    command = [ sys.executable, path.join(module_directory, 'make_analyzable_care_episodes.py') ] + arguments + [ '--shard', str(shard_index), str(number_of_shards) ]
+    with open(path.join(work_directory, 'run.log'), 'w') as log_file:
+        process = subprocess.Popen(command, cwd=work_directory, stdout=log_file, stderr=subprocess.STDOUT)
+        while True:
+            try:
+                return_code = process.wait(timeout=lease_seconds / 3)
+                break
+            except subprocess.TimeoutExpired:
+                if not queue.renew(shard_index, worker, lease_seconds):
+                    process.kill()
+                    process.wait()
+                    shutil.rmtree(work_directory)
+                    return False
+    if return_code:
+        raise RuntimeError('Shard %d exited with %d, see %s' % (shard_index, return_code, path.join(work_directory, 'run.log')))
+
+    os.remove(path.join(work_directory, 'source_data'))
+    try:
+        os.rename(work_directory, part_directory)
+    except OSError:
+
+        # A worker whose lease expired while it was still running can finish the shard too. Either part will do.
+        if not path.isdir(part_directory):
+            raise
+        shutil.rmtree(work_directory)
+    queue.complete(shard_index)
+    return True
+
+
+def run_worker(queue_filepath, lease_seconds=600, max_attempts=3, poll_seconds=5):
+
+    '''
+        Builds shards until none is left. Waits while other workers hold the last shards, since a shard comes back if
+        its worker crashes or fails.
+    '''
+    worker = make_worker_name()
+    with ShardQueue(queue_filepath) as queue:
+        while True:
+            shard_index = queue.claim(worker, lease_seconds, max_attempts)
+            if shard_index is None:
+                if queue.is_finished():
+                    return
+                time.sleep(poll_seconds)
+                continue
+
+            print('%s: building shard %d' % (worker, shard_index))
+            try:
+                build_shard(queue, shard_index, worker, lease_seconds)
+            except Exception as error:
+                print('%s: shard %d failed: %s' % (worker, shard_index, error))
+                queue.release(shard_index, worker, str(error), max_attempts)
+
+
+def merge_csv_parts(part_filepaths, filepath):
+
+    # Parts are copied byte for byte, keeping the first part's header.
+    with open(filepath, 'wb') as output_file:
+        for part_index, part_filepath in enumerate(part_filepaths):
+            with open(part_filepath, 'rb') as part_file:
+                header = part_file.readline()
+                if part_index == 0:
+                    output_file.write(header)
+                shutil.copyfileobj(part_file, output_file)
+
+
+def merge_columnar_parts(part_filepaths, filepath, output_format, compression='zstd'):
+    import pyarrow
+
+    if output_format == 'parquet':
+        import pyarrow.parquet
+        table = pyarrow.concat_tables([ pyarrow.parquet.read_table(part_filepath) for part_filepath in part_filepaths ])
+        pyarrow.parquet.write_table(table, filepath, compression=compression)
+    else:
+        import pyarrow.ipc
+        table = pyarrow.concat_tables([ pyarrow.ipc.open_file(part_filepath).read_all() for part_filepath in part_filepaths ])
+        with pyarrow.ipc.new_file(filepath, table.schema, options=pyarrow.ipc.IpcWriteOptions(compression=compression)) as writer:
+            writer.write_table(table)
+
+
+def merge_parts(parts_directory, number_of_shards, output_directory='.'):
+
+    '''
+        Concatenates each analyzable file of the parts, in shard order, into output_directory. Each file is written
+        under a temporary name and renamed into place, so it is never seen half written. Returns the merged filenames.
+    '''
+    part_directories = [ make_part_directory(parts_directory, shard_index) for shard_index in range(number_of_shards) ]
+    extension_to_format = dict([ (extension, output_format) for output_format, extension in output_format_extensions.items() ])
+    filenames = sorted([ filename for filename in os.listdir(part_directories[0])
+        if filename.startswith('analyzable_') and path.splitext(filename)[1] in extension_to_format ])
+
+    for filename in filenames:
+        with stage('Merge %s' % filename):
+            part_filepaths = [ path.join(part_directory, filename) for part_directory in part_directories ]
+            filepath = path.join(output_directory, filename)
+            temporary_filepath = filepath + '.tmp'
+            output_format = extension_to_format[path.splitext(filename)[1]]
+            if output_format == 'csv':
+                merge_csv_parts(part_filepaths, temporary_filepath)
+            else:
+                merge_columnar_parts(part_filepaths, temporary_filepath, output_format)
+            os.replace(temporary_filepath, filepath)
+    return filenames
+
+
+def coordinate(queue_filepath, arguments, number_of_shards, source_directory='source_data', local_workers=0, lease_seconds=600, max_attempts=3, poll_seconds=5):
+
+    '''
+        Publishes the shards, starts local_workers worker processes, waits for every shard and merges the parts.
+        Returns the shards, as ShardQueue.get_shards. A local worker that exits before every shard is finished has
+        crashed, and is replaced, up to local_workers * max_attempts times. Without local workers, the coordinator
+        waits for workers on other nodes however long they take.
+    '''
+    with ShardQueue(queue_filepath) as queue:
+        with stage('Publish shards', number_of_shards):
+            queue.publish(arguments, number_of_shards, source_directory)
+
+        worker_command = [ sys.executable, path.abspath(__file__), 'work', '--queue', queue.filepath,
+            '--lease_seconds', str(lease_seconds), '--max_attempts', str(max_attempts), '--poll_seconds', str(poll_seconds) ]
+        workers = [ subprocess.Popen(worker_command) for _ in range(local_workers) ]
+        respawns_left = local_workers * max_attempts
+
+        with stage('Build shards', number_of_shards):
+            state_counts = None
+            while True:
+                queue.reclaim_expired_shards(max_attempts)
+                if queue.is_finished():
+                    break
+
+                for worker_index, worker in enumerate(workers):
+                    if worker is None or worker.poll() is None:
+                        continue
+                    workers[worker_index] = None
+
+                    # A worker only exits cleanly once it sees every shard finished.
+                    if worker.returncode:
+                        print('Worker %d exited with %d before the shards were finished' % (worker.pid, worker.returncode))
+                        if respawns_left:
+                            respawns_left -= 1
+                            workers[worker_index] = subprocess.Popen(worker_command)
+                if local_workers and not any(workers) and not queue.is_finished():
+                    raise RuntimeError('Every local worker crashed, with shards left unfinished: %s' % dict(queue.get_state_counts()))
+
+                if queue.get_state_counts() != state_counts:
+                    state_counts = queue.get_state_counts()
+                    print('Shards: %s' % ', '.join([ '%d %s' % (state_counts[state], state) for state in shard_states ]))
+                time.sleep(poll_seconds)
+            for worker in workers:
+                if worker is not None:
+                    worker.wait()
+
+        shards = queue.get_shards()
+        failed_shards = [ shard for shard in shards if shard['state'] == 'failed' ]
+        if failed_shards:
+            raise RuntimeError('%d shards failed, e.g. shard %d: %s' % (len(failed_shards), failed_shards[0]['shard_index'], failed_shards[0]['error']))
+
+        merge_parts(queue.parts_directory, number_of_shards)
+    return shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the analyzable files in shards of patients, over worker processes on one or more nodes')
+    subparsers = parser.add_subparsers(dest='role')
+    subparsers.required = True
+    coordinator_parser = subparsers.add_parser('coordinate', help='publish the shards, wait for the workers and merge their parts')
+    worker_parser = subparsers.add_parser('work', help='build shards of a published queue until none is left')
+    for role_parser in [ coordinator_parser, worker_parser ]:
+        role_parser.add_argument('--queue', default='shards.sqlite', help='SQLite file of the work queue, on the filesystem the nodes share. Parts go in <queue>_parts/')
+        role_parser.add_argument('--lease_seconds', default=600, type=int, help='seconds without a renewal before a claimed shard is given to another worker')
+        role_parser.add_argument('--max_attempts', default=3, type=int, help='claims of a shard before it is marked failed')
+        role_parser.add_argument('--poll_seconds', default=5, type=float, help='seconds between checks of the queue')
+    coordinator_parser.add_argument('--shards', default=16, type=int, help='number of shards of patients')
+    coordinator_parser.add_argument('--local_workers', default=0, type=int, help='worker processes to start on this node')
+    coordinator_parser.add_argument('--source_directory', default='source_data', help='directory of the source files, on the filesystem the nodes share')
+    coordinator_parser.add_argument('--run_report', default='shard_run_report.json', help='JSON file to write stage timings and the shards to')
+    coordinator_parser.add_argument('pipeline_args', nargs=argparse.REMAINDER, help='make_analyzable_care_episodes.py arguments, after --')
+    command_args = vars(parser.parse_args())
+
+    if command_args['role'] == 'work':
+        run_worker(command_args['queue'], command_args['lease_seconds'], command_args['max_attempts'], command_args['poll_seconds'])
+        return
+
+    pipeline_args = command_args['pipeline_args']
+    if pipeline_args[:1] == [ '--' ]:
+        pipeline_args = pipeline_args[1:]
+    for argument in reserved_arguments:
+        if argument in pipeline_args:
+            parser.error('%s cannot be used with shard_queue.py' % argument)
+    if command_args['shards'] < 1:
+        parser.error('--shards must be at least 1')
+
+    with stage('Total'):
+        shards = coordinate(command_args['queue'], pipeline_args, command_args['shards'], command_args['source_directory'], command_args['local_workers'],
+            command_args['lease_seconds'], command_args['max_attempts'], command_args['poll_seconds'])
+    print_stage_summary()
+    write_run_report(command_args['run_report'], command_args=command_args, shards=shards)
+
+
+if __name__ == '__main__':
+    main()
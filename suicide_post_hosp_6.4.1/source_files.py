@@ -0,0 +1,79 @@
+import csv
+import os
+from os import path
+from decompression import compressed_extensions, find_part_filepaths, open_text
+
+source_directory = 'source_data'
+
+# Number of compressed files or parts decompressed at once, ahead of the CSV parser.
+parallel_decompression = min(4, os.cpu_count() or 1)
+
+class SourceFile:
+    def __init__(self, filename, patient_id_column, strip_patient_id, patient_method_name, label):
+        self.filename = filename
+        self.patient_id_column = patient_id_column
+
+        # Some files were loaded without stripping the patient id. Kept as is, since stripping could change which patient a row belongs to.
+        self.strip_patient_id = strip_patient_id
+
+        # The Patient method each row is passed to.
+        self.patient_method_name = patient_method_name
+        self.label = label
+
+    def get_patient_id(self, row):
+        return self.normalize_patient_id(row[self.patient_id_column])
+
+    def normalize_patient_id(self, patient_id):
+        return patient_id.strip() if self.strip_patient_id else patient_id
+
+
+# Loaded in this order. Later files attach data to encounters created by earlier ones, so the order matters.
+# Columns starting with ï»¿ are exports with a UTF-8 byte order mark, read as iso-8859-1.
+source_files = [
+    SourceFile('Charges_12.20.csv', 'STUDY_ID', True, 'add_episode_from_charges', 'Charges'),
+    SourceFile('Readmission.csv', 'STUDY_ID', True, 'add_episode_from_readmissions', 'Readmission'),
+    SourceFile('Demographics.csv', 'ï»¿DEID_PATIENT_NUM', False, 'add_demographics', 'Demographics'),
+    SourceFile('Medications_1.21.18_TS.csv', 'DEID_PATIENT_NUM', False, 'add_epic_medication_categories', 'Epic medication categories'),
+    SourceFile('Medications.csv', 'ï»¿DEID_PATIENT_NUM', False, 'add_medications', 'Medications'),
+    SourceFile('Pain_Score.csv', 'STUDY_ID', True, 'add_pain_score', 'Pain Score'),
+    SourceFile('Chief_Complaints.csv', 'STUDY_ID', True, 'add_chief_complaints', 'Chief Complaint'),
+    SourceFile('Diagnoses.csv', 'ï»¿DEID_PATIENT_NUM', True, 'add_diagnoses', 'Diagnoses'),
+    SourceFile('Visit_Breakdown_Per_Year.csv', 'STUDY_ID', True, 'add_visit', 'Visits'),
+    SourceFile('Patient_Demographics_5.2018.csv', 'STUDY_ID', False, 'add_zip_demographics', 'ZIP demographics'),
+    SourceFile('Encounter_Diagnoses_5.2018.csv', 'STUDY_ID', False, 'add_encounter_diagnosis', 'Encounter diagnoses'),
+    SourceFile('Encounters_5.2018.csv', 'STUDY_ID', False, 'add_encounters', 'Encounter'),
+]
+
+def make_source_filepath(filename):
+    return path.join(source_directory, filename)
+
+
+def find_source_filepaths(filename):
+
+    '''
+        A source file can be plain (Charges_12.20.csv), compressed (Charges_12.20.csv.gz or .csv.zst), or split into parts
+        in a directory (Charges_12.20.csv/ or Charges_12.20/, each part plain or compressed). Returns the files to read,
+        in order.
+    '''
+    filepath = make_source_filepath(filename)
+    for candidate in [ filepath ] + [ filepath + extension for extension in compressed_extensions ]:
+        if path.isfile(candidate):
+            return [ candidate ]
+    for candidate in [ filepath, path.splitext(filepath)[0] ]:
+        if path.isdir(candidate):
+            return find_part_filepaths(candidate)
+    raise FileNotFoundError('No plain, compressed or partitioned source file for %s' % filepath)
+
+
+def open_source_file(source_file):
+    filepaths = find_source_filepaths(source_file.filename)
+    if len(filepaths) == 1 and not filepaths[0].endswith(tuple(compressed_extensions)):
+        return open(filepaths[0], 'r', encoding='iso-8859-1')
+    return open_text(filepaths, 'iso-8859-1', parallel_decompression)
+
+
+def read_source_rows(source_file):
+    with open_source_file(source_file) as input_file:
+        reader = csv.DictReader(input_file)
+        for row in reader:
+            yield row
@@ -0,0 +1,219 @@
+'''
+    Generates synthetic versions of the source files in source_data/, with the same file names, columns (including
+    the byte order mark mangled DEID_PATIENT_NUM columns) and value formats, so the pipeline can be run and
+    benchmarked outside the enclave. None of the values come from real patients.
+'''
+import argparse
+import csv
+import os
+import random
+from datetime import datetime, timedelta
+from os import path
+from Patient import epic_medicine_categories
+from icd_code_to_category import elixhauser_to_icd9, elixhauser_to_icd10, custom_icd9, custom_icd10
+from sampling import suicide_related_categories
+
+dispositions = [
+    'Home or Self Care', 'Home Health Service', 'Home Health Svc not related to IP stay',
+    'Psychiatric Hospital (not UCLA, not VA)', 'Psychiatric Hospital UCLA RNPH',
+    'Psychiatric Hospital UCLA RNPH with planned Acute IP readmission', 'Psychiatric Hospital (not UCLA, not VA) with planned Acute IP readmission',
+    'Acute Care Hosp UCLA SMHOH', 'Admitted as an Inpatient', 'Discharge to OR', 'Hospice Care at Home', 'SNF Skilled Nursing Bed',
+    'Acute Care Hosp UCLA RRUMC with planned Acute IP readmission', 'Eloped from ED', 'Left Against Medical Advice (AMA)', 'Expired',
+    'Inpatient Rehab Unit UCLA 1West', 'Long Term Care Hospital (LTCH)', 'Residential Care Facility',
+
+    # Not one of the known dispositions.
+    'Court/Law Enforcement', '',
+]
+chief_complaints = [
+    'Chest Pain', 'Abdominal Pain', 'Suicidal', 'Suicide Attempt', 'Depression', 'Anxiety', 'Alcohol Problem', 'Intoxication',
+    'Withdrawal', 'Psychiatric Evaluation', 'Hallucinations', 'Agitation', 'Fall', 'Shortness of Breath', 'Fever', 'Headache',
+]
+medication_names = [
+    'Lithium carbonate 300 MG capsule', 'Valproic acid 250 MG capsule', 'Lamotrigine 25 MG tablet', 'Quetiapine 25 MG tablet',
+    'Olanzapine 10 MG tablet', 'Haloperidol 5 MG tablet', 'Lorazepam 1 MG tablet', 'Clonazepam 0.5 MG tablet',
+    'Sertraline 50 MG tablet', 'Trazodone 50 MG tablet', 'Bupropion XL 150 MG tablet', 'Acetaminophen 500 MG tablet',
+    'Lisinopril 10 MG tablet', 'Metformin 500 MG tablet', 'Ondansetron 4 MG injection', 'Heparin 5000 UNIT/ML injection',
+]
+races = [
+    'American Indian or Alaska Native', 'Asian', 'Black or African American', 'Multiple Races',
+    'Native Hawaiian or Other Pacific Islander', 'White or Caucasian', 'Other', 'Unknown',
+]
+ethnicities = [ 'Mexican, Mexican American, Chicano/a', 'Hispanic or Latino', 'Hispanic/Spanish origin Other', 'Not Hispanic or Latino', 'Puerto Rican', 'Unknown' ]
+visit_types = [ 'Ambulatory Visit', 'ED', 'Hospitalization' ]
+
+# ENCOUNTER_DATE and DISCHARGE_DATE are days since this date.
+day_zero = datetime(2000, 1, 1)
+
+# ICD-10 replaced ICD-9 in October 2015.
+icd10_start = datetime(2015, 10, 1)
+
+def build_code_pool(category_to_codes):
+    return [ code for codes in category_to_codes.values() for code in codes ]
+
+icd9_codes = build_code_pool(elixhauser_to_icd9) + build_code_pool(custom_icd9)
+icd10_codes = build_code_pool(elixhauser_to_icd10) + build_code_pool(custom_icd10)
+
+# Only the suicide related categories, not the generic injury category.
+suicide_related_codes = build_code_pool(dict([ (category, custom_icd9[category]) for category in suicide_related_categories ]))
+
+# Codes that are not in any category, including primary psychiatric (ICD-9 290-319, ICD-10 F) and medical diagnoses.
+uncategorized_codes = [ '78650', '7890', 'V7001', 'E8889', '29620', '30000', '311', 'R079', 'R109', 'Z0000', 'F329', 'F411' ]
+
+def format_icd_code(code):
+
+    # Source files have dotted codes, e.g. 296.20 and F32.9. E codes are dotted after the fourth character.
+    dot_position = 4 if code.startswith('E') else 3
+    return code[:dot_position] + '.' + code[dot_position:] if len(code) > dot_position else code
+
+
+def make_icd_code(rng, date, suicide_related_fraction):
+    roll = rng.random()
+    if roll < suicide_related_fraction:
+        return rng.choice(suicide_related_codes)
+    if roll < suicide_related_fraction + 0.2:
+        return rng.choice(uncategorized_codes)
+    return rng.choice(icd10_codes if date >= icd10_start else icd9_codes)
+
+
+def make_timestamp(date):
+    return date.strftime('%m/%d/%y %H:%M')
+
+
+class SyntheticSourceFile:
+
+    '''
+        Writes rows to a source file in blocks, shuffling each block so that a patient's rows are not always
+        adjacent, as in the real extracts, without holding the whole file in memory.
+    '''
+    def __init__(self, directory, filename, column_names, rng, shuffle_block_size):
+        self.file = open(path.join(directory, filename), 'w', encoding='iso-8859-1', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(column_names)
+        self.rng = rng
+        self.shuffle_block_size = shuffle_block_size
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.shuffle_block_size:
+            self.flush()
+
+    def flush(self):
+        self.rng.shuffle(self.rows)
+        self.writer.writerows(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def generate_cohort(directory, number_of_patients, episodes_per_patient=4, seed=0, suicide_related_fraction=0.05, shuffle_block_size=100000):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    def open_source_file(filename, column_names):
+        return SyntheticSourceFile(directory, filename, column_names, rng, shuffle_block_size)
+
+    charges = open_source_file('Charges_12.20.csv', [ 'STUDY_ID', 'STUDY_CSN', 'SERVICE_DATE', 'AMOUNT' ])
+    readmissions = open_source_file('Readmission.csv', [ 'STUDY_ID', 'STUDY_CSN', 'EFFECTIVE_DATE_DT', 'DIFF_IN_DAYS' ])
+    demographics = open_source_file('Demographics.csv', [ 'ï»¿DEID_PATIENT_NUM', 'AGE_AS_OF_1ST_ADMIT', 'gender', 'race', 'ethnicity' ])
+    epic_medications = open_source_file('Medications_1.21.18_TS.csv', [ '', 'DEID_PATIENT_NUM', 'MED_START_DATE' ] + epic_medicine_categories)
+    medications = open_source_file('Medications.csv', [ 'ï»¿DEID_PATIENT_NUM', 'MEDICATION_NAME' ])
+    pain_scores = open_source_file('Pain_Score.csv', [ 'STUDY_ID', 'STUDY_CSN', 'VITAL_SIGN_VALUE', 'VITAL_SIGN_TAKEN_TIME' ])
+    complaints = open_source_file('Chief_Complaints.csv', [ 'STUDY_ID', 'STUDY_CSN', 'CHIEF_COMPLAINT_LIST' ])
+    diagnoses = open_source_file('Diagnoses.csv', [ 'ï»¿DEID_PATIENT_NUM', 'ICD_CODE' ])
+    visits = open_source_file('Visit_Breakdown_Per_Year.csv', [ 'STUDY_ID', 'ENCOUNTER_YEAR', 'VISIT_TYPE', 'TOTAL (Visits per Year)' ])
+    zip_demographics = open_source_file('Patient_Demographics_5.2018.csv', [ 'STUDY_ID', 'ZIP_1ST_3' ])
+    encounter_diagnoses = open_source_file('Encounter_Diagnoses_5.2018.csv', [ 'STUDY_ID', 'STUDY_CSN', 'PRIMARY_DIAGNOSIS_FLAG', 'ADMISSION_DIAGNOSIS_FLAG', 'ICD_CODE', 'ICD_DESCRIPTION' ])
+    encounters = open_source_file('Encounters_5.2018.csv', [ 'STUDY_ID', 'STUDY_CSN', 'HOSP_DISCHARGE_DISP', 'LENGTH_OF_STAY', 'ENCOUNTER_DATE', 'DISCHARGE_DATE' ])
+
+    encounter_id = 10000000
+    epic_medication_row = 0
+    for patient_number in range(number_of_patients):
+        patient_id = 'Z%08d' % patient_number
+
+        # Some extracts pad STUDY_ID with spaces, which the loaders that strip the id remove.
+        padded_patient_id = patient_id + ' ' if rng.random() < 0.2 else patient_id
+
+        # Patient level data.
+        demographics.add([ patient_id, rng.randint(12, 95), rng.choice([ 'Male', 'Female' ]), rng.choice(races), rng.choice(ethnicities) ])
+        zip_demographics.add([ patient_id, '%03d' % rng.randint(900, 935) ])
+        for _ in range(rng.randint(0, 3)):
+            epic_medication_row += 1
+            taken = [ rng.randint(1, 4) if rng.random() < 0.05 else 0 for category in epic_medicine_categories ]
+            epic_medications.add([ epic_medication_row, patient_id, '2012-01-01' ] + taken)
+        for _ in range(rng.randint(0, 4)):
+            medications.add([ patient_id, rng.choice(medication_names) ])
+        for _ in range(rng.randint(0, 5)):
+            diagnoses.add([ patient_id, format_icd_code(make_icd_code(rng, datetime(2012, 1, 1), suicide_related_fraction)) ])
+        for year in range(2006, 2018):
+            for visit_type in visit_types:
+                if rng.random() < 0.15:
+                    visits.add([ padded_patient_id, year, visit_type, rng.randint(1, 8) ])
+
+        # Care episodes, each with one or more encounters.
+        number_of_episodes = max(1, int(round(rng.expovariate(1.0 / episodes_per_patient))))
+        dates = sorted(day_zero + timedelta(days=rng.randint(2190, 6570), minutes=rng.randint(0, 1439)) for _ in range(number_of_episodes))
+        previous_hospitalization_date = None
+        for date in dates:
+            is_hospitalization = rng.random() < 0.5
+            length_of_stay = rng.randint(1, 14) if is_hospitalization else 0
+            for _ in range(rng.choice([ 1, 1, 1, 2, 3 ])):
+                encounter_id += 1
+                study_csn = str(encounter_id)
+
+                for _ in range(rng.randint(1, 4)):
+                    amount = 0 if rng.random() < 0.1 else rng.lognormvariate(6, 2)
+                    charges.add([ padded_patient_id, study_csn, make_timestamp(date), '%.2f' % amount ])
+                for _ in range(rng.choice([ 0, 0, 1, 2 ])):
+                    pain_scores.add([ padded_patient_id, study_csn, rng.randint(0, 12), make_timestamp(date + timedelta(hours=rng.randint(0, 48))) ])
+                if rng.random() < 0.6:
+                    complaints.add([ padded_patient_id, study_csn, '|'.join(rng.sample(chief_complaints, rng.randint(1, 3))) ])
+                for diagnosis_number in range(rng.randint(0, 4)):
+                    icd_code = make_icd_code(rng, date, suicide_related_fraction)
+                    encounter_diagnoses.add([
+                        patient_id, study_csn, 'P' if diagnosis_number == 0 else '', 'Y' if rng.random() < 0.2 else 'N',
+                        format_icd_code(icd_code), 'Synthetic description of %s' % format_icd_code(icd_code),
+                    ])
+
+                # Encounter dates are sometimes a day off from the charge date, and sometimes missing.
+                start_day = (date - day_zero).days + rng.choice([ -1, 0, 0, 0, 1 ])
+                encounters.add([
+                    patient_id, study_csn, rng.choice(dispositions),
+                    length_of_stay if rng.random() < 0.95 else '',
+                    start_day if rng.random() < 0.95 else '',
+                    start_day + length_of_stay if rng.random() < 0.95 else '',
+                ])
+
+                if is_hospitalization and previous_hospitalization_date:
+                    readmissions.add([ padded_patient_id, study_csn, make_timestamp(date), (date.date() - previous_hospitalization_date.date()).days ])
+            if is_hospitalization:
+                previous_hospitalization_date = date
+
+        # Pain scores taken at encounters that no other file has.
+        if rng.random() < 0.05:
+            encounter_id += 1
+            pain_scores.add([ padded_patient_id, str(encounter_id), rng.randint(0, 10), make_timestamp(dates[-1] + timedelta(days=rng.randint(1, 30))) ])
+
+    for source_file in [ charges, readmissions, demographics, epic_medications, medications, pain_scores, complaints, diagnoses, visits, zip_demographics, encounter_diagnoses, encounters ]:
+        source_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic cohort of source files')
+    parser.add_argument('--output_directory', default='source_data', help='directory to write the source files to')
+    parser.add_argument('--patients', default=10000, type=int, help='number of patients')
+    parser.add_argument('--episodes_per_patient', default=4, type=float, help='mean number of care episodes per patient')
+    parser.add_argument('--suicide_related_fraction', default=0.05, type=float, help='fraction of diagnoses that are suicide related')
+    parser.add_argument('--random_seed', default=314, type=int, help='randomization seed')
+    command_args = vars(parser.parse_args())
+
+    generate_cohort(
+        command_args['output_directory'], command_args['patients'], command_args['episodes_per_patient'],
+        command_args['random_seed'], command_args['suicide_related_fraction']
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+'''
+    Lookback features of a care episode, aggregated over the patient's care episodes from days_back days before it up to
+    and including it, e.g. the sum of their charges. Each feature is declared by a WindowedFeature in windowed_features.
+    A patient's episodes are read once into a timeline of columns, and every row of the patient is computed at once from
+    an episodes x rows mask of which episodes fall in each row's window. Every feature with the same window shares the
+    mask, so adding a feature adds an aggregation over arrays rather than another scan over the episodes for each row.
+
+    Values are identical to aggregating the episodes in Python: missing values (negative, i.e. -9999) are skipped, sums
+    add the episodes in the order of patient.care_episodes, and medians and maxes return the episodes' own values.
+'''
+import numpy
+from memoization import memoized
+from Patient import date_to_datetime
+
+missing_value = -9999
+
+class WindowedFeature:
+    def __init__(self, column_name, source_method_name, aggregation, days_back=None):
+        self.column_name = column_name
+
+        # The CareEpisode method returning an episode's value.
+        self.source_method_name = source_method_name
+
+        # One of aggregations.
+        self.aggregation = aggregation
+
+        # None for the number of days back of the file being built.
+        self.days_back = days_back
+
+
+windowed_features = [
+    WindowedFeature('Charges', 'get_charges', 'sum'),
+    WindowedFeature('pain_score', 'get_pain_score', 'median'),
+    WindowedFeature('chief_complaint_medical', 'get_chief_complaint_medical', 'max'),
+    WindowedFeature('chief_complaint_psychiatric', 'get_chief_complaint_psychiatric', 'max'),
+    WindowedFeature('chief_complaint_suicidal', 'get_chief_complaint_suicidal', 'max'),
+    WindowedFeature('chief_complaint_substance_use', 'get_chief_complaint_substance_use', 'max'),
+]
+
+class EpisodeTimeline:
+
+    '''
+        A patient's care episodes, in the order of patient.care_episodes, with the day of each and the values of each
+        source method, read once per method.
+    '''
+    def __init__(self, patient):
+        self.care_episodes = list(patient.care_episodes.values())
+        self.days = numpy.array([ date_to_datetime(care_episode.date).toordinal() for care_episode in self.care_episodes ], dtype=numpy.int64)
+        self.date_to_position = dict([ (care_episode.date, position) for position, care_episode in enumerate(self.care_episodes) ])
+        self.source_columns = {}
+
+    def get_source_column(self, source_method_name):
+
+        '''
+            Returns the values as Python objects, as floats, whether each is a float and whether each is present.
+        '''
+        if source_method_name not in self.source_columns:
+            values = [ getattr(care_episode, source_method_name)() for care_episode in self.care_episodes ]
+            objects = numpy.empty(len(values), dtype=object)
+            objects[:] = values
+            numbers = numpy.array(values, dtype=float)
+            is_float = numpy.array([ isinstance(value, float) for value in values ], dtype=bool)
+            self.source_columns[source_method_name] = (objects, numbers, is_float, numbers >= 0)
+        return self.source_columns[source_method_name]
+
+
+@memoized
+def get_episode_timeline(patient):
+    return EpisodeTimeline(patient)
+
+
+def aggregate_sum(objects, numbers, is_float, in_window, counts):
+
+    # Cumulative sums add the episodes one after another, like sum(), so the totals match it to the last bit.
+    totals = numpy.cumsum(numpy.where(in_window, numbers[:, numpy.newaxis], 0.0), axis=0)[-1]
+    has_float = (in_window & is_float[:, numpy.newaxis]).any(axis=0)
+    return [ float(total) if row_has_float else int(total) for total, row_has_float in zip(totals, has_float) ]
+
+
+def aggregate_max(objects, numbers, is_float, in_window, counts):
+    return objects[numpy.argmax(numpy.where(in_window, numbers[:, numpy.newaxis], -numpy.inf), axis=0)]
+
+
+def aggregate_median(objects, numbers, is_float, in_window, counts):
+
+    # As statistics.median: the middle value, or the mean of the two middle values, after a stable sort.
+    order = numpy.argsort(numpy.where(in_window, numbers[:, numpy.newaxis], numpy.inf), axis=0, kind='stable')
+    rows = numpy.arange(in_window.shape[1])
+    lower = objects[order[(counts - 1) // 2, rows]]
+    upper = objects[order[counts // 2, rows]]
+    return [ upper[row] if counts[row] % 2 else (lower[row] + upper[row]) / 2 for row in rows ]
+
+
+aggregations = {
+    'sum': aggregate_sum,
+    'max': aggregate_max,
+    'median': aggregate_median,
+}
+
+def compute_windowed_features(patient, care_episodes, number_of_days_back, features=windowed_features):
+
+    '''
+        Returns a dict of each feature's column name to a list of its values for each of care_episodes, some of the
+        patient's care episodes, with -9999 where no episode in the window has a value.
+    '''
+    if not features:
+        return {}
+
+    timeline = get_episode_timeline(patient)
+    row_days = timeline.days[[ timeline.date_to_position[care_episode.date] for care_episode in care_episodes ]]
+    days_back_to_in_window = {}
+
+    column_values = {}
+    for feature in features:
+        days_back = number_of_days_back if feature.days_back is None else feature.days_back
+        if days_back not in days_back_to_in_window:
+            days_back_to_in_window[days_back] = (timeline.days[:, numpy.newaxis] >= row_days - days_back) & (timeline.days[:, numpy.newaxis] <= row_days)
+
+        objects, numbers, is_float, is_present = timeline.get_source_column(feature.source_method_name)
+        in_window = days_back_to_in_window[days_back] & is_present[:, numpy.newaxis]
+        counts = in_window.sum(axis=0)
+        values = aggregations[feature.aggregation](objects, numbers, is_float, in_window, counts)
+        column_values[feature.column_name] = [ value if count else missing_value for value, count in zip(values, counts) ]
+    return column_values